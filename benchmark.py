@@ -0,0 +1,388 @@
+"""
+Benchmark suite for the protocol and the game's hot paths. Runs headless, no server needed.
+Every benchmark runs for a sweep of sizes (pallets, players or list entries) with fixed seeds,
+so two runs of the same code do the same work:
+
+python3 benchmark.py                                   every benchmark, every size
+python3 benchmark.py --only render collisions --sizes 100 1000
+python3 benchmark.py --json before.json                save the results
+python3 benchmark.py --json after.json --compare before.json    and see what got faster or slower
+
+Protocol: build_response, decrypt_response, decrypt_info_response, string_list_to_other_type_of_list,
+  and receiving SYNC requests from a socket (protocol.FrameReader).
+Client: a frame of culling + Game.check_for_collisions_and_eat, and Camera.render (SDL's dummy video driver).
+  Camera.render again with the camera standing still while the other players move (idle, or spectating),
+  with and without dirty rects, and a check that both leave the same picture on the screen.
+  The map grows with the pallets (same density everywhere), like a bigger world would, so a frame should cost
+  the same no matter how many pallets there are.
+  Pallet objects vs the NumPy entity store (if numpy is installed): culling + collisions on the real 700x700 map,
+  where pallets pile up in view, and a check that both end up with the same world.
+Server: Game.decrease_all_players_mass.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import socket
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame
+import client
+import entity_store
+import protocol
+from protocol import Consts
+import server
+
+SIZES = (100, 1000, 10000, 100000)
+PLAYERS_COUNT = 20
+FRAMES = 200
+SEED = 1234
+MIN_MEASURE_SECONDS = 0.2  # a stateless benchmark runs again and again for at least this long
+PALLETS_PER_MAP_AREA = 1000  # pallets on a 700x700 map, the size of the real one
+PLAYERS_SPREAD = 150  # players start this close to the middle of the map, around the camera
+RECEIVE_BATCH = 500  # requests sent at once by receive_frames, few enough to fit in a socket's buffer
+
+
+def measure(function):
+    """:return: seconds per call of function(), the best of a few runs of many calls"""
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_MEASURE_SECONDS / 5:
+            break
+        calls *= 2
+
+    best = elapsed / calls
+    for _ in range(4):
+        start = time.perf_counter()
+        for _ in range(calls):
+            function()
+        best = min(best, (time.perf_counter() - start) / calls)
+    return best
+
+
+# PROTOCOL
+
+def random_players_info(size, rng):
+    """players_ids, players_masses, players_x, players_y of size players"""
+    return ([rng.randrange(1 << 31) for _ in range(size)], [rng.randrange(10, 10000) for _ in range(size)],
+            [rng.randrange(-100, 10000) for _ in range(size)], [rng.randrange(-100, 10000) for _ in range(size)])
+
+
+def benchmark_build_response(size):
+    """protocol.build_response with an INFO payload of size players"""
+    payload = protocol.pack_columns(protocol.PLAYERS_INFO_FORMATS, *random_players_info(size, random.Random(SEED)))
+    return measure(lambda: protocol.build_response(Consts.Request.INFO, payload))
+
+
+def benchmark_decrypt_response(size):
+    """protocol.decrypt_response of an INFO response with size players"""
+    response = protocol.build_info_response(*random_players_info(size, random.Random(SEED)))
+    return measure(lambda: protocol.decrypt_response(response))
+
+
+def benchmark_decrypt_info_response(size):
+    """protocol.decrypt_info_response with size players"""
+    response = protocol.build_info_response(*random_players_info(size, random.Random(SEED)))
+    return measure(lambda: protocol.decrypt_info_response(response))
+
+
+def benchmark_string_list_to_other_type_of_list(size):
+    """protocol.string_list_to_other_type_of_list of size numbers"""
+    rng = random.Random(SEED)
+    string_list = [str(rng.randrange(1 << 31)) for _ in range(size)]
+    return measure(lambda: protocol.string_list_to_other_type_of_list(string_list, int))
+
+
+def benchmark_receive_frames(size):
+    """size SYNC requests through a local socket, received with a FrameReader and decrypted, like the server does"""
+    rng = random.Random(SEED)
+    batch_size = min(size, RECEIVE_BATCH)
+    requests = b"".join(
+        protocol.build_sync_request((rng.randrange(700), rng.randrange(700)), rng.randrange(10, 1000),
+                                    [rng.randrange(1 << 31)], [rng.randrange(1 << 32)])
+        for _ in range(batch_size)
+    )
+    sending_socket, receiving_socket = socket.socketpair()
+    frame_reader = protocol.FrameReader(receiving_socket)
+
+    def receive_frames():
+        """send the requests in batches that fit in the socket's buffer, and receive every one"""
+        for _ in range(size // batch_size):
+            sending_socket.sendall(requests)
+            for _ in range(batch_size):
+                _, payload = protocol.split_request(frame_reader.receive_frame())
+                protocol.decrypt_sync_request(payload)
+
+    try:
+        return measure(receive_frames)
+    finally:
+        sending_socket.close()
+        receiving_socket.close()
+
+
+# CLIENT
+
+def build_game(pallet_count, rng, map_size=None, use_entity_store=False):
+    """A game with pallets spread all over the map, and players around its middle"""
+    if map_size is None:
+        map_size = int(700 * (pallet_count / PALLETS_PER_MAP_AREA) ** 0.5)
+    middle = map_size // 2
+
+    players = {}
+    for player_id in range(1, PLAYERS_COUNT + 1):
+        position = (rng.randint(middle - PLAYERS_SPREAD, middle + PLAYERS_SPREAD),
+                    rng.randint(middle - PLAYERS_SPREAD, middle + PLAYERS_SPREAD))
+        players[player_id] = client.Player(player_id, f"bot{player_id}", 100, position)
+
+    game = client.Game(map_size, map_size, players, use_entity_store)
+    game.client_player = players[1]
+    for _ in range(pallet_count):
+        game.add_pallet(client.Pallet((rng.randint(0, map_size), rng.randint(0, map_size))))
+    return game
+
+
+def build_camera(game):
+    """A camera on the client player, the size it starts with in the real game"""
+    screen = pygame.Surface((client.SCREEN_WIDTH, client.SCREEN_HEIGHT))
+    camera_height = 700 // 10
+    return client.Camera(screen, game, game.client_player, camera_height * client.ASPECT_RATIO, camera_height)
+
+
+def run_frames(game, camera, rng, frame):
+    """
+    Wander around like a real player (so there is always something new to eat) and time frame() every frame.
+    :return: average seconds per frame
+    """
+    total_time = 0
+    for _ in range(FRAMES):
+        x, y = game.client_player.position
+        x = min(max(1, x + rng.choice((-1, 0, 1))), game.width - 1)
+        y = min(max(1, y + rng.choice((-1, 0, 1))), game.height - 1)
+        game.move_player(game.client_player, (x, y))
+        camera.update_rect_position()
+
+        start = time.perf_counter()
+        frame()
+        total_time += time.perf_counter() - start
+    return total_time / FRAMES
+
+
+def seeded_game(pallet_count, map_size=None, use_entity_store=False):
+    """the same game every time: a game, a camera on it, and the random generator to keep playing it with"""
+    rng = random.Random(SEED)
+    random.seed(SEED)  # pallet colors
+    game = build_game(pallet_count, rng, map_size, use_entity_store)
+    return game, build_camera(game), rng
+
+
+def benchmark_collisions(pallet_count):
+    """a frame of Camera.find_visible_game_objects + Game.check_for_collisions_and_eat"""
+    game, camera, rng = seeded_game(pallet_count)
+
+    def frame():
+        camera.find_visible_game_objects()
+        game.check_for_collisions_and_eat(camera)
+
+    return run_frames(game, camera, rng, frame)
+
+
+def benchmark_render(pallet_count):
+    """a frame of Camera.render"""
+    game, camera, rng = seeded_game(pallet_count)
+    camera.render()  # the circle sprites are drawn on the first frame, don't count that
+
+    def frame():
+        camera.find_visible_game_objects()
+        start = time.perf_counter()
+        camera.render()
+        return time.perf_counter() - start
+
+    render_times = []
+    run_frames(game, camera, rng, lambda: render_times.append(frame()))
+    return sum(render_times) / FRAMES
+
+
+def render_idle(pallet_count, use_dirty_rects):
+    """
+    Frames of Camera.render where the camera stays put and only the other players move.
+    :return: average seconds per frame, and the screen at the end
+    """
+    game, camera, rng = seeded_game(pallet_count)
+    camera.use_dirty_rects = use_dirty_rects
+    camera.find_visible_game_objects()
+    camera.render()  # the circle sprites are drawn on the first frame, don't count that
+
+    total_time = 0
+    for _ in range(FRAMES):
+        for player in list(game.players.values())[1:]:
+            x, y = player.position
+            game.move_player(player, (min(max(1, x + rng.choice((-1, 0, 1))), game.width - 1),
+                                      min(max(1, y + rng.choice((-1, 0, 1))), game.height - 1)))
+        camera.find_visible_game_objects()
+
+        start = time.perf_counter()
+        camera.render()
+        total_time += time.perf_counter() - start
+    return total_time / FRAMES, pygame.image.tobytes(camera.screen, "RGB")
+
+
+screens = {}  # pallet count -> the screen a full redraw ended with, to check the dirty rects against it
+
+
+def benchmark_render_idle_full(pallet_count):
+    """a frame of Camera.render with the camera standing still, redrawing everything"""
+    frame_time, screens[pallet_count] = render_idle(pallet_count, use_dirty_rects=False)
+    return frame_time
+
+
+def benchmark_render_idle_dirty_rects(pallet_count):
+    """a frame of Camera.render with the camera standing still, redrawing only what changed"""
+    frame_time, screen = render_idle(pallet_count, use_dirty_rects=True)
+    if pallet_count in screens and screens[pallet_count] != screen:
+        print(f"    dirty rects left a different screen than a full redraw, {pallet_count} pallets!")
+    return frame_time
+
+
+def remaining_pallets(game):
+    """every pallet still in the game, as sorted (x, y, mass) tuples"""
+    if game.pallet_store is not None:
+        store = game.pallet_store
+        return sorted(zip(store.x[:store.count].tolist(), store.y[:store.count].tolist(),
+                          store.mass[:store.count].tolist()))
+    return sorted((float(pallet.position[0]), float(pallet.position[1]), float(pallet.mass))
+                  for pallet in game.pallets)
+
+
+def cull_and_collide(pallet_count, use_entity_store):
+    """
+    What a frame does with every pallet on the 700x700 map: find the ones in view (like Camera.render), then eat.
+    :return: average seconds per frame, and the world at the end: (client player mass, remaining pallets)
+    """
+    game, camera, rng = seeded_game(pallet_count, map_size=700, use_entity_store=use_entity_store)
+
+    def frame():
+        if game.pallet_store is not None:
+            game.pallet_store.indices_in_camera_bounds(camera)
+        camera.find_visible_game_objects()
+        game.check_for_collisions_and_eat(camera)
+
+    return run_frames(game, camera, rng, frame), (game.client_player.mass, remaining_pallets(game))
+
+
+worlds = {}  # pallet count -> the world the pallet objects ended with, to check the entity store against it
+
+
+def benchmark_cull_and_collide_objects(pallet_count):
+    """culling + collisions on the 700x700 map, with pallet objects"""
+    frame_time, worlds[pallet_count] = cull_and_collide(pallet_count, use_entity_store=False)
+    return frame_time
+
+
+def benchmark_cull_and_collide_entity_store(pallet_count):
+    """culling + collisions on the 700x700 map, with the NumPy entity store"""
+    frame_time, world = cull_and_collide(pallet_count, use_entity_store=True)
+    if pallet_count in worlds and worlds[pallet_count] != world:
+        print(f"    the entity store ended with a different world than pallet objects, {pallet_count} pallets!")
+    return frame_time
+
+
+# SERVER
+
+def benchmark_decrease_all_players_mass(players_count):
+    """server Game.decrease_all_players_mass with players_count players"""
+    rng = random.Random(SEED)
+    game = server.Game(700, 700, server.FPS)
+    for player_id in range(1, players_count + 1):
+        player = server.Player(f"bot{player_id}", player_id, (rng.randrange(700), rng.randrange(700)))
+        player.mass = rng.randrange(server.PLAYER_INITIAL_MASS, 10000)
+        game.players.add(player)
+    return measure(game.decrease_all_players_mass)
+
+
+BENCHMARKS = {
+    "build_response": benchmark_build_response,
+    "decrypt_response": benchmark_decrypt_response,
+    "decrypt_info_response": benchmark_decrypt_info_response,
+    "string_list_to_other_type_of_list": benchmark_string_list_to_other_type_of_list,
+    "receive_frames": benchmark_receive_frames,
+    "collisions": benchmark_collisions,
+    "render": benchmark_render,
+    "render_idle_full": benchmark_render_idle_full,
+    "render_idle_dirty_rects": benchmark_render_idle_dirty_rects,
+    "cull_and_collide_objects": benchmark_cull_and_collide_objects,
+    "cull_and_collide_entity_store": benchmark_cull_and_collide_entity_store,
+    "decrease_all_players_mass": benchmark_decrease_all_players_mass,
+}
+"""name -> benchmark(size), which returns seconds per call (or per frame)"""
+
+
+def run_benchmarks(names, sizes):
+    """:return: name -> {size: seconds}. prints every result as it comes"""
+    results = {}
+    for name in names:
+        if name == "cull_and_collide_entity_store" and not entity_store.is_available():
+            print(f"{name}: numpy is not installed, skipping")
+            continue
+        print(name)
+        results[name] = {}
+        for size in sizes:
+            seconds = BENCHMARKS[name](size)
+            results[name][str(size)] = seconds
+            print(f"  {size:>7}: {seconds * 1000:10.4f} ms")
+    return results
+
+
+def compare(results, old_results):
+    """print how every result changed from old_results"""
+    print(f"\n{'benchmark':<36}{'size':>8}{'old ms':>12}{'new ms':>12}{'new/old':>9}")
+    for name, sizes in results.items():
+        for size, seconds in sizes.items():
+            old_seconds = old_results.get(name, {}).get(size)
+            if old_seconds is None:
+                continue
+            print(f"{name:<36}{size:>8}{old_seconds * 1000:>12.4f}{seconds * 1000:>12.4f}"
+                  f"{seconds / old_seconds:>9.2f}")
+
+
+def parse_arguments():
+    """command line arguments"""
+    parser = argparse.ArgumentParser(description="benchmarks for the agar.io clone")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS),
+                        help="run only these benchmarks")
+    parser.add_argument("--sizes", nargs="+", type=int, default=SIZES,
+                        help="amount of pallets / players / list entries to run every benchmark with")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="a results file from an older run, to compare with")
+    return parser.parse_args()
+
+
+def main():
+    """Run the benchmarks, print them, and save / compare them if asked to"""
+    arguments = parse_arguments()
+    results = run_benchmarks(arguments.only, arguments.sizes)
+
+    if arguments.json:
+        with open(arguments.json, "w") as json_file:
+            json.dump({
+                "python": platform.python_version(),
+                "pygame": pygame.version.ver,
+                "machine": platform.machine(),
+                "seed": SEED,
+                "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "results": results,
+            }, json_file, indent=2)
+
+    if arguments.compare:
+        with open(arguments.compare) as json_file:
+            compare(results, json.load(json_file)["results"])
+
+
+if __name__ == '__main__':
+    main()
@@ -2,33 +2,61 @@ import math
 import random
 import threading
 import os
+import time
+from collections import OrderedDict, deque
+from functools import lru_cache
 
 import protocol
 from protocol import Consts
 from client_client import Client
+from spatial_grid import SpatialGrid
+import entity_store
+from entity_store import EntityStore
 
 import pygame
-from colors import generate_random_color
+import pygame.gfxdraw
+from colors import generate_random_color, colors
 
 # CONSTANTS
 FPS = 60
 SERVER_UPDATE_POSITION_FPS = 10
+USE_UDP = True  # positions and snapshots over UDP, if the server has it (server.py --udp). otherwise all TCP
+UDP_SYNC_EVERY = 3  # with UDP, a SYNC (eats, and are we still alive) every this many position updates, or on eating
+
+MASS_LOSS_PER_SECOND = 0.01
+
+DEFAULT_TICK_RATE = 10  # the server's ticks a second, until it tells us
+INTERPOLATION_DELAY_TICKS = 1  # other players are drawn this far in the past, so there's a snapshot on both sides
+MAX_EXTRAPOLATION_TICKS = 2  # when snapshots are late, guess where players went at most this far, then wait
+SAMPLES_PER_PLAYER = 8  # snapshots remembered for every player
+RENDER_CLOCK_MAX_DRIFT_TICKS = 2  # if the render clock is further than this from the server's, jump instead of easing
+RENDER_CLOCK_CORRECTION = 0.1  # how much of the drift from the server's clock is fixed every frame
 
 ASPECT_RATIO = 16 / 9
 SCREEN_HEIGHT = 900
 SCREEN_WIDTH = int(SCREEN_HEIGHT * ASPECT_RATIO)
 
 PALLET_MASS = 10
-PALLET_SPAWN_PER_SECOND = 15
-SPAWN_PALLET_EXTRA_RANGE = 30
 
 FONT_SIZE = 25
+TEXT_SURFACE_CACHE_SIZE = 512  # rendered texts to keep around. two per name (the name and its outline)
+
+SPRITE_ZOOM_BUCKET = 2  # the circle sprites are thrown away when the camera's height crosses a multiple of this
+SPRITE_CACHE_SIZE = 2048  # circle sprites to keep before starting over. about 100 colors, a few sizes each
+
+USE_DIRTY_RECTS = True  # while the camera stands still, redraw only what changed on screen. see Camera.render
+MAX_DIRTY_AREA = 0.5  # if more than this part of the screen changed, it's cheaper to redraw all of it
+MAX_DIRTY_RECTS = 12  # or if it changed in more places than this. a small rect can cost 1/10 of the whole screen
+
+GRID_CELL_SIZE = 16  # size of a spatial grid cell, in game units. about the size of a new player
+USE_ENTITY_STORE = False  # keep pallets in NumPy arrays instead of objects. needs numpy, see entity_store.py
 
 # COLORS
 BLACK = (0, 0, 0)
 WHITE = (255, 255, 255)
 PINK = (255, 0, 255)
 BACKGROUND_COLOR = WHITE
+SPRITE_COLORKEY = (0, 255, 1)  # the see-through part of the circle sprites. not one of the colors in colors.py
 
 
 def mass_to_radius(mass):
@@ -39,21 +67,18 @@ def mass_to_radius(mass):
 
 
 class Pallet:
-    """Pallet. player's food."""
+    """Pallet. player's food. the server owns them, key is how we tell it we ate one"""
 
-    def __init__(self, position):
+    def __init__(self, position, color=None, key=None):
         """INITIALIZER"""
         self.position = position
-        self.color = generate_random_color()
+        self.color = color if color is not None else generate_random_color()
         self.mass = PALLET_MASS
+        self.key = key
 
     def draw(self, camera):
         """Draw the pallet"""
-        x, y = camera.coords_from_game_to_camera(self.position)
-        pygame.draw.circle(camera.screen, self.color, (x, y),
-                           camera.mass_to_camera_size(
-                               mass_to_radius(self.mass))
-                           )
+        camera.screen.blits(camera.circle_blits(self.color, self.position, self.mass), doreturn=False)
 
 
 class Player:
@@ -68,7 +93,13 @@ class Player:
         self.id = object_id
 
         self.players_eaten_id = []
+        self.pallets_eaten_keys = []
 
+        self.set_name(name)
+
+    def set_name(self, name):
+        """change the name, and the name tag drawn on the player"""
+        self.name = name
         self.name_surface, self.name_surface_rect = create_text(self.name, FONT_SIZE, WHITE)
         self.name_surface_outline, self.name_surface_outline_rect = create_text(self.name, FONT_SIZE + 1, BLACK)
 
@@ -76,24 +107,30 @@ class Player:
         """eat mass"""
         self.mass += mass
 
-    def draw_name(self, camera):
-        """draw self.name on the screen"""
+    def lose_mass(self, min_mass, seconds):
+        """Every second, a player's mass decreases by 1%. exactly like the server does it for everyone else"""
+        change_in_mass = self.mass * MASS_LOSS_PER_SECOND * seconds
+        if self.mass - change_in_mass >= min_mass:
+            self.mass -= change_in_mass
+
+    def name_blits(self, camera):
+        """what to blit to draw self.name on the screen"""
         self.name_surface_rect.center = camera.coords_from_game_to_camera(self.position)
         self.name_surface_outline_rect.center = self.name_surface_rect.center
         self.name_surface_outline_rect.x -= 1
         self.name_surface_outline_rect.y -= 1
 
-        camera.screen.blit(self.name_surface_outline, self.name_surface_outline_rect)
-        camera.screen.blit(self.name_surface, self.name_surface_rect)
+        return [(self.name_surface_outline, self.name_surface_outline_rect),
+                (self.name_surface, self.name_surface_rect)]
+
+    def draw_name(self, camera):
+        """draw self.name on the screen"""
+        camera.screen.blits(self.name_blits(camera), doreturn=False)
 
     def draw(self, camera):
         """Draw client on the screen"""
-        x, y = camera.coords_from_game_to_camera(self.position)
-        size = camera.mass_to_camera_size(
-            mass_to_radius(self.mass)
-        )
-        pygame.draw.circle(camera.screen, self.color, (x, y), size)
-        self.draw_name(camera)
+        camera.screen.blits(camera.circle_blits(self.color, self.position, self.mass) + self.name_blits(camera),
+                            doreturn=False)
 
     def __repr__(self):
         """Used for debugging: representation of the client"""
@@ -103,87 +140,185 @@ class Player:
 class Game:
     """Represents the game"""
 
-    def __init__(self, width, height, players: dict):
+    def __init__(self, width, height, players: dict, use_entity_store=False, tick_rate=DEFAULT_TICK_RATE):
         """INITIALIZER!!!!!!!!!!!!!!!!!!"""
         self.width = width
         self.height = height
+        self.tick_rate = tick_rate
         self.players = players
-        self.pallets = []
+        self.pallets = set()
+        self.pallet_chunks = {}  # chunk index -> {slot: Pallet} of the chunks around us, as the server sent them
+        self.pallet_chunk_columns = math.ceil(width / protocol.PALLET_CHUNK_SIZE)
+        self.pallets_updates = deque()  # PALLETS pushes waiting for the main thread, see apply_pallets_updates
         self.viruses = []
-        self.all_game_objects = [player for player in
-                                 players.values()]
+        self.all_game_objects = dict.fromkeys(players.values())  # a dict keeps drawing order and removes in O(1)
+
+        # with the entity store, pallets are rows in its arrays instead of objects in pallets / all_game_objects / grid
+        self.pallet_store = EntityStore() if use_entity_store else None
+
+        self.grid = SpatialGrid(GRID_CELL_SIZE)  # every pallet and player, by position
+        for player in players.values():
+            self.grid.insert(player, player.position)
 
         self.client_player = None
+        self.names = {}  # player id -> name of every player in the game, kept up to date by the server
+        self.names_version = 0
+        self.snapshot_tick = 0  # the tick of the last snapshot we applied
+        self.snapshot_time = None  # when it arrived (time.perf_counter)
+
+        # other players move smoothly between snapshots, instead of jumping 10 times a second
+        self.samples = {}  # player id -> (tick, mass, position) from the last snapshots, oldest first
+        self.render_tick = None  # the moment (in server ticks, with fractions) other players are drawn at
+        self.render_clock_time = None
+        self.viewport = None  # (x, y, width, height) the camera shows. the server only sends us what's around it
 
     def create_new_player(self, player_id, name, mass, position):
         """Creates a new player"""
         new_player = Player(player_id, name, mass, position)
         self.players[player_id] = new_player
-        self.all_game_objects.append(new_player)
+        self.all_game_objects[new_player] = None
+        self.grid.insert(new_player, position)
         return new_player
 
+    def move_player(self, player, position):
+        """Move a player, and keep the grid up to date"""
+        player.position = position
+        self.grid.move(player, position)
+
     def get_random_player(self):
         """
-        :return: a random living player
+        :return: a random living player, the bot only if there's nobody else. None if there's nobody at all
         """
-        random_player = random.choice(list(self.players.values()))
-        if len(self.players) > 1:
-            while random_player.id == 0:
-                random_player = random.choice(list(self.players.values()))
-
-        return random_player
+        players = list(self.players.values())
+        if not players:
+            return None
+        return random.choice([player for player in players if player.id != 0] or players)
 
-    def check_for_collisions_and_eat(self, game_objects):
-        """checks if a player ate a pallet or another player and eats"""
+    def check_for_collisions_and_eat(self, camera):
+        """
+        checks if a player in the camera's view ate a pallet or another player and eats.
+        The players come from what the camera found visible this frame (see Camera.find_visible_game_objects),
+        and only the grid cells under a player are checked, so it does not matter how many pallets there are.
+        """
         _have_eaten = False
-        try:
-            for player_id, player in self.players.items():
-                total_mass_to_eat = 0
-                radius = mass_to_radius(player.mass)
-                mass = player.mass
-                for i, game_object in enumerate(game_objects[::-1]):  # We are going backwards to enable popping
-                    if not mass >= game_object.mass * 1.25:  # if player's mass is not bigger than game_object's mass by
-                        # at least 25%
-                        continue
-
-                    distance = get_distance(player.position, game_object.position)
-                    if distance < radius:
-                        # COLLISION!!!!
-                        total_mass_to_eat += game_object.mass
-                        if type(game_object) == Pallet:
+        store = self.pallet_store
+        eaten_pallets = []
+        if store is not None:
+            pallets_in_view = store.indices_in_camera_bounds(camera)
+        for player in [game_object for game_object in camera.renderable_game_objects
+                       if type(game_object) == Player]:
+            if player.id not in self.players:
+                continue  # eaten earlier this frame
+            total_mass_to_eat = 0
+            radius = mass_to_radius(player.mass)
+            mass = player.mass
+
+            if store is not None and len(pallets_in_view):
+                eaten = store.indices_eaten_by(pallets_in_view, player.position, mass, radius)
+                if len(eaten):
+                    total_mass_to_eat += float(store.mass[eaten].sum())
+                    eaten_pallets.append(eaten)
+                    if player == self.client_player:
+                        player.pallets_eaten_keys.extend(key for key in store.key[eaten].tolist()
+                                                         if key != entity_store.NO_KEY)
+                        _have_eaten = True
+                    pallets_in_view = entity_store.np.setdiff1d(pallets_in_view, eaten, assume_unique=True)
+            with lock:  # the receiving thread adds, moves and removes players in the grid
+                nearby_game_objects = self.grid.query_circle(player.position, radius)  # a list of its own
+            for game_object in nearby_game_objects:
+                if game_object is player or not camera.is_game_object_in_camera_bounds(game_object):
+                    continue
+                if not mass >= game_object.mass * 1.25:  # if player's mass is not bigger than game_object's mass by
+                    # at least 25%
+                    continue
+
+                distance = get_distance(player.position, game_object.position)
+                if distance < radius:
+                    # COLLISION!!!!
+                    total_mass_to_eat += game_object.mass
+                    if type(game_object) == Pallet:
+                        with lock:  # the grid is the receiving thread's too
                             self.remove_pallet(game_object)
-
-                        elif type(game_object) == Player:
-                            if player == self.client_player:
-                                if str(game_object.id) not in player.players_eaten_id:
-                                    player.players_eaten_id.append(str(game_object.id))
-                                    _have_eaten = True
-                                    self.remove_player(game_object)
-
-                if total_mass_to_eat and player == self.client_player:
-                    player.eat(total_mass_to_eat)
-            return _have_eaten
-        except RuntimeError:  # dictionary changed size during iteration
-            return _have_eaten
-
-    def spawn_new_pallet_in_camera_scope(self, camera):
-        """Spawn a new pallet in the camera's scope. Just like the function name might suggest"""
-        x = random.randint(int(camera.rect.x) - SPAWN_PALLET_EXTRA_RANGE,
-                           int(camera.rect.x + camera.width - 1) + SPAWN_PALLET_EXTRA_RANGE)
-        y = random.randint(int(camera.rect.y - SPAWN_PALLET_EXTRA_RANGE),
-                           int(camera.rect.y + camera.height - 1) + SPAWN_PALLET_EXTRA_RANGE)
-        new_pallet = Pallet((x, y))
-        self.pallets.append(new_pallet)
-        self.all_game_objects.append(new_pallet)
-        return new_pallet
+                        if player == self.client_player and game_object.key is not None:
+                            player.pallets_eaten_keys.append(game_object.key)
+                            _have_eaten = True
+
+                    elif type(game_object) == Player:
+                        if player == self.client_player:
+                            if game_object.id not in player.players_eaten_id:
+                                player.players_eaten_id.append(game_object.id)
+                                _have_eaten = True
+                                with lock:  # a snapshot may have taken it out since we found it
+                                    if self.players.get(game_object.id) is game_object:
+                                        self.remove_player(game_object)
+
+            if total_mass_to_eat and player == self.client_player:
+                player.eat(total_mass_to_eat)
+
+        if eaten_pallets:
+            store.swap_remove(entity_store.np.concatenate(eaten_pallets).tolist())
+        return _have_eaten
+
+    def add_pallet(self, pallet):
+        """Add a pallet to the game"""
+        if self.pallet_store is not None:
+            self.pallet_store.add(pallet.position, pallet.mass, pallet.color, pallet.key)
+            return pallet
+        self.pallets.add(pallet)
+        self.all_game_objects[pallet] = None
+        self.grid.insert(pallet, pallet.position)
+        return pallet
 
     def remove_pallet(self, pallet):
         """Remove a pallet"""
-        try:
-            self.all_game_objects.remove(pallet)
-            self.pallets.remove(pallet)
-        except ValueError:
+        self.pallets.discard(pallet)
+        self.all_game_objects.pop(pallet, None)
+        self.grid.remove(pallet)
+
+    def apply_pallets_updates(self):
+        """
+        Apply the PALLETS pushes that came since the last frame. on the main thread, the only one that touches
+        the pallets, so they never change under the collision check or the render. the grid they're in has the
+        players too, that the receiving thread changes: that part is done under the lock.
+        """
+        while self.pallets_updates:
+            self.apply_pallets_update(*self.pallets_updates.popleft())
+
+    def apply_pallets_update(self, dropped_chunks, chunk_updates):
+        """Forget the chunks we don't need anymore, and update the ones that changed"""
+        gone_pallets = []
+        for chunk_index in dropped_chunks:
+            gone_pallets.extend(self.pallet_chunks.pop(chunk_index, {}).values())
+
+        new_pallets = []
+        for chunk_index, _, is_full, pallets, eaten_slots in chunk_updates:
+            if is_full:
+                gone_pallets.extend(self.pallet_chunks.pop(chunk_index, {}).values())
+            chunk = self.pallet_chunks.setdefault(chunk_index, {})
+            for slot in eaten_slots:
+                if slot in chunk:
+                    gone_pallets.append(chunk.pop(slot))
+
+            row, column = divmod(chunk_index, self.pallet_chunk_columns)
+            origin_x, origin_y = column * protocol.PALLET_CHUNK_SIZE, row * protocol.PALLET_CHUNK_SIZE
+            for slot, generation, x, y, color_index in zip(*pallets):
+                if slot in chunk:
+                    gone_pallets.append(chunk[slot])  # the slot respawned
+                pallet = Pallet((origin_x + x, origin_y + y), colors[color_index],
+                                protocol.pallet_key(chunk_index, slot, generation))
+                chunk[slot] = pallet
+                new_pallets.append(pallet)
+
+        if self.pallet_store is not None:
+            self.pallet_store.swap_remove(self.pallet_store.indices_of_keys([pallet.key for pallet in gone_pallets]))
+            for pallet in new_pallets:
+                self.add_pallet(pallet)
             return
+        with lock:
+            for pallet in gone_pallets:
+                self.remove_pallet(pallet)
+            for pallet in new_pallets:
+                self.add_pallet(pallet)
 
     def x_in_bounds(self, x):
         """Is x in bounds of game width"""
@@ -193,26 +328,108 @@ class Game:
         """Is y in bounds of game height"""
         return 0 < y < self.height
 
-    def update_player_info(self, player_id, player_mass, player_position):
-        """update a player's info"""
-        player = self.players.get(player_id)
-        if player is None:
-            self.create_new_player(player_id, "", player_mass, player_position)
+    def add_sample(self, player_id, tick, player_mass, player_position):
+        """Remember where a player was on a tick. it's drawn there a bit later, see interpolate_players"""
+        samples = self.samples.get(player_id)
+        if samples is None:
+            samples = self.samples[player_id] = deque(maxlen=SAMPLES_PER_PLAYER)
+        elif samples[-1][0] < tick - 1:
+            # deltas only have players that changed, so it stood still since its last sample until the tick before.
+            # without this, it would slide slowly all the way from there
+            _, last_mass, last_position = samples[-1]
+            samples.append((tick - 1, last_mass, last_position))
+        samples.append((tick, player_mass, player_position))
+
+    def advance_render_clock(self, now):
+        """
+        Move the render clock to now. it follows the server's clock (the last snapshot's tick, plus the time since it
+        arrived) a bit in the past, easing into it so late or early snapshots don't make everyone jump.
+        :return: the render tick, None until the first snapshot
+        """
+        if self.snapshot_time is None:
+            return None
+        target_tick = self.snapshot_tick + (now - self.snapshot_time) * self.tick_rate - INTERPOLATION_DELAY_TICKS
+        if self.render_tick is None or abs(target_tick - self.render_tick) > RENDER_CLOCK_MAX_DRIFT_TICKS:
+            self.render_tick = target_tick
+        else:
+            self.render_tick += (now - self.render_clock_time) * self.tick_rate
+            self.render_tick += (target_tick - self.render_tick) * RENDER_CLOCK_CORRECTION
+        self.render_clock_time = now
+        return self.render_tick
+
+    def interpolate_players(self):
+        """Put every other player where it was at the render tick, between the snapshots around it"""
+        if self.render_tick is None:
+            return
+        for player_id, samples in self.samples.items():
+            player = self.players.get(player_id)
+            if player is None or player is self.client_player:
+                continue  # we move ourselves
+            player.mass, position = interpolate_sample(samples, self.render_tick, self.snapshot_tick)
+            self.move_player(player, position)
+
+    def apply_names_update(self, version, is_full, players_ids, players_names, left_players_ids):
+        """Update the names table with what the server pushed, and the name tags of the players that changed"""
+        if is_full:
+            self.names = {}
+        for player_id in left_players_ids:
+            self.names.pop(player_id, None)
+        for player_id, player_name in zip(players_ids, players_names):
+            self.names[player_id] = player_name
+            player = self.players.get(player_id)
+            if player is not None and player.name != player_name:
+                player.set_name(player_name)
+            if not is_full:
+                print("New player connected!")
+        self.names_version = version
+
+    def apply_snapshot(self, tick, base_tick, players_ids, players_masses, players_positions, removed_players_ids,
+                       received_at):
+        """
+        Apply a snapshot from the server in place. a delta only touches the players in it.
+        Other players don't move yet, they get a sample and move when the render clock gets there.
+        :return: False if it's a delta from a tick we never got, so it can't be applied.
+        """
+        if tick <= self.snapshot_tick:
+            return True  # old news
+        if base_tick > self.snapshot_tick:
             return False
-        player.mass = player_mass
-        player.position = player_position
+
+        if base_tick == 0:
+            # keyframe. whoever is not in it is not in the game
+            removed_players_ids = self.players.keys() - set(players_ids)
+        for player_id in removed_players_ids:
+            player = self.players.get(player_id)
+            if player is not None and player != self.client_player:
+                # if the dead player is the client player, skip because it's handled somewhere else.
+                self.remove_player(player)
+
+        for player_id, player_mass, player_position in zip(players_ids, players_masses, players_positions):
+            if self.client_player is not None and player_id == self.client_player.id:
+                # we move ourselves. the server's copy is up to a tick behind, don't jump back to it
+                continue
+            if player_id not in self.players:
+                # a snapshot over UDP may beat the names update over TCP. the name tag comes with the update
+                self.create_new_player(player_id, self.names.get(player_id, ""), player_mass, player_position)
+            self.add_sample(player_id, tick, player_mass, player_position)
+
+        self.snapshot_tick = tick
+        self.snapshot_time = received_at
         return True
 
     def remove_player(self, player):
         """KILL A PLAYER!!"""
         del self.players[player.id]
-        self.all_game_objects.remove(player)
+        self.samples.pop(player.id, None)
+        self.all_game_objects.pop(player, None)
+        self.grid.remove(player)
 
 
 class Camera:
     """A camera follows a specific player throughout the game."""
 
-    def __init__(self, screen, game, player, camera_initial_width, camera_initial_height):
+    def __init__(self, screen, game, player, camera_initial_width, camera_initial_height,
+                 use_dirty_rects=USE_DIRTY_RECTS):
         """INITIALIZER!!!!!!!!!!!!!!!!!!!!!!!!!!"""
         self.screen = screen
         self.game = game
@@ -221,12 +438,22 @@ class Camera:
         self.camera_initial_width = camera_initial_width
         self.camera_initial_height = camera_initial_height
 
-        self.renderable_game_objects = game.all_game_objects
-
         self.width, self.height = camera_initial_width, camera_initial_height
         self.rect = pygame.Rect(0, 0, camera_initial_width, camera_initial_height)
         self.update_rect_position()
 
+        self.circle_sprites = {}  # (color, radius on screen) -> pre-rendered anti-aliased circle
+        self.circle_sprites_zoom = self.zoom_bucket()
+
+        self.renderable_game_objects = []  # what's on screen this frame, smallest first
+        self.find_visible_game_objects()
+
+        self.use_dirty_rects = use_dirty_rects
+        self.drawn = {}  # game object -> its blits (surface, top left) of the last frame, in the order they were drawn
+        self.drawn_rects = {}  # game object -> the rect of the screen its blits of the last frame cover, if known
+        self.drawn_view = None  # (x, y, width, height) of the camera on the last frame. None: redraw everything
+        self.invalid_rects = []  # parts of the screen somebody else drew over since the last frame
+
     def update_rect_position(self):
         """Update camera's rect position"""
         x, y = self.player.position
@@ -270,15 +497,185 @@ class Camera:
         """Converts a mass to pixel size on the screen"""
         return (mass / self.height) * SCREEN_HEIGHT
 
+    def zoom_bucket(self):
+        """which zoom level the camera is in. the sizes on screen only change with it"""
+        return int(self.height // SPRITE_ZOOM_BUCKET)
+
+    def get_circle_sprite(self, color, radius):
+        """
+        An anti-aliased circle, already drawn. drawn once per color and radius, and blitted from then on.
+        The smooth edge is blended with the background color, and everything around it is a colorkey:
+        colorkey blits are a lot faster than per pixel alpha, even faster than pygame.draw.circle.
+        """
+        key = (color, radius)
+        sprite = self.circle_sprites.get(key)
+        if sprite is None:
+            if len(self.circle_sprites) >= SPRITE_CACHE_SIZE:
+                self.circle_sprites.clear()
+            center = radius + 1
+            sprite = pygame.Surface((center * 2 + 1, center * 2 + 1))
+            sprite.fill(SPRITE_COLORKEY)
+            pygame.draw.circle(sprite, BACKGROUND_COLOR, (center, center), radius + 1)
+            pygame.gfxdraw.filled_circle(sprite, center, center, radius, color)
+            pygame.gfxdraw.aacircle(sprite, center, center, radius, color)
+            if pygame.display.get_surface() is not None:
+                sprite = sprite.convert()
+            sprite.set_colorkey(SPRITE_COLORKEY, pygame.RLEACCEL)
+            self.circle_sprites[key] = sprite
+        return sprite
+
+    def circle_blits(self, color, position, mass):
+        """what to blit to draw a circle of some mass at a position in the game. nothing if it's too small to see"""
+        radius = round(self.mass_to_camera_size(mass_to_radius(mass)))
+        if radius < 1:
+            return []
+        x, y = self.coords_from_game_to_camera(position)
+        return [(self.get_circle_sprite(color, radius), (x - radius - 1, y - radius - 1))]
+
     def render(self):
-        """Renders the game on the screen. Very important"""
-        self.screen.fill(BACKGROUND_COLOR)
+        """
+        Renders the game on the screen. Very important
+        While the camera stands still (same place, same zoom), only the parts of the screen where something
+        appeared, moved, changed or went away are cleared and drawn again. Otherwise, all of it.
+        :return: the rects of the screen that changed, for pygame.display.update
+        """
+        zoom = self.zoom_bucket()
+        if zoom != self.circle_sprites_zoom:
+            # new zoom, new sizes. the old sprites won't be used again
+            self.circle_sprites.clear()
+            self.circle_sprites_zoom = zoom
+
+        drawn = {}  # game object -> its blits. the same order as drawing one by one (see Pallet.draw and Player.draw)
+        all_game_objects = self.game.all_game_objects
+        sprites = self.circle_sprites
+        rect_x, rect_y = self.rect.x, self.rect.y
+        scale_x, scale_y = SCREEN_WIDTH / self.width, SCREEN_HEIGHT / self.height
+        radiuses = {}  # mass -> radius on screen. every pallet has the same mass
+        for game_object in self.renderable_game_objects:
+            if game_object not in all_game_objects:  # eaten since we found it
+                continue
+            mass = game_object.mass
+            radius = radiuses.get(mass)
+            if radius is None:
+                radius = radiuses[mass] = round(self.mass_to_camera_size(mass_to_radius(mass)))
+            blits = []
+            if radius >= 1:
+                sprite = sprites.get((game_object.color, radius)) or self.get_circle_sprite(game_object.color, radius)
+                x, y = game_object.position
+                blits.append((sprite, ((x - rect_x) * scale_x - radius - 1, (y - rect_y) * scale_y - radius - 1)))
+            if type(game_object) == Player:
+                blits.extend((surface, rect.topleft) for surface, rect in game_object.name_blits(self))
+            if blits:
+                drawn[game_object] = blits
+
+        view = (rect_x, rect_y, self.width, self.height)
+        dirty_rects = None
+        rects = {}
+        if self.use_dirty_rects and self.game.pallet_store is None and view == self.drawn_view:
+            dirty_rects = self.find_dirty_rects(drawn, rects)
+        self.drawn, self.drawn_rects, self.drawn_view, self.invalid_rects = drawn, rects, view, []
+
+        if dirty_rects is None:
+            self.screen.fill(BACKGROUND_COLOR)
+            if self.game.pallet_store is not None:
+                self.draw_pallet_store()
+            self.screen.blits([blit for blits in drawn.values() for blit in blits], doreturn=False)
+            return [self.screen.get_rect()]
+
+        if dirty_rects:
+            objects_blits = list(drawn.values())
+            objects_rects = list(rects.values())
+            for dirty_rect in dirty_rects:
+                self.screen.set_clip(dirty_rect)  # whatever overlaps it is drawn whole, but only this part changes
+                self.screen.fill(BACKGROUND_COLOR, dirty_rect)
+                self.screen.blits([blit for index in dirty_rect.collidelistall(objects_rects)
+                                   for blit in objects_blits[index]], doreturn=False)
+            self.screen.set_clip(None)
+        return dirty_rects
+
+    def find_dirty_rects(self, drawn, rects):
+        """
+        The parts of the screen that have to be drawn again, from what was drawn on the last frame to what's drawn now.
+        Fills rects with the rect of every game object drawn now. whatever didn't change keeps the one it had.
+        :return: the rects, None if so much changed that it's cheaper to draw everything
+        """
+        dirty_rects = self.invalid_rects
+        previous, previous_rects = self.drawn, self.drawn_rects
+        for game_object, blits in drawn.items():
+            previous_blits = previous.pop(game_object, None)
+            if previous_blits == blits:
+                rect = previous_rects.get(game_object) or blits_rect(blits)
+            else:
+                rect = blits_rect(blits)
+                previous_rect = None if previous_blits is None else \
+                    previous_rects.get(game_object) or blits_rect(previous_blits)
+                if previous_rect is None:
+                    dirty_rects.append(rect)
+                elif previous_rect.colliderect(rect):
+                    dirty_rects.append(previous_rect.union(rect))  # moved a bit. one rect is cheaper to clear than two
+                else:
+                    dirty_rects.extend((previous_rect, rect))
+            rects[game_object] = rect
+        dirty_rects.extend(previous_rects.get(game_object) or blits_rect(blits)
+                           for game_object, blits in previous.items())  # what's not on screen anymore
+
+        screen_rect = self.screen.get_rect()
+        dirty_rects = [rect.inflate(2, 2).clip(screen_rect) for rect in dirty_rects]  # rounding of the blits
+        dirty_rects = [rect for rect in dirty_rects if rect]
+        dirty_area = sum(rect.width * rect.height for rect in dirty_rects)
+        if len(dirty_rects) > MAX_DIRTY_RECTS or dirty_area > screen_rect.width * screen_rect.height * MAX_DIRTY_AREA:
+            return None
+        return dirty_rects
+
+    def invalidate(self, rect=None):
+        """Something else drew over this part of the screen (all of it if None): draw it again on the next frame"""
+        if rect is None:
+            self.drawn_view = None
+        else:
+            self.invalid_rects.append(pygame.Rect(rect))
 
-        self.renderable_game_objects = []
-        for game_object in self.game.all_game_objects:
-            if self.is_game_object_in_camera_bounds(game_object):
-                game_object.draw(self)
-                self.renderable_game_objects.append(game_object)
+    def find_visible_game_objects(self):
+        """
+        Find what's on screen, by asking the grid for the cells under the camera (plus a pallet's reach around it).
+        Costs as much as what's on screen, not as the whole world. Call it once a frame, after the camera moved.
+        Players reach much further out of their cell than pallets, but there are few of them, so they're checked
+        one by one instead of making the grid look at a much bigger area.
+        Sorted by mass, so bigger things are drawn on top of smaller ones, and then by position, so things that overlap
+        are drawn in the same order on every frame (the grid doesn't keep one).
+        """
+        with lock:  # the receiving thread adds, moves and removes players in the grid
+            candidates = self.game.grid.query_rect(self.rect.x - PALLET_MASS, self.rect.y - PALLET_MASS,
+                                                   self.rect.x + self.width + PALLET_MASS,
+                                                   self.rect.y + self.height + PALLET_MASS)
+            players = list(self.game.players.values())
+
+        visible = [game_object for game_object in candidates
+                   if type(game_object) != Player and self.is_game_object_in_camera_bounds(game_object)]
+        visible.extend(player for player in players if self.is_game_object_in_camera_bounds(player))
+        visible.sort(key=lambda game_object: (game_object.mass, game_object.position))  # the same order every frame
+        self.renderable_game_objects = visible
+        return visible
+
+    def draw_pallet_store(self):
+        """Draw the pallets of the entity store. the ones in view and where they go are found in one vectorized pass"""
+        store = self.game.pallet_store
+        in_view = store.indices_in_camera_bounds(self)
+        screen_x = (store.x[in_view] - self.rect.x) / self.width * SCREEN_WIDTH
+        screen_y = (store.y[in_view] - self.rect.y) / self.height * SCREEN_HEIGHT
+        radiuses = entity_store.np.rint((entity_store.np.sqrt(store.mass[in_view] / math.pi) / self.height)
+                                        * SCREEN_HEIGHT).astype(int)
+
+        screen_x -= radiuses + 1  # where the top left corner of every sprite goes
+        screen_y -= radiuses + 1
+
+        to_blit = []
+        sprites = self.circle_sprites
+        for x, y, radius, color_index in zip(screen_x.tolist(), screen_y.tolist(), radiuses.tolist(),
+                                             store.color_index[in_view].tolist()):
+            if radius >= 1:
+                color = colors[color_index]
+                to_blit.append((sprites.get((color, radius)) or self.get_circle_sprite(color, radius), (x, y)))
+        self.screen.blits(to_blit, doreturn=False)
 
     def is_game_object_in_camera_bounds(self, game_object):
         """Checks if a game object is in camera bounds"""
@@ -294,6 +691,41 @@ class Camera:
         return x, y
 
 
+def blits_rect(blits):
+    """the rect of the screen a list of blits (surface, top left) covers"""
+    surface, position = blits[0]
+    rect = pygame.Rect(position, surface.get_size())
+    for surface, position in blits[1:]:
+        rect.union_ip(pygame.Rect(position, surface.get_size()))
+    return rect
+
+
+def interpolate_sample(samples, render_tick, latest_tick):
+    """
+    mass, position of a player at render_tick (can be between ticks), from its samples.
+    Between 2 samples it's on the line between them. Past its last sample it stays there, unless the last
+    sample is from the latest snapshot: then it keeps going the same way for at most MAX_EXTRAPOLATION_TICKS.
+    """
+    last_tick, last_mass, last_position = samples[-1]
+    if render_tick >= last_tick:
+        if last_tick < latest_tick or len(samples) < 2:
+            return last_mass, last_position  # it didn't change since, deltas would have said so
+        previous_tick, _, previous_position = samples[-2]
+        ticks_ahead = min(render_tick - last_tick, MAX_EXTRAPOLATION_TICKS) / (last_tick - previous_tick)
+        return last_mass, (last_position[0] + (last_position[0] - previous_position[0]) * ticks_ahead,
+                           last_position[1] + (last_position[1] - previous_position[1]) * ticks_ahead)
+
+    next_tick, next_mass, next_position = samples[-1]
+    for tick, mass, position in reversed(samples):
+        if tick <= render_tick:
+            progress = (render_tick - tick) / (next_tick - tick)
+            return (mass + (next_mass - mass) * progress,
+                    (position[0] + (next_position[0] - position[0]) * progress,
+                     position[1] + (next_position[1] - position[1]) * progress))
+        next_tick, next_mass, next_position = tick, mass, position
+    return next_mass, next_position  # older than everything we remember
+
+
 def get_distance(point1: (int, int), point2: (int, int)) -> float:
     """
     Calculates the distance between 2 points, by using pythagoras' theorem
@@ -322,11 +754,42 @@ def async_input_player_name():
     threading.Thread(target=__input_to_change_player_name).start()
 
 
+@lru_cache(maxsize=None)
+def get_font(size):
+    """the font in a size. loaded from disk once per size"""
+    return pygame.font.Font('freesansbold.ttf', size)
+
+
+text_surfaces = OrderedDict()  # (text, size, color) -> rendered surface. least recently used first
+text_surfaces_lock = threading.Lock()  # the main thread and the sync thread both create texts
+
+
+def render_text(text, size, color):
+    """
+    A rendered text surface, from the cache if we rendered the same text lately.
+    The surfaces are shared, only blit them.
+    """
+    key = (text, size, color)
+    with text_surfaces_lock:
+        text_surface = text_surfaces.get(key)
+        if text_surface is not None:
+            text_surfaces.move_to_end(key)
+            return text_surface
+
+    text_surface = get_font(size).render(text, False, color)
+    with text_surfaces_lock:
+        text_surfaces[key] = text_surface
+        if len(text_surfaces) > TEXT_SURFACE_CACHE_SIZE:
+            text_surfaces.popitem(last=False)
+    return text_surface
+
+
 def create_text(text, size, color, center=(0, 0), text_font=None):
     """creates a pygame text surface and a rect."""
     if text_font is None:
-        text_font = pygame.font.Font('freesansbold.ttf', int(size))
-    text_surface = text_font.render(text, False, color)
+        text_surface = render_text(text, int(size), color)
+    else:
+        text_surface = text_font.render(text, False, color)
     text_rect = text_surface.get_rect()
     text_rect.center = center
 
@@ -345,100 +808,90 @@ enter_username_surface, enter_username_rect = create_text("Enter username in con
                                                           (SCREEN_WIDTH // 2, SCREEN_HEIGHT // 10 * 3.5))
 
 client_player_name = -1
-async_input_player_name()
 
 lock = threading.Lock()
 
 
+def apply_push(game: Game, frame):
+    """The server pushed something. runs on the client's receiving thread"""
+    operation_number, _ = protocol.decrypt_header(frame)
+    if operation_number == Consts.Push.SNAPSHOT:
+        apply_snapshot(game, frame)
+    elif operation_number == Consts.Push.NAMES_UPDATE:
+        with lock:
+            game.apply_names_update(*protocol.decrypt_names_update(frame))
+    elif operation_number == Consts.Push.PALLETS:
+        game.pallets_updates.append(protocol.decrypt_pallets_update(frame))  # the main thread applies it
+
+
+def apply_snapshot(game: Game, snapshot):
+    """The server pushed the state of the world at the end of a tick. runs on the client's receiving thread"""
+    tick, base_tick, players_ids, players_masses, players_x, players_y, removed_players_ids = \
+        protocol.decrypt_snapshot(snapshot)
+
+    with lock:
+        is_applied = game.apply_snapshot(tick, base_tick, players_ids, players_masses, zip(players_x, players_y),
+                                         removed_players_ids, time.perf_counter())
+
+    if is_applied:
+        client.send_unreliable(protocol.build_ack_request(tick))
+    else:
+        client.send_request(protocol.build_request(Consts.Update.REQUEST_KEYFRAME))
+
+
 def sync_game_data_with_server(game: Game):
-    """sync game data with the server. ALL THE MAGIC HAPPENS HERE"""
+    """
+    sync game data with the server. ALL THE MAGIC HAPPENS HERE
+    One SYNC round trip a tick carries everything. with UDP working the position goes there instead, and a SYNC
+    only every UDP_SYNC_EVERY ticks (or when we ate). the lock is held to read and change the game, never while
+    waiting for the server, so the snapshots and the game loop don't wait for the network.
+    """
     global lock, client, have_eaten, is_alive, client_player
 
     clock = pygame.time.Clock()
+    sent_viewport = None
+    syncs_skipped = 0
     while True:
         with lock:
+            viewport = game.viewport
+            position = mass = None
+            eaten_ids, eaten_pallets_keys = [], []
             if is_alive:
+                position, mass = client_player.position, client_player.mass
+                if have_eaten:
+                    eaten_ids, client_player.players_eaten_id = client_player.players_eaten_id, []
+                    eaten_pallets_keys, client_player.pallets_eaten_keys = client_player.pallets_eaten_keys, []
+                    have_eaten = False
+
+        if viewport != sent_viewport:
+            sent_viewport = viewport
+            client.send_request(protocol.build_viewport_request(*sent_viewport))
+
+        if position is not None:
+            if client.is_udp_working:
+                # the position goes over UDP, where a lost one doesn't hold up the ones after it.
+                # a SYNC only carries the eats, and tells us if we are still alive
+                client.send_unreliable(protocol.build_position_and_mass_request(*position, mass))
+                syncs_skipped += 1
+                sync_request = None
+                if eaten_ids or eaten_pallets_keys or syncs_skipped >= UDP_SYNC_EVERY:
+                    sync_request = protocol.build_sync_request(None, None, eaten_ids, eaten_pallets_keys)
+                    syncs_skipped = 0
+            else:
+                sync_request = protocol.build_sync_request(position, mass, eaten_ids, eaten_pallets_keys)
+
+            if sync_request is not None:
+                client.send_request(sync_request)
                 try:
-                    if have_eaten:
-                        client.send_request(
-                            protocol.build_request(
-                                protocol.Consts.Update.EAT,
-                                protocol.VALUE_SEPERATOR.join(client_player.players_eaten_id)
-                            )
-                        )
-
-                        confirmation = client.get_response()
-
-                        have_eaten = False
-                        client_player.players_eaten_id = []
-
-                    # send player updated position
-                    new_x, new_y = client_player.position
-                    new_mass = client_player.mass
-                    client.send_request(
-                        protocol.build_request(
-                            protocol.Consts.Update.MY_POSITION_AND_MASS,
-                            f"{new_x}{protocol.VALUE_SEPERATOR}{new_y}",
-                            new_mass
-                        )
-                    )
-
-                    response = protocol.decrypt_response(client.get_response())
-                    flag = int(response[0])
-                    if flag == Consts.Error.YOURE_DEAD:
-                        is_alive = False
+                    is_still_alive = protocol.decrypt_sync_response(client.get_response())
                 except TypeError:
-                    is_alive = False
-            # update players_ids, players_masses, players_positions,
-            client.send_request(
-                protocol.build_request(
-                    protocol.Consts.Request.INFO
-                )
-            )
+                    is_still_alive = False
 
-            info_response = client.get_response()
-            players_ids, players_masses, players_x, players_y = protocol.decrypt_info_response(info_response)
+                if not is_still_alive:
+                    with lock:
+                        is_alive = False
 
-            if len(players_ids) != len(game.players):
-                # someone died.
-                try:
-                    for player in game.players.values():
-                        if player == game.client_player:
-                            # if the dead player is the client player
-                            # if so then skip because it's handled somewhere else.
-                            continue
-                        if player.id not in players_ids:
-                            game.remove_player(player)
-                except RuntimeError:  # dictionary changed size during iteration, this is ok!! I promise
-                    pass
-
-            new_players = []
-            for player_id, player_mass, player_x, player_y in zip(players_ids, players_masses, players_x, players_y):
-                is_already_in_game = game.update_player_info(player_id, player_mass, (player_x, player_y))
-                if not is_already_in_game:
-                    new_players.append(str(player_id))
-
-            # register new players
-            if new_players:
-                client.send_request(
-                    protocol.build_request(
-                        protocol.Consts.Request.NAMES,
-                        protocol.VALUE_SEPERATOR.join(new_players)
-                    )
-                )
-
-                response = client.get_response()
-                player_names = protocol.decrypt_response(response)
-                for player_id, player_name in zip(new_players, player_names):
-                    player = game.players[int(player_id)]
-                    player.name = player_name
-                    player.name_surface, player.name_surface_rect = create_text(player.name, FONT_SIZE, WHITE)
-                    player.name_surface_outline, player.name_surface_outline_rect = create_text(player.name,
-                                                                                                FONT_SIZE + 1,
-                                                                                                BLACK)
-                    print("New player connected!")
-
-            clock.tick(SERVER_UPDATE_POSITION_FPS)
+        clock.tick(SERVER_UPDATE_POSITION_FPS)
 
 
 def start_syncing_game_with_server(game):
@@ -447,7 +900,7 @@ def start_syncing_game_with_server(game):
     t.start()
 
 
-client = Client(protocol.SERVER_IP)
+client = None  # connected in main
 have_eaten = False
 is_alive = False
 none_player = Player(None, None, None, None)
@@ -468,21 +921,36 @@ def main():
     """MAIN FUNCTION! WHICH MEANS I'M DONE WRITING COMMENTS AND FINALLY TURN IN THIS PROJECT"""
     global client, have_eaten, is_alive, client_player
 
+    async_input_player_name()
+
     """Connect to server and receive starting data"""
+    client = Client(protocol.SERVER_IP)
 
     # request welcome info
     welcome_info_request = protocol.build_request(Consts.Request.WELCOME_INFO)
     client.send_request(welcome_info_request)
     response = client.get_response()
-    GAME_WIDTH, GAME_HEIGHT, players_ids, players_names, players_masses = protocol.decrypt_welcome_info_response(
-        response)
+    GAME_WIDTH, GAME_HEIGHT, TICK_RATE, players_ids, players_names, players_masses = \
+        protocol.decrypt_welcome_info_response(response)
 
     """initiate game"""
 
     players = {player_id: Player(player_id, player_name, player_mass, (-100, -100))
                for player_id, player_name, player_mass in zip(players_ids, players_names, players_masses)}
 
-    game = Game(GAME_WIDTH, GAME_HEIGHT, players)
+    game = Game(GAME_WIDTH, GAME_HEIGHT, players, use_entity_store=USE_ENTITY_STORE and entity_store.is_available(),
+                tick_rate=TICK_RATE)
+    game.names = dict(zip(players_ids, players_names))
+
+    # from now on the server pushes us a snapshot every tick, and the names of whoever joins
+    client.start_receiving(lambda frame: apply_push(game, frame))
+    client.send_request(protocol.build_request(Consts.Request.SUBSCRIBE))
+    confirmation = client.get_response()
+    if USE_UDP:
+        client.send_request(protocol.build_request(Consts.Request.OPEN_UDP))
+        udp_token = protocol.decrypt_open_udp_response(client.get_response())
+        if udp_token:
+            client.open_udp(udp_token, lambda frame: apply_push(game, frame))
 
     start_syncing_game_with_server(game)
 
@@ -495,7 +963,11 @@ def main():
 
     is_pressed = {'UP': False, 'RIGHT': False, 'DOWN': False, 'LEFT': False}
 
-    random_player = game.get_random_player()
+    with lock:  # the receiving thread adds and removes players
+        random_player = game.get_random_player()
+    if random_player is None:
+        # nobody to watch. look at the middle of the map
+        random_player = Player(None, "", PALLET_MASS, (GAME_WIDTH / 2, GAME_HEIGHT / 2))
 
     camera = Camera(screen, game, random_player, CAMERA_INITIAL_WIDTH, CAMERA_INITIAL_HEIGHT)
 
@@ -506,29 +978,33 @@ def main():
         if not is_alive and client_player_name != -1 and client_requests_to_join:
             is_alive = True
             client.send_request(
-                protocol.build_request(
-                    protocol.Consts.Request.SPAWN_NEW_PLAYER,
-                    client_player_name
-                )
+                protocol.build_spawn_new_player_request(client_player_name)
             )
             response = client.get_response()
             client_player_id, start_mass, start_x, start_y = protocol.decrypt_spawn_a_new_player_response(response)
-            client_player = game.create_new_player(client_player_id, client_player_name, start_mass, (start_x, start_y))
+            client_player_start_mass = start_mass
+            with lock:  # the receiving thread changes the players and the grid under it
+                client_player = game.create_new_player(client_player_id, client_player_name, start_mass,
+                                                       (start_x, start_y))
             game.client_player = client_player
             camera = Camera(screen, game, client_player, CAMERA_INITIAL_WIDTH, CAMERA_INITIAL_HEIGHT)
             client_requests_to_join = False
 
         for event in pygame.event.get():
+            if event.type == pygame.WINDOWEXPOSED:
+                camera.invalidate()  # the window was covered. whatever was there has to go to the display again
+
             if event.type == pygame.QUIT:
+                # not under the lock: the receiving thread needs it for the pushes that come before the answer
+                send_server_quit_request()
                 with lock:
-                    send_server_quit_request()
                     if is_alive:
                         game.remove_player(client_player)
                         client_player = none_player
                         is_alive = False
 
-                    pygame.quit()
-                    os._exit(1)
+                pygame.quit()
+                os._exit(1)
 
             if event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_SPACE:
@@ -566,35 +1042,43 @@ def main():
             if is_pressed['LEFT']:
                 new_pos = new_pos[0] - 1, new_pos[1]
 
-            if game.x_in_bounds(new_pos[0]):
-                client_player.position = new_pos[0], client_player.position[1]
+            with lock:
+                if game.x_in_bounds(new_pos[0]):
+                    game.move_player(client_player, (new_pos[0], client_player.position[1]))
 
-            if game.y_in_bounds(new_pos[1]):
-                client_player.position = client_player.position[0], new_pos[1]
+                if game.y_in_bounds(new_pos[1]):
+                    game.move_player(client_player, (client_player.position[0], new_pos[1]))
+
+            client_player.lose_mass(client_player_start_mass, 1 / FPS)
 
         else:
             if camera.player == client_player:
                 # JUST DIED. LMAO
-                game.remove_player(client_player)
+                with lock:
+                    game.remove_player(client_player)
+                    camera.player = game.get_random_player() or camera.player  # nobody else: stay where we died
                 client_player = none_player
-                camera.player = game.get_random_player()
+                camera.invalidate()  # the start screen goes on top of it
 
-        # spawn more pallets
-        if random.randint(0, FPS // PALLET_SPAWN_PER_SECOND) == 0:
-            game.spawn_new_pallet_in_camera_scope(camera)
+        game.apply_pallets_updates()
+        with lock:
+            game.advance_render_clock(time.perf_counter())
+            game.interpolate_players()
 
         camera.update_size()
-        _have_eaten = game.check_for_collisions_and_eat(camera.renderable_game_objects)
+        camera.update_rect_position()
+        camera.find_visible_game_objects()
+        _have_eaten = game.check_for_collisions_and_eat(camera)
         if _have_eaten:
             have_eaten = True
-        camera.update_rect_position()
+        game.viewport = (camera.rect.x, camera.rect.y, int(camera.width), int(camera.height))
 
         # Render.
-        camera.render()
+        dirty_rects = camera.render()
         if not is_alive:
-            draw_start_screen(screen)
+            draw_start_screen(screen)  # over whatever changed under it. the rest of it is still on the screen
 
-        pygame.display.update()
+        pygame.display.update(dirty_rects)
         clock.tick(FPS)
 
 
@@ -1,4 +1,8 @@
-import socket, protocol
+import queue
+import socket
+import threading
+
+import protocol
 
 
 class Client:
@@ -7,17 +11,113 @@ class Client:
         """Initializer"""
         self.socket = socket.socket()
         self.socket.connect((server_host, protocol.PORT))
+        # the receiving thread's acknowledgements go right before our SYNCs. Nagle would hold the SYNC back
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.frame_reader = protocol.FrameReader(self.socket)
+        self.responses = None  # set once a thread receives everything for us, see start_receiving
+        self.send_lock = threading.Lock()  # the receiving thread sends too (acknowledgements)
+
+        self.udp_socket = None  # see open_udp
+        self.udp_token = None
+        self.udp_sent_sequence = 0
+        self.udp_lock = threading.Lock()
+        self.is_udp_working = False  # a datagram from the server got to us, so they get through both ways
         print('connected')
 
-    def send_request(self, request: str) -> None:
-        """sends from str to bytes to server"""
-        self.socket.send(request.encode())
+    def send_request(self, request: bytes) -> None:
+        """sends a whole frame to server"""
+        with self.send_lock:
+            self.socket.sendall(request)
+
+    def send_unreliable(self, frame: bytes) -> None:
+        """
+        sends a frame that's fine to lose, because a newer one is coming (see protocol.DATAGRAM_OPERATIONS).
+        over UDP once it works. until then over TCP, and a copy over UDP, so the server learns where we are
+        """
+        if self.udp_socket is not None:
+            with self.udp_lock:
+                self.udp_sent_sequence += 1
+                datagram = protocol.build_datagram(self.udp_token, self.udp_sent_sequence, frame)
+            try:
+                self.udp_socket.send(datagram)
+            except OSError:
+                pass  # it's UDP, it could have been lost anyway
+            if self.is_udp_working:
+                return
+        self.send_request(frame)
+
+    def get_response(self) -> bytes:
+        """
+        receives a whole frame from server.
+        before start_receiving it's a view of the receive buffer, good until the next get_response
+        """
+        if self.responses is not None:
+            response = self.responses.get()
+            if not response:
+                self.responses.put(response)  # the connection is gone. whoever waits next is told too
+            return response
+        return self.frame_reader.receive_frame()
+
+    def start_receiving(self, on_push) -> None:
+        """
+        From now on a thread receives everything the server sends.
+        Pushed frames are passed to on_push(frame) on that thread, responses wait for get_response.
+        a pushed frame is a view of the receive buffer: on_push copies (bytes(frame)) what it keeps after it returns.
+        """
+        self.responses = queue.Queue()
+        threading.Thread(target=self.receive_thread, args=[on_push], daemon=True).start()
+
+    def receive_thread(self, on_push) -> None:
+        """sort every frame from the server into pushes and responses"""
+        while True:
+            try:
+                frame = self.frame_reader.receive_frame()
+            except OSError:
+                frame = b""
+            if not frame:
+                self.responses.put(b"")  # whoever waits for a response should not wait forever
+                return
+
+            operation_number, _ = protocol.decrypt_header(frame)
+            if operation_number in protocol.PUSH_OPERATIONS:
+                on_push(frame)
+            else:
+                self.responses.put(bytes(frame))  # the next frame is received into the same buffer
+
+    def open_udp(self, token: int, on_push) -> None:
+        """
+        Open the UDP channel the server gave us a token for (see protocol OPEN_UDP).
+        Pushed frames that come over it are passed to on_push(frame) on a thread of its own, older ones are dropped.
+        """
+        self.udp_token = token
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.connect(self.socket.getpeername())
+        threading.Thread(target=self.receive_datagrams_thread, args=[on_push], daemon=True).start()
+
+    def receive_datagrams_thread(self, on_push) -> None:
+        """pass every new pushed frame that comes over UDP to on_push"""
+        buffer = bytearray(protocol.MAX_DATAGRAM_SIZE)
+        view = memoryview(buffer)
+        received_sequence = 0
+        while True:
+            try:
+                size = self.udp_socket.recv_into(buffer)
+            except ConnectionError:
+                continue  # the server wasn't listening for a moment. it's UDP, keep going
+            except OSError:
+                return  # closed
 
-    def get_response(self, num_of_bytes: int = 1024) -> str:
-        """receives bytes from server"""
-        content = self.socket.recv(num_of_bytes).decode()
-        return content
+            token, sequence, frame = protocol.split_datagram(view[:size])
+            if token != self.udp_token or sequence <= received_sequence:
+                continue  # broken, or older than what we already have
+            received_sequence = sequence
+            self.is_udp_working = True
+            operation_number, _ = protocol.decrypt_header(frame)
+            if operation_number in protocol.PUSH_OPERATIONS:
+                on_push(frame)
 
     def close(self) -> None:
         """closes the client socket"""
         self.socket.close()
+        if self.udp_socket is not None:
+            self.udp_socket.close()
@@ -0,0 +1,103 @@
+"""
+An optional struct-of-arrays store for pallets: positions, masses and colors live in contiguous NumPy arrays
+instead of one Python object per pallet, so the camera and eat checks run as single vectorized passes.
+Needs numpy. without it, the client keeps using Pallet objects.
+"""
+from colors import colors
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+INITIAL_CAPACITY = 1024
+NO_KEY = (1 << 64) - 1  # the key of a pallet the server doesn't know about
+COLOR_INDICES = {color: index for index, color in enumerate(colors)}
+
+
+def is_available():
+    """is numpy installed"""
+    return np is not None
+
+
+class EntityStore:
+    """Pallets as arrays. index i of every array is the same pallet, only the first `count` are alive"""
+
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        """initializer"""
+        self.count = 0
+        self.x = np.empty(capacity, dtype=np.float64)
+        self.y = np.empty(capacity, dtype=np.float64)
+        self.mass = np.empty(capacity, dtype=np.float64)
+        self.color_index = np.empty(capacity, dtype=np.uint8)
+        self.key = np.empty(capacity, dtype=np.uint64)  # protocol.pallet_key, to tell the server we ate it
+
+    def __len__(self):
+        """how many pallets are in the store"""
+        return self.count
+
+    def _grow(self):
+        """double the capacity of every array"""
+        capacity = len(self.x) * 2
+        for name in ("x", "y", "mass", "color_index", "key"):
+            old_array = getattr(self, name)
+            new_array = np.empty(capacity, dtype=old_array.dtype)
+            new_array[:self.count] = old_array[:self.count]
+            setattr(self, name, new_array)
+
+    def add(self, position, mass, color, key=None):
+        """Add a pallet. returns its index (until something is removed)"""
+        if self.count == len(self.x):
+            self._grow()
+        index = self.count
+        self.x[index], self.y[index] = position
+        self.mass[index] = mass
+        self.color_index[index] = COLOR_INDICES[color]
+        self.key[index] = NO_KEY if key is None else key
+        self.count += 1
+        return index
+
+    def swap_remove(self, indices):
+        """
+        Remove pallets by moving the last alive pallet into every hole. O(len(indices)), nothing else moves.
+        Going from the highest index down, the last pallet is never one that is about to be removed.
+        """
+        for index in sorted(set(indices), reverse=True):
+            last = self.count - 1
+            if index != last:
+                self.x[index] = self.x[last]
+                self.y[index] = self.y[last]
+                self.mass[index] = self.mass[last]
+                self.color_index[index] = self.color_index[last]
+                self.key[index] = self.key[last]
+            self.count -= 1
+
+    def indices_of_keys(self, keys):
+        """indices of the pallets with these keys. the ones that are not in the store (eaten already) are skipped"""
+        if not keys:
+            return []
+        return np.flatnonzero(np.isin(self.key[:self.count], np.array(keys, dtype=np.uint64))).tolist()
+
+    def indices_in_camera_bounds(self, camera):
+        """
+        Indices of every pallet Camera.is_game_object_in_camera_bounds would accept, in one vectorized pass.
+        Same formula, same order of operations, so the result is exactly the same.
+        """
+        x = self.x[:self.count]
+        y = self.y[:self.count]
+        radius = self.mass[:self.count]
+        rect_x, rect_y = camera.rect.x, camera.rect.y
+        in_bounds = ((rect_x - radius <= x) & (x <= rect_x + camera.width + radius) &
+                     (rect_y - radius <= y) & (y <= rect_y + camera.height + radius))
+        return np.flatnonzero(in_bounds)
+
+    def indices_eaten_by(self, candidates, position, mass, radius):
+        """
+        Which of the candidate indices a player at position, with mass and radius, eats.
+        The same mass-ratio and distance checks as Game.check_for_collisions_and_eat, vectorized.
+        """
+        player_x, player_y = position
+        dx = player_x - self.x[candidates]
+        dy = player_y - self.y[candidates]
+        is_eaten = (mass >= self.mass[candidates] * 1.25) & (np.sqrt(dx ** 2 + dy ** 2) < radius)
+        return candidates[is_eaten]
@@ -0,0 +1,362 @@
+"""
+Load test for the server: many headless players over real sockets, no pygame.
+Every bot joins, subscribes to the tick stream (and acknowledges it like the client does), spawns, then syncs at the
+client's rate: moves around randomly, sometimes eats someone it sees, sometimes quits and comes back.
+Reports request latency percentiles per operation, throughput, deaths, errors and the server's CPU.
+
+python3 load_test.py --clients 500 --duration 30 --start-server
+python3 load_test.py --clients 2000 --start-server --server-args="--asyncio"
+python3 load_test.py --clients 2000 --start-server --server-script sharded_server.py --server-args="--shards 4"
+python3 load_test.py --clients 200 --server-pid 1234   (a server that's already running)
+python3 load_test.py --clients 500 --udp --start-server --server-args="--udp"   positions and snapshots over UDP
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+import protocol
+from protocol import Consts
+from client_client import Client
+
+SYNC_RATE = 10  # like the client's SERVER_UPDATE_POSITION_FPS
+STEP_SIZE = 6  # how far a bot moves every sync, in game units. about a frame's worth of key presses each
+START_MASS = 100
+SERVER_START_SECONDS = 1
+
+
+def connect(host):
+    """A Client, without it printing 'connected' a thousand times"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        return Client(host)
+
+
+class Bot:
+    """One simulated player, on its own thread"""
+
+    def __init__(self, host, name, rng, arguments):
+        """initializer"""
+        self.host = host
+        self.name = name
+        self.rng = rng
+        self.arguments = arguments
+        self.client = None
+
+        self.latencies = {}  # operation name -> seconds of every request
+        self.counters = {"snapshots": 0, "names_updates": 0, "pallets_updates": 0, "udp_snapshots": 0,
+                         "push_bytes": 0, "deaths": 0, "quits": 0, "eats": 0}
+        self.errors = {}  # exception name -> count
+
+        self.width = self.height = 0
+        self.position = (0, 0)
+        self.player_id = None
+        self.seen_ids = set()  # players the snapshots showed us, to eat some of them
+        self.seen_ids_lock = threading.Lock()
+
+    def request(self, frame):
+        """send a request and wait for its response, timing it"""
+        operation_number, _ = protocol.decrypt_header(frame)
+        start = time.perf_counter()
+        self.client.send_request(frame)
+        response = self.client.get_response()
+        self.latencies.setdefault(protocol.OPERATION_NAMES[operation_number], []).append(time.perf_counter() - start)
+        if not response:
+            raise ConnectionError("server closed the connection")
+        return response
+
+    def on_push(self, frame, is_over_udp=False):
+        """a receiving thread got a push. count it, and acknowledge snapshots like the client does"""
+        operation_number, _ = protocol.decrypt_header(frame)
+        if is_over_udp:
+            self.counters["udp_snapshots"] += 1
+        self.counters["push_bytes"] += len(frame)
+        if operation_number == Consts.Push.NAMES_UPDATE:
+            self.counters["names_updates"] += 1
+            return
+        if operation_number == Consts.Push.PALLETS:
+            self.counters["pallets_updates"] += 1
+            return
+
+        self.counters["snapshots"] += 1
+        tick, base_tick, players_ids, _, _, _, removed_players_ids = protocol.decrypt_snapshot(frame)
+        with self.seen_ids_lock:
+            if base_tick == 0:
+                self.seen_ids = set(players_ids)
+            else:
+                self.seen_ids.update(players_ids)
+                self.seen_ids.difference_update(removed_players_ids)
+        try:
+            self.client.send_unreliable(protocol.build_ack_request(tick))
+        except OSError:
+            pass
+
+    def join(self):
+        """connect, get the welcome info, subscribe and spawn"""
+        self.client = connect(self.host)
+        response = self.request(protocol.build_request(Consts.Request.WELCOME_INFO))
+        self.width, self.height, *_ = protocol.decrypt_welcome_info_response(response)
+        self.client.start_receiving(self.on_push)
+        self.request(protocol.build_request(Consts.Request.SUBSCRIBE))
+        if self.arguments.udp:
+            response = self.request(protocol.build_request(Consts.Request.OPEN_UDP))
+            udp_token = protocol.decrypt_open_udp_response(response)
+            if udp_token:
+                self.client.open_udp(udp_token, lambda frame: self.on_push(frame, is_over_udp=True))
+        self.spawn()
+
+    def spawn(self):
+        """get a new player"""
+        response = self.request(protocol.build_spawn_new_player_request(self.name))
+        self.player_id, _, x, y = protocol.decrypt_spawn_a_new_player_response(response)
+        self.position = (x, y)
+
+    def quit(self):
+        """say goodbye and hang up"""
+        self.request(protocol.build_request(Consts.Update.QUIT))
+        self.client.close()
+        self.client = None
+
+    def sync(self):
+        """one sync tick: move, maybe eat someone, maybe quit"""
+        x, y = self.position
+        x = min(max(1, x + self.rng.randint(-STEP_SIZE, STEP_SIZE)), self.width - 1)
+        y = min(max(1, y + self.rng.randint(-STEP_SIZE, STEP_SIZE)), self.height - 1)
+        self.position = (x, y)
+
+        eaten_ids = []
+        if self.rng.random() < self.arguments.eat_chance / SYNC_RATE:
+            with self.seen_ids_lock:
+                candidates = [player_id for player_id in self.seen_ids if player_id != self.player_id]
+            if candidates:
+                eaten_ids.append(self.rng.choice(candidates))
+                self.counters["eats"] += 1
+
+        if self.client.is_udp_working:
+            # like the client: the position over UDP, the eats (and are we alive) still a SYNC on TCP
+            self.client.send_unreliable(protocol.build_position_and_mass_request(*self.position, START_MASS))
+            response = self.request(protocol.build_sync_request(None, None, eaten_ids))
+        else:
+            response = self.request(protocol.build_sync_request(self.position, START_MASS, eaten_ids))
+        if not protocol.decrypt_sync_response(response):
+            self.counters["deaths"] += 1  # YOURE_DEAD. somebody ate us
+            self.spawn()
+
+        if self.rng.random() < self.arguments.quit_chance / SYNC_RATE:
+            self.counters["quits"] += 1
+            self.quit()
+            self.join()
+
+    def run(self, stop_time):
+        """play until stop_time"""
+        next_sync_time = time.perf_counter()
+        while time.perf_counter() < stop_time:
+            try:
+                if self.client is None:
+                    self.join()
+                self.sync()
+            except (OSError, ConnectionError, TypeError, ValueError) as error:
+                # TypeError / ValueError: a broken or missing response
+                name = type(error).__name__
+                self.errors[name] = self.errors.get(name, 0) + 1
+                if self.client is not None:
+                    self.client.close()
+                    self.client = None
+                time.sleep(1 / SYNC_RATE)
+
+            next_sync_time += 1 / SYNC_RATE
+            delay = next_sync_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_sync_time = time.perf_counter()  # the server is too slow for us. don't burst
+
+        if self.client is not None:
+            try:
+                self.quit()
+            except (OSError, ConnectionError, TypeError, ValueError):
+                self.client.close()
+
+
+def process_cpu_seconds(pid):
+    """
+    user + system CPU time a process and its children (like the shards of sharded_server.py) used so far,
+    from /proc. None if we can't read it
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as stat_file:
+            fields = stat_file.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    user_ticks, system_ticks = int(fields[11]), int(fields[12])
+    cpu_seconds = (user_ticks + system_ticks) / os.sysconf("SC_CLK_TCK")
+
+    for child_pid in child_pids(pid):
+        cpu_seconds += process_cpu_seconds(child_pid) or 0
+    return cpu_seconds
+
+
+def child_pids(pid):
+    """the processes a process started, from /proc"""
+    pids = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as children_file:
+                pids.extend(int(child_pid) for child_pid in children_file.read().split())
+    except OSError:
+        pass
+    return pids
+
+
+def percentile(sorted_values, fraction):
+    """the value below which this fraction of the (sorted) values are"""
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def summarize(bots, duration, server_cpu_seconds):
+    """put every bot's numbers together"""
+    latencies, counters, errors = {}, {}, {}
+    for bot in bots:
+        for operation_name, values in bot.latencies.items():
+            if not values:
+                continue  # only sent before the measuring started (joins, when nobody rejoined)
+            latencies.setdefault(operation_name, []).extend(values)
+        for name, count in bot.counters.items():
+            counters[name] = counters.get(name, 0) + count
+        for name, count in bot.errors.items():
+            errors[name] = errors.get(name, 0) + count
+
+    operations = {}
+    for operation_name, values in sorted(latencies.items()):
+        values.sort()
+        operations[operation_name] = {
+            "count": len(values),
+            "per_second": len(values) / duration,
+            "p50_ms": percentile(values, 0.5) * 1000,
+            "p90_ms": percentile(values, 0.9) * 1000,
+            "p99_ms": percentile(values, 0.99) * 1000,
+            "max_ms": values[-1] * 1000,
+        }
+
+    return {
+        "clients": len(bots),
+        "duration_seconds": duration,
+        "requests_per_second": sum(len(values) for values in latencies.values()) / duration,
+        "operations": operations,
+        "snapshots_per_second": counters.get("snapshots", 0) / duration,
+        "push_bytes_per_second": counters.get("push_bytes", 0) / duration,
+        "counters": counters,
+        "errors": errors,
+        "server_cpu_percent": None if server_cpu_seconds is None else server_cpu_seconds / duration * 100,
+    }
+
+
+def print_report(results):
+    """print the results as tables"""
+    print(f"{results['clients']} clients for {results['duration_seconds']:.1f} s, "
+          f"{results['requests_per_second']:.0f} requests/s")
+    print(f"{'operation':<18}{'count':>9}{'per s':>9}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for operation_name, numbers in results["operations"].items():
+        print(f"{operation_name:<18}{numbers['count']:>9}{numbers['per_second']:>9.1f}{numbers['p50_ms']:>9.2f}"
+              f"{numbers['p90_ms']:>9.2f}{numbers['p99_ms']:>9.2f}{numbers['max_ms']:>9.2f}")
+
+    counters = results["counters"]
+    print(f"pushed: {results['snapshots_per_second']:.0f} snapshots/s, "
+          f"{results['push_bytes_per_second'] / 1024:.1f} KiB/s, {counters.get('names_updates', 0)} names updates, "
+          f"{counters.get('pallets_updates', 0)} pallets updates, "
+          f"{counters.get('udp_snapshots', 0)} snapshots over UDP")
+    print(f"YOURE_DEAD: {counters.get('deaths', 0)}, eats: {counters.get('eats', 0)}, "
+          f"quits: {counters.get('quits', 0)}")
+    print(f"errors: {results['errors'] or 'none'}")
+    if results["server_cpu_percent"] is not None:
+        print(f"server CPU: {results['server_cpu_percent']:.1f}% of one core")
+
+
+def parse_arguments():
+    """command line arguments"""
+    parser = argparse.ArgumentParser(description="load test for the agar.io clone server")
+    parser.add_argument("--host", default=protocol.SERVER_IP)
+    parser.add_argument("--clients", type=int, default=100, help="how many bots play at the same time")
+    parser.add_argument("--duration", type=float, default=20, help="seconds to play, after everyone joined")
+    parser.add_argument("--ramp", type=float, default=5, help="seconds to connect all the bots over")
+    parser.add_argument("--eat-chance", type=float, default=0.05,
+                        help="how many times a second a bot eats someone it sees, on average")
+    parser.add_argument("--quit-chance", type=float, default=0.01,
+                        help="how many times a second a bot quits and joins again, on average")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--udp", action="store_true",
+                        help="bots ask for UDP (OPEN_UDP), for positions and snapshots. the server needs --udp too")
+    parser.add_argument("--server-pid", type=int, help="measure the CPU of this (already running) server")
+    parser.add_argument("--start-server", action="store_true", help="start server.py for the test, and stop it after")
+    parser.add_argument("--server-args", default="", help="arguments for the server --start-server starts")
+    parser.add_argument("--server-script", default="server.py",
+                        help="the server --start-server starts, like sharded_server.py")
+    parser.add_argument("--json", help="also write the results to this file")
+    return parser.parse_args()
+
+
+def main():
+    """Run the load test and print a report"""
+    arguments = parse_arguments()
+
+    server_process = None
+    server_pid = arguments.server_pid
+    if arguments.start_server:
+        server_command = [sys.executable, arguments.server_script, *shlex.split(arguments.server_args)]
+        server_process = subprocess.Popen(server_command, cwd=os.path.dirname(os.path.abspath(__file__)),
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        server_pid = server_process.pid
+        time.sleep(SERVER_START_SECONDS)
+
+    try:
+        rng = random.Random(arguments.seed)
+        bots = [Bot(arguments.host, f"bot{''.join(rng.choices('abcdefghij', k=6))}",
+                    random.Random(rng.random()), arguments) for _ in range(arguments.clients)]
+
+        # everyone plays until the same moment, the last ones to join play for the whole duration
+        stop_time = time.perf_counter() + arguments.ramp + arguments.duration
+        threads = []
+        for bot in bots:
+            thread = threading.Thread(target=bot.run, args=[stop_time], daemon=True)
+            thread.start()
+            threads.append(thread)
+            time.sleep(arguments.ramp / max(1, arguments.clients))
+
+        # only measure once everybody is in
+        cpu_at_start = process_cpu_seconds(server_pid) if server_pid else None
+        measure_start = time.perf_counter()
+        for bot in bots:
+            for values in bot.latencies.values():
+                values.clear()
+            bot.counters = dict.fromkeys(bot.counters, 0)
+            bot.errors = {}
+
+        for thread in threads:
+            thread.join()
+        duration = time.perf_counter() - measure_start
+        cpu_at_end = process_cpu_seconds(server_pid) if server_pid else None
+    finally:
+        if server_process is not None:
+            server_process.terminate()
+            server_process.wait()
+
+    server_cpu_seconds = None
+    if cpu_at_start is not None and cpu_at_end is not None:
+        server_cpu_seconds = cpu_at_end - cpu_at_start
+
+    results = summarize(bots, duration, server_cpu_seconds)
+    print_report(results)
+    if arguments.json:
+        with open(arguments.json, "w") as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""
+The pallets (food) of the whole map. the server owns them, so every client sees the same ones.
+The map is cut into square chunks (protocol.PALLET_CHUNK_SIZE), and every chunk has the same number of slots.
+A slot is a pallet, or for a while after it was eaten, nothing. So there are never more pallets than the map's
+area allows, and a chunk only exists once somebody looked at it.
+Where a pallet appears depends only on the seed, its chunk, its slot and how many times the slot respawned,
+so fields with the same seed (like the shards of sharded_server.py) put the same pallets in the same places.
+"""
+import math
+import random
+from collections import deque
+
+from protocol import PALLET_CHUNK_SIZE
+from colors import colors
+
+PALLETS_PER_CHUNK = 12  # about 1400 pallets on a 700x700 map. at most 256 (a slot is a byte)
+PALLET_RESPAWN_TICKS = 50  # an eaten pallet comes back (somewhere else in its chunk) this many ticks later
+GENERATION_MASK = 0xFF  # a slot's generation is a byte (see protocol.pallet_key). 256 respawns later, keys repeat
+
+
+class PalletChunk:
+    """The slots of one chunk, as lists: slot i of every list is the same pallet"""
+
+    def __init__(self, index, origin):
+        """initializer"""
+        self.index = index
+        self.origin = origin  # (x, y) of its top left corner
+        self.version = 0  # goes up with every change in the chunk
+        self.is_alive = [True] * PALLETS_PER_CHUNK
+        self.generations = [0] * PALLETS_PER_CHUNK  # goes up every time the slot respawns
+        self.x = [0] * PALLETS_PER_CHUNK
+        self.y = [0] * PALLETS_PER_CHUNK
+        self.color_indices = [0] * PALLETS_PER_CHUNK
+        self.slot_versions = [0] * PALLETS_PER_CHUNK  # the chunk version the slot last changed in
+
+    def changes_since(self, version):
+        """
+        :param version: the version the client has, None if it has nothing of this chunk
+        :return: the pallets (the columns of protocol.PALLET_FORMATS) that appeared since, and the slots eaten since
+        """
+        origin_x, origin_y = self.origin
+        slots, generations, xs, ys, color_indices = [], [], [], [], []
+        eaten_slots = []
+        for slot in range(PALLETS_PER_CHUNK):
+            if version is not None and self.slot_versions[slot] <= version:
+                continue
+            if self.is_alive[slot]:
+                slots.append(slot)
+                generations.append(self.generations[slot])
+                xs.append(self.x[slot] - origin_x)
+                ys.append(self.y[slot] - origin_y)
+                color_indices.append(self.color_indices[slot])
+            elif version is not None:
+                eaten_slots.append(slot)
+        return (slots, generations, xs, ys, color_indices), eaten_slots
+
+
+class PalletField:
+    """Every pallet chunk of the map, made when first needed"""
+
+    def __init__(self, width, height, seed):
+        """initializer"""
+        self.width = width
+        self.height = height
+        self.seed = seed
+        self.columns = math.ceil(width / PALLET_CHUNK_SIZE)
+        self.rows = math.ceil(height / PALLET_CHUNK_SIZE)
+        self.chunks = {}  # chunk index -> PalletChunk
+        self.respawns = deque()  # (tick, chunk index, slot) of eaten pallets, in the order they come back
+        self.eaten_keys = []  # keys this field's own clients ate since take_eaten_keys
+        self.tick = 0  # only the game's tick touches the field (clients' eats are queued to it), so no lock
+
+    def get_chunk(self, chunk_index):
+        """The chunk, full of pallets if nobody looked at it before"""
+        chunk = self.chunks.get(chunk_index)
+        if chunk is None:
+            row, column = divmod(chunk_index, self.columns)
+            chunk = PalletChunk(chunk_index, (column * PALLET_CHUNK_SIZE, row * PALLET_CHUNK_SIZE))
+            for slot in range(PALLETS_PER_CHUNK):
+                self.place(chunk, slot)
+            self.chunks[chunk_index] = chunk
+        return chunk
+
+    def place(self, chunk, slot):
+        """Put the pallet of a slot's current generation where it belongs. the same place in every field"""
+        rng = random.Random(hash((self.seed, chunk.index, slot, chunk.generations[slot])))
+        origin_x, origin_y = chunk.origin
+        chunk.x[slot] = rng.randrange(origin_x, min(origin_x + PALLET_CHUNK_SIZE, self.width))
+        chunk.y[slot] = rng.randrange(origin_y, min(origin_y + PALLET_CHUNK_SIZE, self.height))
+        chunk.color_indices[slot] = rng.randrange(len(colors))
+
+    def chunks_in(self, rect):
+        """indices of the chunks a rect (x, y, width, height) touches"""
+        x, y, width, height = rect
+        first_column = max(0, int(x // PALLET_CHUNK_SIZE))
+        last_column = min(self.columns - 1, int((x + width) // PALLET_CHUNK_SIZE))
+        first_row = max(0, int(y // PALLET_CHUNK_SIZE))
+        last_row = min(self.rows - 1, int((y + height) // PALLET_CHUNK_SIZE))
+        return [row * self.columns + column
+                for row in range(first_row, last_row + 1) for column in range(first_column, last_column + 1)]
+
+    def eat(self, keys, remember=True):
+        """
+        Pallets were eaten. keys of pallets that are already gone (or respawned since) are ignored.
+        :param remember: keep the keys for take_eaten_keys. False for pallets other fields already know about
+        :return: how many were eaten
+        """
+        eaten = 0
+        for key in keys:
+            chunk_index, slot, generation = key >> 16, (key >> 8) & 0xFF, key & GENERATION_MASK
+            if chunk_index >= self.columns * self.rows or slot >= PALLETS_PER_CHUNK:
+                continue
+            chunk = self.get_chunk(chunk_index)  # made now if needed, or it would come with the pallet still there
+            if not chunk.is_alive[slot] or chunk.generations[slot] != generation:
+                continue
+            chunk.is_alive[slot] = False
+            chunk.version += 1
+            chunk.slot_versions[slot] = chunk.version
+            self.respawns.append((self.tick + PALLET_RESPAWN_TICKS, chunk.index, slot))
+            if remember:
+                self.eaten_keys.append(key)
+            eaten += 1
+        return eaten
+
+    def take_eaten_keys(self):
+        """the keys of the pallets eaten since the last call"""
+        eaten_keys, self.eaten_keys = self.eaten_keys, []
+        return eaten_keys
+
+    def step(self, tick):
+        """Respawn the pallets that were eaten long enough ago"""
+        self.tick = tick
+        while self.respawns and self.respawns[0][0] <= tick:
+            _, chunk_index, slot = self.respawns.popleft()
+            chunk = self.chunks[chunk_index]
+            chunk.generations[slot] = (chunk.generations[slot] + 1) & GENERATION_MASK
+            self.place(chunk, slot)
+            chunk.is_alive[slot] = True
+            chunk.version += 1
+            chunk.slot_versions[slot] = chunk.version
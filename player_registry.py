@@ -0,0 +1,74 @@
+import threading
+from collections import deque
+
+SLOT_BITS = 16  # an id is (generation << SLOT_BITS) | slot, and has to fit in protocol.ID_FORMAT (32 bits)
+MAX_SLOTS = 1 << SLOT_BITS
+GENERATION_MASK = (1 << (32 - SLOT_BITS)) - 1
+BOT_SLOT = 0  # reserved for the bot, so its id is always 0. the client looks for that
+
+
+class PlayerRegistry:
+    """
+    Every living player, by id. adding, finding and removing a player are all O(1),
+    and going over the players goes in the order they joined.
+    An id is a slot and a generation: when a player leaves, its slot is reused by someone else
+    only with the next generation, so an old id (like in a late EAT request) never points to the new player.
+    """
+
+    def __init__(self, hands_out_ids=True):
+        """
+        initializer
+        :param hands_out_ids: False if the ids come from somewhere else (the front of sharded_server.py).
+        then nobody calls next_id, and removing a player frees no slot.
+        """
+        self.hands_out_ids = hands_out_ids
+        self.players = {}  # id -> player, in the order they joined
+        self.generations = [0]  # slot -> generation of the next player in it
+        self.free_slots = deque()  # slots nobody is in. the ones freed first are reused first
+        self.slots_lock = threading.Lock()  # handler threads take ids while the tick removes players
+
+    def next_id(self):
+        """A new id for a player that's about to be added"""
+        with self.slots_lock:
+            if self.free_slots:
+                slot = self.free_slots.popleft()
+            else:
+                slot = len(self.generations)
+                if slot >= MAX_SLOTS:
+                    raise OverflowError("too many players")
+                self.generations.append(0)
+            return (self.generations[slot] << SLOT_BITS) | slot
+
+    def add(self, player):
+        """Add a player. its id comes from next_id, or is 0 for the bot"""
+        self.players[player.id] = player
+
+    def get(self, player_id):
+        """the player with this id, None if there is no such player (anymore)"""
+        return self.players.get(player_id)
+
+    def remove(self, player_id):
+        """Remove a player by id. :return: the removed player, None if there was no such player"""
+        with self.slots_lock:
+            player = self.players.pop(player_id, None)
+            if player is not None and self.hands_out_ids:
+                slot = player_id & (MAX_SLOTS - 1)
+                if slot != BOT_SLOT:
+                    self.generations[slot] = (self.generations[slot] + 1) & GENERATION_MASK
+                    self.free_slots.append(slot)
+        return player
+
+    def __contains__(self, player):
+        """is this player (the object, not just its id) still in the game"""
+        return player is not None and self.players.get(player.id) is player
+
+    def __iter__(self):
+        """
+        Go over the players in the order they joined.
+        Over a copy: other threads may add and remove players while we go.
+        """
+        return iter(list(self.players.values()))
+
+    def __len__(self):
+        """how many players there are"""
+        return len(self.players)
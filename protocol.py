@@ -1,10 +1,68 @@
+import struct
 
 PORT = 8821
 SERVER_IP = "127.0.0.1"
 board_length, board_height = 49, 41
 
-FIELD_SEPERATOR = '/'
-VALUE_SEPERATOR = '*'
+PROTOCOL_VERSION = 1
+
+HEADER = struct.Struct("!BBI")
+"""
+Every message starts with this header:
+protocol version (1 byte), operation number (1 byte), payload length (4 bytes).
+"""
+COUNT = struct.Struct("!I")
+STRING_LENGTH = struct.Struct("!H")
+
+ID_FORMAT = "I"
+MASS_FORMAT = "I"
+POSITION_FORMAT = "i"
+
+PLAYERS_INFO_FORMATS = (ID_FORMAT, MASS_FORMAT, POSITION_FORMAT, POSITION_FORMAT)
+"""players_ids, players_masses, players_x, players_y"""
+
+WELCOME_INFO = struct.Struct("!III")
+"""GAME_WIDTH, GAME_HEIGHT, TICK_RATE"""
+SPAWN_NEW_PLAYER = struct.Struct("!IIii")
+"""new_player_id, start_mass, start_x, start_y"""
+POSITION_AND_MASS = struct.Struct("!iiI")
+"""x, y, mass"""
+SNAPSHOT = struct.Struct("!II")
+"""tick, base_tick"""
+TICK = struct.Struct("!I")
+"""tick"""
+VIEWPORT = struct.Struct("!iiII")
+"""x, y, width, height"""
+SYNC = struct.Struct("!BiiI")
+"""has_position, x, y, mass"""
+SYNC_STATUS = struct.Struct("!B")
+"""is_alive"""
+NAMES_UPDATE = struct.Struct("!IB")
+"""version, is_full"""
+PALLET_CHUNK = struct.Struct("!IIB")
+"""chunk index, version, is_full"""
+UDP_TOKEN = struct.Struct("!Q")
+"""token"""
+DATAGRAM = struct.Struct("!QI")
+"""
+Every UDP datagram starts with this, then a whole frame:
+token (the one OPEN_UDP gave the client's TCP connection), sequence number (per sender, starts at 1).
+"""
+MAX_DATAGRAM_SIZE = 1400
+"""bigger datagrams may be fragmented on the way, and get lost more often. snapshots bigger than this go over TCP"""
+
+DECODE_ERRORS = (struct.error, ValueError, IndexError)
+"""what decrypting a frame with a broken payload raises (a bad utf-8 name is a ValueError too)"""
+
+FRAME_BUFFER_SIZE = 64 * 1024
+"""the buffer a FrameReader starts with. it grows when a bigger frame comes"""
+
+PALLET_CHUNK_SIZE = 64
+"""the map is cut into square chunks of pallets this big (game units). chunk index = row * columns + column"""
+PALLET_KEY_FORMAT = "Q"
+"""a pallet's key: chunk index << 16 | slot << 8 | generation (see pallet_key and pallet_field.py)"""
+PALLET_FORMATS = ("B", "B", "B", "B", "B")
+"""slots, generations, x in the chunk, y in the chunk, color indices (in colors.py)"""
 
 
 class Consts:
@@ -14,6 +72,7 @@ class Consts:
         MY_POSITION_AND_MASS = 9
         """
         updates client's position.
+        Can be sent over UDP (see OPEN_UDP), where nothing comes back and older ones are dropped.
         """
         EAT = 8
         """
@@ -23,30 +82,56 @@ class Consts:
         """
         Client quit the game :(
         """
+        ACK = 12
+        """
+        The client applied the snapshot of this tick. the next snapshots are deltas from the last acknowledged tick.
+        Can be sent over UDP (see OPEN_UDP).
+        par1= tick
+
+        RETURNS:
+        nothing, not even a confirmation
+        """
+        REQUEST_KEYFRAME = 13
+        """
+        The client can't apply a delta (it doesn't have its base). asks for a full snapshot on the next tick.
+
+        RETURNS:
+        nothing, not even a confirmation
+        """
+        VIEWPORT = 14
+        """
+        The part of the map the client's camera shows. snapshots only carry players around it.
+        Until a client sends one, the server guesses it from the client's player mass.
+        par1= x, y, width, height
+
+        RETURNS:
+        nothing, not even a confirmation
+        """
 
     class Request:
         WELCOME_INFO = 1
         """
-        Inform that we are joining, and asks to add us to the game and receive all the info needed to start. 
-        
-        
+        Inform that we are joining, and asks to add us to the game and receive all the info needed to start.
+
+
         RETURNS:
-        GAME_WIDTH, GAME_HEIGHT, players_ids, players_names, players_masses
+        GAME_WIDTH, GAME_HEIGHT, TICK_RATE (ticks a second), players_ids, players_names, players_masses
         """
 
         SPAWN_NEW_PLAYER = 2
         """
         Request server to create a new player.
         par1= username
-        
+
         RETURNS:
         new_player_id, start_mass, start_x, start_y
         """
 
         INFO = 3
         """
-        client should request info every frame. consists of basic information of the current state of the game.
-        
+        basic information of the current state of the game. clients that SUBSCRIBE get it pushed every tick
+        instead, this is for the ones that would rather poll.
+
         RETURNS:
         players_ids, players_masses, players_x, players_y
         """
@@ -54,10 +139,73 @@ class Consts:
         """
         when a new client joins, other clients have only ids of a him but not the name. they
         recognise it, and should ask the server for a name match to the id.
-        
+        (subscribed clients don't need this, they get NAMES_UPDATE pushes)
+
         par1= list of ids
         RETURNS:
-        list of names (corresponding to the list of ids) 
+        list of names (corresponding to the list of ids)
+        """
+
+        SYNC = 15
+        """
+        Everything the client tells the server every sync tick, in one round trip instead of one per thing:
+        its position and mass (if it has a player), the ids of the players it ate and the keys of the pallets it ate.
+        The state of the world is not in the response, SNAPSHOT, NAMES_UPDATE and PALLETS pushes take care of that.
+        par1= has_position, x, y, mass, eaten_ids, eaten_pallets_keys
+
+        RETURNS:
+        is_alive (false if the client sent a position but its player is dead)
+        """
+
+        SUBSCRIBE = 10
+        """
+        Subscribe to the tick stream: from now on the server pushes a SNAPSHOT every tick,
+        so there is no need to poll INFO.
+
+        RETURNS:
+        CONFIRM
+        """
+
+        OPEN_UDP = 18
+        """
+        Ask for a UDP channel next to this TCP connection, for what's old news by the time a lost TCP segment is
+        sent again: MY_POSITION_AND_MASS and ACK from the client, SNAPSHOT pushes from the server.
+        Every datagram is a DATAGRAM header (the token, and a sequence number) and a frame. older datagrams than
+        the newest one are dropped. The server sends snapshots over UDP once a datagram of the client got to it,
+        to the address it came from. Everything else stays on TCP.
+
+        RETURNS:
+        token (0 if this server has no UDP)
+        """
+
+    class Push:
+        """the server sends these on its own, every tick, to subscribed clients. nobody asked, so nobody waits for them"""
+
+        SNAPSHOT = 11
+        """
+        The state of the world around the client's viewport at the end of a tick.
+        A keyframe (base_tick=0) has every player. A delta has only the players that joined or changed since
+        base_tick, which is the last tick the client acknowledged, and the ids of players that left (the game, or the
+        viewport) since then.
+        tick, base_tick, players_ids, players_masses, players_x, players_y, removed_players_ids
+        """
+
+        NAMES_UPDATE = 16
+        """
+        Changes to the id -> name table of every player in the game, pushed right before the SNAPSHOT of the same
+        tick, so a client knows the name of a player before it sees the player.
+        The first one after SUBSCRIBE is the whole table (is_full), and so is one after the client fell too far behind.
+        Every change bumps the table's version.
+        version, is_full, players_ids, players_names (joined), left_players_ids
+        """
+
+        PALLETS = 17
+        """
+        The pallets around the client's viewport. the server owns them, in chunks (see PALLET_CHUNK_SIZE).
+        Only chunks that changed since the client got them are in it: a full chunk (forget what you had of it),
+        or the pallets that (re)appeared and the slots that were eaten since. And the chunks the client doesn't
+        need anymore, so it can forget them. every chunk is sent full again with every SNAPSHOT keyframe.
+        dropped_chunks, then for every chunk: chunk index, version, is_full, pallets (PALLET_FORMATS), eaten slots
         """
 
     class Confirm:
@@ -73,6 +221,17 @@ class Consts:
         """
 
 
+PUSH_OPERATIONS = {Consts.Push.SNAPSHOT, Consts.Push.NAMES_UPDATE, Consts.Push.PALLETS}
+"""frames with these operation numbers are pushed by the server, they are never a response"""
+DATAGRAM_OPERATIONS = {Consts.Update.MY_POSITION_AND_MASS, Consts.Update.ACK}
+"""the requests that may come over UDP"""
+
+OPERATION_NAMES = {operation_number: name
+                   for operations in (Consts.Update, Consts.Request, Consts.Push, Consts.Confirm, Consts.Error)
+                   for name, operation_number in vars(operations).items() if not name.startswith("_")}
+"""operation number -> its name, for logs and stats"""
+
+
 def encrypt_players(players):
     """Encrypt the list of players"""
     encrypted_players = ""
@@ -92,60 +251,185 @@ def decrypt_board(encrypted_board):
     return decrypted_board
 
 
-def split_request(request):
-    """Splits a request into OPERATION_NUMBER, ARG1, ARG2"""
-    if len(request) < 2:
-        return None, None, None
+def build_frame(operation_number, payload=b""):
+    """Put a header in front of a payload"""
+    return HEADER.pack(PROTOCOL_VERSION, operation_number, len(payload)) + payload
 
-    OPERATION_NUMBER = request[0]
-    arguments = request[1:].split(FIELD_SEPERATOR)
-    if len(arguments) != 2:
-        return None, None, None
 
-    ARG1, ARG2 = arguments
-    if not OPERATION_NUMBER.isdigit():
-        return None, None, None
+def decrypt_header(header, offset=0):
+    """
+    :param offset: where the header starts, if it's in a bigger buffer
+    :return: operation number, payload length.
+    None, None if the header was built by a different protocol version.
+    """
+    version, operation_number, payload_length = HEADER.unpack_from(header, offset)
+    if version != PROTOCOL_VERSION:
+        return None, None
+    return operation_number, payload_length
 
-    return int(OPERATION_NUMBER), ARG1, ARG2
 
+def split_frame(frame):
+    """Splits a whole frame into OPERATION_NUMBER, PAYLOAD"""
+    if len(frame) < HEADER.size:
+        return None, None
 
-def build_request(operation_number, arg1="", arg2=""):
-    """Build a general-purpose request. operation number must be 1 digit."""
-    return f"{operation_number}{arg1}/{arg2}"
+    operation_number, payload_length = decrypt_header(frame)
+    if operation_number is None or len(frame) - HEADER.size != payload_length:
+        return None, None
 
+    return operation_number, frame[HEADER.size:]
 
-def is_iterable(arg) -> bool:
-    """is arg iterable"""
-    try:
-        _ = iter(arg)
-    except TypeError:
-        return False
-    return True
 
+class FrameReader:
+    """
+    Receives the frames of one socket into a buffer it keeps (recv_into), instead of new bytes for every recv.
+    A frame is handed out as a memoryview of the buffer, and is only good until the next receive_frame:
+    whoever keeps a frame longer copies it (bytes(frame)).
+    """
 
-def build_response(*args):
-    """Build a general-purpose response. Can not handle 2d arrays or more"""
-    response = ""
-    for arg in args:
-        if is_iterable(arg):
-            response += VALUE_SEPERATOR.join([str(element) for element in arg])
+    def __init__(self, sock, max_payload_length=None, buffer_size=FRAME_BUFFER_SIZE):
+        """
+        initializer
+        :param max_payload_length: frames bigger than this are treated like a closed socket
+        """
+        self.sock = sock
+        self.max_payload_length = max_payload_length
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # the first byte that was not handed out yet
+        self.end = 0  # right after the last byte received
+
+    def receive_frame(self):
+        """
+        Receive exactly one frame, no matter how big it is.
+        :return: the whole frame (header included), or b"" if the socket was closed.
+        """
+        if self.start == self.end:
+            self.start = self.end = 0  # everything was handed out, start over at the front for free
+        if not self.fill(HEADER.size):
+            return b""
+
+        operation_number, payload_length = decrypt_header(self.buffer, self.start)
+        if operation_number is None:
+            return b""
+        if self.max_payload_length is not None and payload_length > self.max_payload_length:
+            return b""
+
+        frame_length = HEADER.size + payload_length
+        if not self.fill(frame_length):
+            return b""
+        frame = self.view[self.start:self.start + frame_length]
+        self.start += frame_length
+        return frame
+
+    def fill(self, num_of_bytes):
+        """recv_into the buffer until num_of_bytes that were not handed out are in it. False if the socket closed"""
+        while self.end - self.start < num_of_bytes:
+            if self.start + num_of_bytes > len(self.buffer):
+                self.make_room(num_of_bytes)
+            received = self.sock.recv_into(self.view[self.end:])
+            if not received:
+                return False
+            self.end += received
+        return True
+
+    def make_room(self, num_of_bytes):
+        """Move the bytes that were not handed out to the front, in a bigger buffer if num_of_bytes don't fit"""
+        pending = self.view[self.start:self.end]
+        if num_of_bytes > len(self.buffer):
+            self.buffer = bytearray(max(num_of_bytes, 2 * len(self.buffer)))
+            self.view = memoryview(self.buffer)
+            self.view[:len(pending)] = pending
         else:
-            response += str(arg)
-        response += FIELD_SEPERATOR
+            self.view[:len(pending)] = bytes(pending)  # the two can overlap. it's only a partial frame
+        self.end = len(pending)
+        self.start = 0
+
+
+def split_request(request):
+    """Splits a request into OPERATION_NUMBER, PAYLOAD"""
+    return split_frame(request)
 
-    if response:
-        return response[:-1]  # remove the last field seperator
-    else:
-        return response
+
+def build_request(operation_number, payload=b""):
+    """Build a general-purpose request."""
+    return build_frame(operation_number, payload)
+
+
+def build_response(operation_number, payload=b""):
+    """Build a general-purpose response. operation number is the request it answers, or a Confirm / Error code"""
+    return build_frame(operation_number, payload)
 
 
 def decrypt_response(response):
-    """Decrypt a general-purpose response. Can not handle 2d arrays or more"""
-    values = response.split(FIELD_SEPERATOR)
-    for i, value in enumerate(values):
-        if VALUE_SEPERATOR in value:
-            values[i] = value.split(VALUE_SEPERATOR)
-    return values
+    """Decrypt a general-purpose response into OPERATION_NUMBER, PAYLOAD"""
+    return split_frame(response)
+
+
+def pack_list(values, value_format):
+    """Pack a list of numbers: count, then all the values"""
+    return struct.pack(f"!I{len(values)}{value_format}", len(values), *values)
+
+
+def unpack_list(payload, value_format, offset=0):
+    """Unpack a list packed by pack_list. returns the list and the offset right after it"""
+    count, = COUNT.unpack_from(payload, offset)
+    offset += COUNT.size
+    values_format = f"!{count}{value_format}"
+    values = list(struct.unpack_from(values_format, payload, offset))
+    return values, offset + struct.calcsize(values_format)
+
+
+def pack_columns(value_formats, *columns):
+    """
+    Pack lists of the same length, one after the other, with a single count in front.
+    For example: pack_columns(("I", "i"), [1, 2], [-5, 6])
+    """
+    count = len(columns[0]) if columns else 0
+    columns_format = "!I" + "".join(f"{count}{value_format}" for value_format in value_formats)
+    values = []
+    for column in columns:
+        values.extend(column)
+    return struct.pack(columns_format, count, *values)
+
+
+def unpack_columns(payload, value_formats, offset=0):
+    """Unpack lists packed by pack_columns. returns the lists and the offset right after them"""
+    count, = COUNT.unpack_from(payload, offset)
+    offset += COUNT.size
+    columns_format = "!" + "".join(f"{count}{value_format}" for value_format in value_formats)
+    values = struct.unpack_from(columns_format, payload, offset)
+    columns = [list(values[i * count:(i + 1) * count]) for i in range(len(value_formats))]
+    return columns, offset + struct.calcsize(columns_format)
+
+
+def pack_string(string):
+    """Pack a string: utf-8 length, then the utf-8 bytes"""
+    encoded = string.encode()
+    return STRING_LENGTH.pack(len(encoded)) + encoded
+
+
+def unpack_string(payload, offset=0):
+    """Unpack a string packed by pack_string. returns the string and the offset right after it"""
+    length, = STRING_LENGTH.unpack_from(payload, offset)
+    offset += STRING_LENGTH.size
+    return str(payload[offset:offset + length], "utf-8"), offset + length
+
+
+def pack_strings(strings):
+    """Pack a list of strings: count, then every string"""
+    return COUNT.pack(len(strings)) + b"".join(pack_string(string) for string in strings)
+
+
+def unpack_strings(payload, offset=0):
+    """Unpack a list of strings packed by pack_strings. returns the list and the offset right after it"""
+    count, = COUNT.unpack_from(payload, offset)
+    offset += COUNT.size
+    strings = []
+    for _ in range(count):
+        string, offset = unpack_string(payload, offset)
+        strings.append(string)
+    return strings, offset
 
 
 def string_list_to_other_type_of_list(string_list, type_of_value):
@@ -161,38 +445,261 @@ def string_list_to_other_type_of_list(string_list, type_of_value):
     return [type_of_value(value) for value in string_list]
 
 
+def build_welcome_info_response(game_width, game_height, tick_rate, players_ids, players_names, players_masses):
+    """GAME_WIDTH, GAME_HEIGHT, TICK_RATE, players_ids, players_names, players_masses"""
+    return build_response(
+        Consts.Request.WELCOME_INFO,
+        WELCOME_INFO.pack(game_width, game_height, tick_rate)
+        + pack_columns((ID_FORMAT, MASS_FORMAT), players_ids, [int(mass) for mass in players_masses])
+        + pack_strings(players_names)
+    )
+
+
 def decrypt_welcome_info_response(response):
-    """GAME_WIDTH, GAME_HEIGHT, players_ids, players_names, players_masses, client_player_id, start_x, start_y"""
-    GAME_WIDTH, GAME_HEIGHT, players_ids, players_names, players_masses = decrypt_response(response)
+    """GAME_WIDTH, GAME_HEIGHT, TICK_RATE, players_ids, players_names, players_masses"""
+    _, payload = decrypt_response(response)
+    GAME_WIDTH, GAME_HEIGHT, TICK_RATE = WELCOME_INFO.unpack_from(payload)
+    (players_ids, players_masses), offset = unpack_columns(payload, (ID_FORMAT, MASS_FORMAT), WELCOME_INFO.size)
+    players_names, _ = unpack_strings(payload, offset)
+
+    return GAME_WIDTH, GAME_HEIGHT, TICK_RATE, players_ids, players_names, players_masses
+
+
+def build_spawn_new_player_request(username):
+    """Ask to spawn a new player called username"""
+    return build_request(Consts.Request.SPAWN_NEW_PLAYER, pack_string(username))
 
-    GAME_WIDTH = int(GAME_WIDTH)
-    GAME_HEIGHT = int(GAME_HEIGHT)
 
-    players_ids = string_list_to_other_type_of_list(players_ids, int)
-    players_names = string_list_to_other_type_of_list(players_names, str)
-    players_masses = string_list_to_other_type_of_list(players_masses, int)
+def decrypt_spawn_new_player_request(payload):
+    """returns the requested username"""
+    username, _ = unpack_string(payload)
+    return username
 
-    return GAME_WIDTH, GAME_HEIGHT, players_ids, players_names, players_masses
+
+def build_spawn_new_player_response(client_player_id, start_mass, start_x, start_y):
+    """new_player_id, start_mass, start_x, start_y"""
+    return build_response(
+        Consts.Request.SPAWN_NEW_PLAYER,
+        SPAWN_NEW_PLAYER.pack(client_player_id, int(start_mass), start_x, start_y)
+    )
 
 
 def decrypt_spawn_a_new_player_response(response):
     """Decrypt the spawn a new player response. it's in the name of the function"""
-    client_player_id, start_mass, start_x, start_y = decrypt_response(response)
-
-    client_player_id = int(client_player_id)
-    start_mass = int(start_mass)
-    start_x = int(start_x)
-    start_y = int(start_y)
+    _, payload = decrypt_response(response)
+    client_player_id, start_mass, start_x, start_y = SPAWN_NEW_PLAYER.unpack_from(payload)
 
     return client_player_id, start_mass, start_x, start_y
 
 
+def build_position_and_mass_request(x, y, mass):
+    """Update the client's position and mass"""
+    return build_request(Consts.Update.MY_POSITION_AND_MASS, POSITION_AND_MASS.pack(int(x), int(y), int(mass)))
+
+
+def decrypt_position_and_mass_request(payload):
+    """x, y, mass"""
+    return POSITION_AND_MASS.unpack_from(payload)
+
+
+def build_ids_request(operation_number, ids):
+    """A request that carries a list of player ids (EAT, NAMES)"""
+    return build_request(operation_number, pack_list([int(player_id) for player_id in ids], ID_FORMAT))
+
+
+def decrypt_ids_request(payload):
+    """the list of player ids a request carries"""
+    ids, _ = unpack_list(payload, ID_FORMAT)
+    return ids
+
+
+def build_info_response(players_ids, players_masses, players_x, players_y):
+    """players_ids, players_masses, players_x, players_y"""
+    return build_response(
+        Consts.Request.INFO,
+        pack_columns(PLAYERS_INFO_FORMATS, players_ids, players_masses, players_x, players_y)
+    )
+
+
 def decrypt_info_response(info_response):
     """players_ids, players_masses, players_x, players_y"""
-    players_ids, players_masses, players_x, players_y = decrypt_response(info_response)
-    players_ids = string_list_to_other_type_of_list(players_ids, int)
-    players_masses = string_list_to_other_type_of_list(players_masses, int)
-    players_x = string_list_to_other_type_of_list(players_x, int)
-    players_y = string_list_to_other_type_of_list(players_y, int)
+    _, payload = decrypt_response(info_response)
+    (players_ids, players_masses, players_x, players_y), _ = unpack_columns(payload, PLAYERS_INFO_FORMATS)
 
     return players_ids, players_masses, players_x, players_y
+
+
+def build_names_response(players_names):
+    """list of names (corresponding to the list of requested ids)"""
+    return build_response(Consts.Request.NAMES, pack_strings(players_names))
+
+
+def decrypt_names_response(response):
+    """list of names (corresponding to the list of requested ids)"""
+    _, payload = decrypt_response(response)
+    players_names, _ = unpack_strings(payload)
+    return players_names
+
+
+def build_snapshot(tick, base_tick, players_ids, players_masses, players_x, players_y, removed_players_ids):
+    """tick, base_tick (0 for a keyframe), players_ids, players_masses, players_x, players_y, removed_players_ids"""
+    return build_frame(
+        Consts.Push.SNAPSHOT,
+        SNAPSHOT.pack(tick, base_tick)
+        + pack_columns(PLAYERS_INFO_FORMATS, players_ids, players_masses, players_x, players_y)
+        + pack_list(removed_players_ids, ID_FORMAT)
+    )
+
+
+def decrypt_snapshot(snapshot):
+    """tick, base_tick (0 for a keyframe), players_ids, players_masses, players_x, players_y, removed_players_ids"""
+    _, payload = split_frame(snapshot)
+    tick, base_tick = SNAPSHOT.unpack_from(payload)
+    (players_ids, players_masses, players_x, players_y), offset = unpack_columns(
+        payload, PLAYERS_INFO_FORMATS, SNAPSHOT.size
+    )
+    removed_players_ids, _ = unpack_list(payload, ID_FORMAT, offset)
+
+    return tick, base_tick, players_ids, players_masses, players_x, players_y, removed_players_ids
+
+
+def build_sync_request(position, mass, eaten_ids, eaten_pallets_keys=()):
+    """One request with everything a sync tick sends. position and mass are None when the client has no player"""
+    if position is None:
+        fields = SYNC.pack(False, 0, 0, 0)
+    else:
+        x, y = position
+        fields = SYNC.pack(True, int(x), int(y), int(mass))
+    return build_request(
+        Consts.Request.SYNC,
+        fields
+        + pack_list([int(player_id) for player_id in eaten_ids], ID_FORMAT)
+        + pack_list(list(eaten_pallets_keys), PALLET_KEY_FORMAT)
+    )
+
+
+def decrypt_sync_request(payload):
+    """has_position, x, y, mass, eaten_ids, eaten_pallets_keys"""
+    has_position, x, y, mass = SYNC.unpack_from(payload)
+    eaten_ids, offset = unpack_list(payload, ID_FORMAT, SYNC.size)
+    eaten_pallets_keys, _ = unpack_list(payload, PALLET_KEY_FORMAT, offset)
+    return bool(has_position), x, y, mass, eaten_ids, eaten_pallets_keys
+
+
+def build_sync_response(is_alive):
+    """is_alive"""
+    return build_response(Consts.Request.SYNC, SYNC_STATUS.pack(is_alive))
+
+
+def decrypt_sync_response(response):
+    """is_alive"""
+    _, payload = decrypt_response(response)
+    is_alive, = SYNC_STATUS.unpack_from(payload)
+    return bool(is_alive)
+
+
+def build_names_update(version, is_full, players_ids, players_names, left_players_ids):
+    """version, is_full (the whole table, forget the old one), players_ids, players_names, left_players_ids"""
+    return build_frame(
+        Consts.Push.NAMES_UPDATE,
+        NAMES_UPDATE.pack(version, is_full)
+        + pack_list(players_ids, ID_FORMAT)
+        + pack_strings(players_names)
+        + pack_list(left_players_ids, ID_FORMAT)
+    )
+
+
+def decrypt_names_update(names_update):
+    """version, is_full (the whole table, forget the old one), players_ids, players_names, left_players_ids"""
+    _, payload = split_frame(names_update)
+    version, is_full = NAMES_UPDATE.unpack_from(payload)
+    players_ids, offset = unpack_list(payload, ID_FORMAT, NAMES_UPDATE.size)
+    players_names, offset = unpack_strings(payload, offset)
+    left_players_ids, _ = unpack_list(payload, ID_FORMAT, offset)
+    return version, bool(is_full), players_ids, players_names, left_players_ids
+
+
+def build_pallets_update(dropped_chunks, chunk_updates):
+    """
+    dropped_chunks, chunk_updates: a list of (chunk index, version, is_full, pallets, eaten_slots)
+    where pallets are the columns of PALLET_FORMATS
+    """
+    parts = [pack_list(dropped_chunks, "I"), COUNT.pack(len(chunk_updates))]
+    for chunk_index, version, is_full, pallets, eaten_slots in chunk_updates:
+        parts.append(PALLET_CHUNK.pack(chunk_index, version, is_full))
+        parts.append(pack_columns(PALLET_FORMATS, *pallets))
+        parts.append(pack_list(eaten_slots, "B"))
+    return build_frame(Consts.Push.PALLETS, b"".join(parts))
+
+
+def decrypt_pallets_update(pallets_update):
+    """dropped_chunks, chunk_updates. see build_pallets_update"""
+    _, payload = split_frame(pallets_update)
+    dropped_chunks, offset = unpack_list(payload, "I")
+    count, = COUNT.unpack_from(payload, offset)
+    offset += COUNT.size
+    chunk_updates = []
+    for _ in range(count):
+        chunk_index, version, is_full = PALLET_CHUNK.unpack_from(payload, offset)
+        pallets, offset = unpack_columns(payload, PALLET_FORMATS, offset + PALLET_CHUNK.size)
+        eaten_slots, offset = unpack_list(payload, "B", offset)
+        chunk_updates.append((chunk_index, version, bool(is_full), pallets, eaten_slots))
+    return dropped_chunks, chunk_updates
+
+
+def pallet_key(chunk_index, slot, generation):
+    """The key of a pallet, the way SYNC reports it eaten"""
+    return chunk_index << 16 | slot << 8 | generation
+
+
+def build_open_udp_response(token):
+    """token (0 if this server has no UDP)"""
+    return build_response(Consts.Request.OPEN_UDP, UDP_TOKEN.pack(token))
+
+
+def decrypt_open_udp_response(response):
+    """token (0 if this server has no UDP)"""
+    _, payload = decrypt_response(response)
+    token, = UDP_TOKEN.unpack_from(payload)
+    return token
+
+
+def build_datagram(token, sequence, frame):
+    """Put a frame in a UDP datagram"""
+    return DATAGRAM.pack(token, sequence) + frame
+
+
+def split_datagram(datagram):
+    """
+    Splits a UDP datagram into token, sequence, frame.
+    None, None, None if it's too short, or the frame in it is not whole.
+    """
+    if len(datagram) < DATAGRAM.size:
+        return None, None, None
+    token, sequence = DATAGRAM.unpack_from(datagram)
+    frame = datagram[DATAGRAM.size:]
+    operation_number, _ = split_frame(frame)
+    if operation_number is None:
+        return None, None, None
+    return token, sequence, frame
+
+
+def build_ack_request(tick):
+    """Acknowledge the snapshot of this tick"""
+    return build_request(Consts.Update.ACK, TICK.pack(tick))
+
+
+def decrypt_ack_request(payload):
+    """the acknowledged tick"""
+    tick, = TICK.unpack_from(payload)
+    return tick
+
+
+def build_viewport_request(x, y, width, height):
+    """The part of the map the client's camera shows"""
+    return build_request(Consts.Update.VIEWPORT, VIEWPORT.pack(int(x), int(y), int(width), int(height)))
+
+
+def decrypt_viewport_request(payload):
+    """x, y, width, height"""
+    return VIEWPORT.unpack_from(payload)
@@ -0,0 +1,248 @@
+"""
+Watch a match again, as a spectator, from a replay log the server recorded (server.py --record-replay match.replay,
+or simulation.py --record-replay). The log is memory-mapped, and any tick is found through its index, so jumping
+around a long match costs the same as jumping around a short one. The players are drawn by the client's Camera.
+
+python3 replay.py match.replay                   watch from the start
+python3 replay.py match.replay --tick 4200       from tick 4200
+python3 replay.py match.replay --info            how long, how big
+python3 replay.py match.replay --dump 4200       the players (id, mass, x, y, name) on tick 4200, no window
+
+keys: space pause, left / right 10 seconds back / forward, up / down faster / slower, tab follow the next player,
+period one tick forward (paused)
+"""
+import argparse
+import sys
+import time
+
+import client
+from client import Camera, Game, create_text, BLACK
+from replay_log import ReplayReader, INDEX_ENTRY
+
+import pygame
+
+SEEK_SECONDS = 10
+MAX_SPEED = 16
+
+
+class MapCenter:
+    """What the camera looks at when nobody is in the game"""
+
+    def __init__(self, game):
+        """initializer"""
+        self.position = (game.width / 2, game.height / 2)
+        self.mass = client.PALLET_MASS
+
+
+class Spectator:
+    """A client Game fed from a replay log instead of the server, and a camera that follows its players"""
+
+    def __init__(self, reader, screen):
+        """initializer"""
+        self.reader = reader
+        self.screen = screen
+        self.speed = 1
+        self.is_paused = False
+        self.game = None
+        self.camera = None
+        self.tick = None  # the last tick applied to the game
+        self.status_rect = None  # where the status line was drawn on the last frame
+        self.play_tick = None  # where playback is, in ticks with fractions
+
+    def seek(self, tick):
+        """Start over from a tick: a new game, with the world as it was on it"""
+        tick = min(max(tick, self.reader.first_tick), self.reader.last_tick)
+        world_state, names = self.reader.state_at(tick)
+        followed_id = self.followed_id()
+
+        self.game = Game(self.reader.width, self.reader.height, {}, tick_rate=self.reader.tick_rate * self.speed)
+        self.game.names = names
+        players_ids = list(world_state)
+        self.game.apply_snapshot(tick, 0, players_ids, [world_state[player_id][0] for player_id in players_ids],
+                                 [world_state[player_id][1:] for player_id in players_ids], [], time.perf_counter())
+        self.tick = self.play_tick = tick
+        self.camera = Camera(self.screen, self.game, MapCenter(self.game), *camera_initial_size(self.game))
+        self.follow(self.game.players.get(followed_id) or self.biggest_player())
+
+    def feed(self, tick):
+        """Apply a tick's record to the game, like a snapshot from the server"""
+        is_keyframe, players, left_ids, joined_ids, joined_names = self.reader.record_at(tick)
+        game = self.game
+        if is_keyframe:
+            game.names.clear()  # the keyframe has all of them
+        for player_id in left_ids:
+            game.names.pop(player_id, None)
+        game.names.update(zip(joined_ids, joined_names))
+        players_ids, players_masses, players_x, players_y = players
+        game.apply_snapshot(tick, 0 if is_keyframe else tick - 1, players_ids, players_masses,
+                            zip(players_x, players_y), left_ids, time.perf_counter())
+        self.tick = tick
+
+    def advance(self, seconds):
+        """Play for this many seconds of real time"""
+        if self.is_paused:
+            return
+        self.play_tick = min(self.play_tick + seconds * self.reader.tick_rate * self.speed, self.reader.last_tick)
+        while self.tick + 1 <= self.play_tick:
+            self.feed(self.tick + 1)
+
+    def step(self):
+        """One tick forward, and pause there"""
+        self.is_paused = True
+        if self.tick < self.reader.last_tick:
+            self.feed(self.tick + 1)
+            self.play_tick = self.tick
+
+    def set_speed(self, speed):
+        """how many times faster than the match was played"""
+        self.speed = min(max(speed, 1 / MAX_SPEED), MAX_SPEED)
+        self.game.tick_rate = self.reader.tick_rate * self.speed  # so the render clock keeps up
+
+    def followed_id(self):
+        """id of the player the camera follows, None if nobody"""
+        return getattr(self.camera.player, "id", None) if self.camera is not None else None
+
+    def biggest_player(self):
+        """the biggest player in the game, None if there is nobody"""
+        return max(self.game.players.values(), key=lambda player: player.mass, default=None)
+
+    def follow(self, player):
+        """Point the camera at a player, or at the middle of the map if it's None"""
+        self.camera.player = player if player is not None else MapCenter(self.game)
+
+    def follow_next(self):
+        """Follow the next player, by id"""
+        players_ids = sorted(self.game.players)
+        if not players_ids:
+            return
+        followed_id = self.followed_id()
+        next_ids = [player_id for player_id in players_ids if followed_id is None or player_id > followed_id]
+        self.follow(self.game.players[(next_ids or players_ids)[0]])
+
+    def render(self):
+        """
+        Draw the game as it is at the render clock, and where in the replay we are.
+        :return: the rects of the screen that changed, for pygame.display.update
+        """
+        game, camera = self.game, self.camera
+        if not self.is_paused:
+            game.advance_render_clock(time.perf_counter())
+            game.interpolate_players()
+        if isinstance(camera.player, client.Player) and camera.player.id not in game.players:
+            self.follow(self.biggest_player())  # the one we followed is gone
+
+        camera.update_size()
+        camera.update_rect_position()
+        camera.find_visible_game_objects()
+        if self.status_rect is not None:
+            camera.invalidate(self.status_rect)  # the old status line goes, with what was under it
+        dirty_rects = camera.render()
+
+        status = f"tick {self.tick} / {self.reader.last_tick}   x{self.speed:g}"
+        if self.is_paused:
+            status += "   paused"
+        text_surface, text_rect = create_text(status, client.FONT_SIZE, BLACK)
+        text_rect.topleft = (10, 10)
+        self.screen.blit(text_surface, text_rect)
+        self.status_rect = text_rect
+        return dirty_rects + [text_rect]
+
+
+def camera_initial_size(game):
+    """width, height of the camera, like the client's when it starts"""
+    height = game.height // 10
+    return height * client.ASPECT_RATIO, height
+
+
+def print_info(reader, path):
+    """How long the replay is, and how big"""
+    print(f"{path}: {reader.width}x{reader.height} map, {reader.tick_rate} ticks a second")
+    if not reader.ticks_count:
+        print("no ticks recorded")
+        return
+    log_size = reader.record_end(reader.last_tick)  # a log that's still being written can be a bit longer
+    print(f"ticks {reader.first_tick} to {reader.last_tick} ({reader.ticks_count / reader.tick_rate:.0f} s), "
+          f"a keyframe every {reader.keyframe_interval}")
+    print(f"{log_size / 1024:.0f} KiB (+ {reader.ticks_count * INDEX_ENTRY.size / 1024:.0f} KiB index), "
+          f"{log_size / reader.ticks_count:.0f} bytes a tick")
+
+
+def dump(reader, tick):
+    """Print the players on a tick, like simulation.py --dump"""
+    world_state, names = reader.state_at(tick)
+    for player_id, (mass, x, y) in sorted(world_state.items()):
+        print(f"{player_id} {mass} {x} {y} {names.get(player_id, '')}")
+
+
+def watch(reader, start_tick):
+    """Open a window and play the replay in it"""
+    screen = pygame.display.set_mode((client.SCREEN_WIDTH, client.SCREEN_HEIGHT))
+    pygame.display.set_caption("ROY.IO replay")
+    clock = pygame.time.Clock()
+    spectator = Spectator(reader, screen)
+    spectator.seek(start_tick)
+
+    seek_ticks = SEEK_SECONDS * reader.tick_rate
+    last_frame_time = time.perf_counter()
+    while True:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                pygame.quit()
+                return
+            if event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_SPACE:
+                    spectator.is_paused = not spectator.is_paused
+                elif event.key == pygame.K_RIGHT:
+                    spectator.seek(spectator.tick + seek_ticks)
+                elif event.key == pygame.K_LEFT:
+                    spectator.seek(spectator.tick - seek_ticks)
+                elif event.key == pygame.K_UP:
+                    spectator.set_speed(spectator.speed * 2)
+                elif event.key == pygame.K_DOWN:
+                    spectator.set_speed(spectator.speed / 2)
+                elif event.key == pygame.K_TAB:
+                    spectator.follow_next()
+                elif event.key == pygame.K_PERIOD:
+                    spectator.step()
+
+        now = time.perf_counter()
+        spectator.advance(now - last_frame_time)
+        last_frame_time = now
+        pygame.display.update(spectator.render())
+        clock.tick(client.FPS)
+
+
+def parse_arguments():
+    """command line arguments"""
+    parser = argparse.ArgumentParser(description="watch a replay log of the agar.io clone server")
+    parser.add_argument("path", help="the replay log (its index is next to it, PATH.index)")
+    parser.add_argument("--tick", type=int, help="start from this tick")
+    parser.add_argument("--info", action="store_true", help="print how long and how big the replay is, and quit")
+    parser.add_argument("--dump", type=int, metavar="TICK", help="print the players on this tick, and quit")
+    return parser.parse_args()
+
+
+def main():
+    """Open the replay, and do what the arguments say with it"""
+    arguments = parse_arguments()
+    try:
+        reader = ReplayReader(arguments.path)
+    except (OSError, ValueError) as error:
+        sys.exit(error)
+
+    if arguments.info:
+        print_info(reader, arguments.path)
+    elif not reader.ticks_count:
+        sys.exit(f"{arguments.path}: no ticks recorded")
+    elif arguments.dump is not None:
+        if not reader.first_tick <= arguments.dump <= reader.last_tick:
+            sys.exit(f"{arguments.path}: tick {arguments.dump} is not in the replay "
+                     f"({reader.first_tick} to {reader.last_tick})")
+        dump(reader, arguments.dump)
+    else:
+        watch(reader, reader.first_tick if arguments.tick is None else arguments.tick)
+    reader.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""
+Replay logs: what the players did on every tick of a match, to watch it again (replay.py) and find what
+happened on a slow tick. No pygame here, the server writes them (server.py --record-replay match.replay).
+
+The log is a header, then a record for every tick: the players that joined, changed or left on that tick (a delta),
+or every player (a keyframe) every keyframe_interval ticks, so a tick is never more than that many records away
+from a whole world. Next to it, the index (match.replay.index) has where every tick's record starts,
+INDEX_ENTRY.size bytes a tick, so a tick's record is found with one multiplication.
+Both files are only appended to, and handed to the OS after every tick: if the server dies, it's all there.
+"""
+import mmap
+import struct
+
+import protocol
+from protocol import PLAYERS_INFO_FORMATS, ID_FORMAT
+
+REPLAY_MAGIC = b"AGARREPL"
+REPLAY_VERSION = 1
+REPLAY_HEADER = struct.Struct("!8sBIIIII")
+"""magic, version, map width, map height, tick rate, keyframe interval, first tick"""
+REPLAY_TICK = struct.Struct("!IBI")
+"""tick, is_keyframe, length of the rest: the players (PLAYERS_INFO_FORMATS), left ids, joined ids, joined names"""
+INDEX_ENTRY = struct.Struct("!Q")
+"""where a tick's record starts in the log"""
+INDEX_SUFFIX = ".index"
+KEYFRAME_INTERVAL = 100  # ticks between keyframes. seeking reads at most this many records
+
+
+class ReplayWriter:
+    """Appends the ticks of a server's game to a replay log and its index"""
+
+    def __init__(self, path, game, keyframe_interval=KEYFRAME_INTERVAL):
+        """initializer. the first tick recorded is the next one the game steps to"""
+        self.log_file = open(path, "wb")
+        self.index_file = open(path + INDEX_SUFFIX, "wb")
+        self.keyframe_interval = keyframe_interval
+        self.first_tick = game.tick + 1
+        self.known_ids = set()  # the players of the last recorded tick
+        header = REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, game.width, game.height, game.tick_rate,
+                                    keyframe_interval, self.first_tick)
+        self.log_file.write(header)
+        self.offset = len(header)
+
+    def record(self, game):
+        """Append the tick the game just stepped to. right after every Game.step, or the ticks won't line up"""
+        tick = game.tick
+        world_state = game.world_state
+        is_keyframe = (tick - self.first_tick) % self.keyframe_interval == 0
+        if is_keyframe:
+            players_ids = list(world_state)
+            left_ids = []
+            joined_ids = players_ids
+            self.known_ids = set(players_ids)
+        else:
+            changed_ids = game.changes_by_tick.get(tick, ())
+            players_ids = [player_id for player_id in changed_ids if player_id in world_state]
+            left_ids = [player_id for player_id in changed_ids if player_id not in world_state]
+            joined_ids = [player_id for player_id in players_ids if player_id not in self.known_ids]
+            self.known_ids.difference_update(left_ids)
+            self.known_ids.update(joined_ids)
+
+        joined_names = [game.names.get(player_id, "") for player_id in joined_ids]
+        players_masses, players_x, players_y = [], [], []
+        for player_id in players_ids:
+            mass, x, y = world_state[player_id]
+            players_masses.append(mass)
+            players_x.append(x)
+            players_y.append(y)
+
+        payload = (protocol.pack_columns(PLAYERS_INFO_FORMATS, players_ids, players_masses, players_x, players_y)
+                   + protocol.pack_list(left_ids, ID_FORMAT)
+                   + protocol.pack_list(joined_ids, ID_FORMAT)
+                   + protocol.pack_strings(joined_names))
+        self.log_file.write(REPLAY_TICK.pack(tick, is_keyframe, len(payload)))
+        self.log_file.write(payload)
+        self.index_file.write(INDEX_ENTRY.pack(self.offset))
+        self.offset += REPLAY_TICK.size + len(payload)
+        self.flush()  # two small writes a tick, and a killed server loses nothing
+
+    def flush(self):
+        """Hand what was recorded so far to the OS"""
+        self.log_file.flush()
+        self.index_file.flush()
+
+    def close(self):
+        """Finish the log"""
+        self.log_file.close()
+        self.index_file.close()
+
+
+class ReplayReader:
+    """A replay log and its index, memory-mapped. any tick is read without reading the ones before its keyframe"""
+
+    def __init__(self, path):
+        """initializer. raises ValueError if it's not a replay log"""
+        with open(path, "rb") as log_file:
+            self.log = mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(path + INDEX_SUFFIX, "rb") as index_file:
+            try:
+                self.index = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # an empty file can't be mapped: nothing was recorded yet
+                self.index = b""
+
+        if len(self.log) < REPLAY_HEADER.size:
+            raise ValueError(f"{path} is not a replay log")
+        magic, version, self.width, self.height, self.tick_rate, self.keyframe_interval, self.first_tick = \
+            REPLAY_HEADER.unpack_from(self.log)
+        if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+            raise ValueError(f"{path} is not a replay log (of this version)")
+
+        # a log that was still being written (or whose server died) can end in the middle of a record
+        self.ticks_count = len(self.index) // INDEX_ENTRY.size
+        while self.ticks_count and self.record_end(self.first_tick + self.ticks_count - 1) > len(self.log):
+            self.ticks_count -= 1
+        self.last_tick = self.first_tick + self.ticks_count - 1
+
+    def record_offset(self, tick):
+        """where a tick's record starts in the log"""
+        offset, = INDEX_ENTRY.unpack_from(self.index, (tick - self.first_tick) * INDEX_ENTRY.size)
+        return offset
+
+    def record_end(self, tick):
+        """where a tick's record ends in the log. past the end of the log if it's not all there"""
+        offset = self.record_offset(tick)
+        if offset + REPLAY_TICK.size > len(self.log):
+            return offset + REPLAY_TICK.size
+        _, _, length = REPLAY_TICK.unpack_from(self.log, offset)
+        return offset + REPLAY_TICK.size + length
+
+    def record_at(self, tick):
+        """
+        The record of a tick, read straight from the mapped log.
+        :return: is_keyframe, (players_ids, players_masses, players_x, players_y), left_ids, joined_ids, joined_names
+        """
+        if not self.first_tick <= tick <= self.last_tick:
+            raise IndexError(f"tick {tick} is not in the replay ({self.first_tick} to {self.last_tick})")
+        offset = self.record_offset(tick)
+        _, is_keyframe, _ = REPLAY_TICK.unpack_from(self.log, offset)
+        players, offset = protocol.unpack_columns(self.log, PLAYERS_INFO_FORMATS, offset + REPLAY_TICK.size)
+        left_ids, offset = protocol.unpack_list(self.log, ID_FORMAT, offset)
+        joined_ids, offset = protocol.unpack_list(self.log, ID_FORMAT, offset)
+        joined_names, _ = protocol.unpack_strings(self.log, offset)
+        return bool(is_keyframe), players, left_ids, joined_ids, joined_names
+
+    def keyframe_tick(self, tick):
+        """the tick of the last keyframe at or before tick"""
+        return tick - (tick - self.first_tick) % self.keyframe_interval
+
+    def state_at(self, tick):
+        """
+        The world on a tick: its keyframe, and the deltas from there.
+        :return: world_state (player id -> (mass, x, y)), names (player id -> name)
+        """
+        world_state, names = {}, {}
+        for record_tick in range(self.keyframe_tick(tick), tick + 1):
+            apply_record(world_state, names, *self.record_at(record_tick))
+        return world_state, names
+
+    def close(self):
+        """Unmap the files"""
+        self.log.close()
+        if isinstance(self.index, mmap.mmap):
+            self.index.close()
+
+
+def apply_record(world_state, names, is_keyframe, players, left_ids, joined_ids, joined_names):
+    """Apply a tick's record (see ReplayReader.record_at) to a world_state and names, in place"""
+    if is_keyframe:
+        world_state.clear()
+        names.clear()
+    for player_id in left_ids:
+        world_state.pop(player_id, None)
+        names.pop(player_id, None)
+    names.update(zip(joined_ids, joined_names))
+    for player_id, mass, x, y in zip(*players):
+        world_state[player_id] = (mass, x, y)
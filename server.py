@@ -1,10 +1,20 @@
+import argparse
+import asyncio
+import math
 import random
+import secrets
 import threading
+import time
+from collections import deque
+from types import MappingProxyType
 import protocol
 from protocol import Consts
-from server_server import Server
-
-import pygame
+from server_server import Server, AsyncServer, DatagramServer, AsyncDatagramServer
+from spatial_grid import SpatialGrid
+from player_registry import PlayerRegistry, BOT_SLOT
+from stats import ServerStats, start_stats_server
+from pallet_field import PalletField
+from replay_log import ReplayWriter
 
 PLAYER_INITIAL_MASS = 100
 
@@ -27,6 +37,7 @@ class Player(GameObject):
         self.name = name
         self.id = player_id
         self.mass = PLAYER_INITIAL_MASS
+        self.is_alive = True  # until it's removed from the game. a player that is about to join is alive already
 
     def eat(self, mass):
         """eat mass"""
@@ -34,54 +45,197 @@ class Player(GameObject):
 
 
 class Game:
-    """The game itself"""
-
-    def __init__(self, width, height):
-        """initializer"""
+    """
+    The game itself. one thread owns it: the one that steps it (the tick).
+    Handler threads never change it, they queue commands (queue_input, queue_new_player, queue_removal...) that
+    the tick applies all together at its start, in the order they came. What they read is world_state,
+    which the tick replaces (never changes) once a tick.
+    """
+
+    def __init__(self, width, height, tick_rate, rng=None):
+        """
+        initializer
+        :param rng: where the randomness comes from (a random.Random). seed it, and the same inputs give the same game
+        """
         self.width = width
         self.height = height
-        self.players = []
-        self.pallets = []
+        self.tick_rate = tick_rate
+        self.rng = rng if rng is not None else random.Random()
+        self.tick = 0
+        self.players = PlayerRegistry()
+        self.pallet_field = PalletField(width, height, self.rng.getrandbits(32))
         self.viruses = []
-        self.all_game_objects = []  # sorted from the smallest mass to the highest mass
-        self.last_player_id = 0  # initial value should be 0, but starts from 1.
+        self.commands = deque()  # (function, args) of the changes asked for since the last tick, in order
+        self.pending_bot = None  # the bot, if it was asked for and the next tick puts it in the game
+        self.world_state = MappingProxyType({})  # player id -> (mass, x, y) at the end of the last tick. read only
+        self.changes_by_tick = {}  # tick -> ids of players that joined, changed or left on that tick
+        self.grid = SpatialGrid(AOI_CELL_SIZE)  # player ids by their position at the end of the last tick
+
+        self.names = {}  # player id -> name, of every player in the game. changed and read by the tick only
+        self.names_version = 0  # goes up with every change to names
+        self.name_changes = deque(maxlen=NAME_CHANGES_HISTORY)  # (version, player id, name or None if it left)
+
+    def new_player(self, name):
+        """A new player with a random position and its own id, not in the game yet"""
+        x = self.rng.randint(self.width // 10, self.width // 10 * 9)
+        y = self.rng.randint(self.height // 10, self.height // 10 * 9)
+        return Player(name, self.players.next_id(), (x, y))
 
     def create_new_player(self, name):
-        """Create a new player with random position, and add it to the game"""
-        self.last_player_id += 1
-
-        x = random.randint(self.width // 10, self.width // 10 * 9)
-        y = random.randint(self.height // 10, self.height // 10 * 9)
-        position = (x, y)
-        # print(position)
-        new_player = Player(name, self.last_player_id, position)
-        self.players.append(new_player)
-        self.all_game_objects.append(new_player)
+        """Create a new player with random position, and add it to the game now. only the game's owner does that"""
+        new_player = self.new_player(name)
+        self.add_player(new_player)
         return new_player
 
-    def create_new_fake_player(self):
-        """Create a new player with random spanish name, and add it to the game
+    def add_player(self, player):
+        """Put a player in the game"""
+        self.players.add(player)
+        self.record_name(player.id, player.name)
+
+    def new_fake_player(self):
+        """A new player with random spanish name, not in the game yet
         He can not eat other players, but they can eat him. he is a bot.
         """
-
-        random_name = random.choice(
+        random_name = self.rng.choice(
             ["Hola, ¿Qué hora es?", "¿Y tú?", "Mucho gusto por favor", "¿Qué tal?", "Nos vemos", "Por favor", "Gracias",
              "De nada",
              "Disculpa", "No me gusta", "¿Cuánto cuesta?", "¿Dónde está el baño?", "¿Qué hora es?", "Me puede ayudar"])
-        fake_player = Player(random_name, 0, (100, 100))
-        self.players.append(fake_player)
-        self.all_game_objects.append(fake_player)
+        return Player(random_name, BOT_SLOT, BOT_POSITION)
+
+    def create_new_fake_player(self):
+        """Create the bot and add it to the game now, if it's not there. only the game's owner does that"""
+        if self.players.get(BOT_SLOT) is None:
+            self.add_player(self.new_fake_player())
+
+    def add_fake_player(self, bot):
+        """Put the bot in the game, unless it's there already"""
+        self.pending_bot = None
+        if self.players.get(BOT_SLOT) is None:
+            self.add_player(bot)
+
+    def queue_new_fake_player(self):
+        """
+        The bot joins on the next tick, if it's not on its way already.
+        :return: the bot that joins, so a client can be told about it right away
+        """
+        bot = self.pending_bot
+        if bot is None:
+            bot = self.pending_bot = self.new_fake_player()
+            self.queue_command(self.add_fake_player, bot)
+        return bot
 
     def update_player_position(self, player_id, position):
         """updates a given players' position"""
         self.get_player_by_ID(player_id).position = position
 
+    def queue_command(self, function, *args):
+        """Ask for function(*args) to change the game. it runs on the next tick, after whatever was asked before it"""
+        self.commands.append((function, args))
+
+    def queue_new_player(self, name):
+        """
+        A new player, with its id and position picked now, so the client can be answered right away.
+        It joins the game on the next tick.
+        """
+        new_player = self.new_player(name)
+        self.queue_command(self.add_player, new_player)
+        return new_player
+
+    def queue_removal(self, player_id):
+        """A player was eaten, or its client left. it's gone on the next tick"""
+        self.queue_command(self.remove_player, player_id)
+
+    def queue_input(self, player, position, mass):
+        """A client moved. it takes effect on the next tick"""
+        self.queue_command(self.apply_input, player, position, mass)
+
+    def queue_pallets_eaten(self, keys):
+        """A client ate these pallets (see PalletField.eat). they're gone on the next tick"""
+        self.queue_command(self.pallet_field.eat, keys)
+
+    def apply_input(self, player, position, mass):
+        """Where a client says its player is. ignored if the player is gone by now"""
+        if player in self.players:
+            player.position = position
+            player.mass = mass
+
+    def apply_commands(self):
+        """Apply every command queued since the last tick, in order. only the game's owner calls this"""
+        commands = self.commands
+        for _ in range(len(commands)):  # what comes in while we apply waits for the next tick
+            function, args = commands.popleft()
+            function(*args)
+
+    def step(self):
+        """Advance the world by one tick"""
+        self.apply_commands()
+        self.decrease_all_players_mass()
+        self.tick += 1
+        self.pallet_field.step(self.tick)
+        self.record_changes()
+
+    def record_changes(self):
+        """Remember who changed on this tick, so snapshots can carry only them"""
+        old_world_state = self.world_state
+        world_state = {}
+        changed_ids = set()
+        for player in self.players:
+            x, y = player.position
+            entry = (int(player.mass), x, y)
+            world_state[player.id] = entry
+            if old_world_state.get(player.id) != entry:
+                changed_ids.add(player.id)
+        left_ids = old_world_state.keys() - world_state.keys()
+        changed_ids.update(left_ids)
+
+        for player_id in changed_ids:
+            if player_id in left_ids:
+                self.grid.remove(player_id)
+            else:
+                _, x, y = world_state[player_id]
+                self.grid.move(player_id, (x, y))
+
+        self.world_state = MappingProxyType(world_state)  # handed out as is. the next tick makes a new one
+        self.changes_by_tick[self.tick] = changed_ids
+        self.changes_by_tick.pop(self.tick - SNAPSHOT_HISTORY_TICKS, None)
+
+    def changed_since(self, base_tick):
+        """
+        :return: ids of everyone that joined, changed or left after base_tick.
+        None if base_tick is too old to remember.
+        """
+        if base_tick == self.tick:
+            return set()
+        if base_tick + 1 not in self.changes_by_tick:
+            return None
+        return set().union(*(self.changes_by_tick[tick] for tick in range(base_tick + 1, self.tick + 1)))
+
+    def players_ids_in(self, viewport):
+        """ids of the players inside a viewport (x, y, width, height), as of the end of the last tick"""
+        x, y, width, height = viewport
+        visible_ids = set()
+        for player_id in self.grid.query_rect(x, y, x + width, y + height):
+            _, player_x, player_y = self.world_state[player_id]
+            if x <= player_x <= x + width and y <= player_y <= y + height:
+                visible_ids.add(player_id)
+        return visible_ids
+
+    def players_info(self):
+        """players_ids, players_masses, players_x, players_y, as of the end of the last tick"""
+        players_ids, players_masses, players_x, players_y = [], [], [], []
+        for player_id, (mass, x, y) in self.world_state.items():
+            players_ids.append(player_id)
+            players_masses.append(mass)
+            players_x.append(x)
+            players_y.append(y)
+        return players_ids, players_masses, players_x, players_y
+
     def decrease_all_players_mass(self):
         """Every second, every player's mass decreases by 0.97%"""
 
         for player in self.players:
             change_in_mass_every_second = player.mass * 0.01
-            change_in_mass_every_frame = change_in_mass_every_second / FPS
+            change_in_mass_every_frame = change_in_mass_every_second / self.tick_rate
             if player.mass - change_in_mass_every_frame < PLAYER_INITIAL_MASS:
                 continue
             else:
@@ -91,21 +245,50 @@ class Game:
         """
         :return: a random living player
         """
-        return self.players[random.randint(0, len(self.players) - 1)]
+        return self.rng.choice(list(self.players))
 
     def get_player_by_ID(self, player_id):
         """
         :param: player_id: id
-        :return: player with this id
+        :return: player with this id, None if there is no such player
         """
-        return self.players[player_id]
+        return self.players.get(player_id)
+
+    def remove_player(self, player_id):
+        """kill a player. :return: the player, None if there was no such player"""
+        player = self.players.remove(player_id)
+        if player is not None:
+            player.is_alive = False
+            self.record_name(player_id, None)
+        return player
+
+    def record_name(self, player_id, name):
+        """A player joined (with this name) or left (None). bumps the version of the names"""
+        self.names_version += 1
+        if name is None:
+            self.names.pop(player_id, None)
+        else:
+            self.names[player_id] = name
+        self.name_changes.append((self.names_version, player_id, name))
+
+    def names_changed_since(self, version):
+        """
+        :return: the current version of the names, and {player id: name, or None if it left} of whatever changed
+        after version. None instead of the changes if version is too old to remember.
+        """
+        if version is None or (self.name_changes and self.name_changes[0][0] > version + 1):
+            return self.names_version, None
 
-    def remove_player(self, index=None, player=None):
-        """kill a player"""
-        if index is not None:
-            self.players.pop(index)
-        elif player is not None:
-            self.players.remove(player)
+        changes = {}
+        for change_version, player_id, name in reversed(self.name_changes):
+            if change_version <= version:
+                break
+            changes.setdefault(player_id, name)  # only the latest change of every player matters
+        return self.names_version, changes
+
+    def names_table(self):
+        """players_ids, players_names of everyone in the game"""
+        return list(self.names.keys()), list(self.names.values())
 
 
 def start_connecting_clients(server):
@@ -129,132 +312,534 @@ def create_a_new_client_thread(server, client_socket):
     threads.append(thread)
 
 
-def handle_client(server: Server, client_socket):
-    """Handle all client requests"""
-    client_player = Player
-    is_client_alive = False
-    player_quit = False
-    while client_socket:
-        request = server.receive(client_socket)
-        operation_number, par1, par2 = protocol.split_request(request)
-        response = None
+class ClientSession:
+    """Everything the server remembers about one connected client, no matter how it is connected"""
+
+    def __init__(self, push):
+        """
+        initializer
+        :param push: push(frame) sends a frame the client did not ask for, without waiting.
+        """
+        self.push = push
+        self.player = None
+        self.quit = False
+
+        self.acked_tick = 0  # the last snapshot the client applied. deltas are built from it
+        self.last_keyframe_tick = 0
+        self.wants_keyframe = True
+
+        self.viewport = None  # what the client's camera shows, if it told us
+        self.visible_ids_by_tick = {}  # tick -> ids the client has after applying that tick's snapshot
+
+        self.names_version = None  # the version of the names the client has. None until it got all of them
+        self.pallet_chunks = {}  # chunk index -> version of it the client has, of the pallet chunks around it
+
+        self.udp_token = None  # see OPEN_UDP. None if the client didn't ask for UDP
+        self.udp_address = None  # where its last datagram came from. snapshots go there, once it's known
+        self.udp_received_sequence = 0  # the newest datagram it sent. older ones are dropped
+        self.udp_sent_sequence = 0
+
+        self.bytes_in = 0  # see stats.py
+        self.bytes_out = 0
+
+    def area_of_interest(self):
+        """The part of the map this client gets snapshots about: its viewport plus a margin"""
+        if self.viewport is not None:
+            x, y, width, height = self.viewport
+        elif self.is_alive():
+            x, y, width, height = viewport_around(self.player.position, self.player.mass)
+        else:
+            return 0, 0, game.width, game.height
+
+        return x - AOI_MARGIN, y - AOI_MARGIN, width + AOI_MARGIN * 2, height + AOI_MARGIN * 2
+
+    def is_alive(self):
+        """does the client still have a living player (or one that joins on the next tick)"""
+        return self.player is not None and self.player.is_alive
+
+
+def handle_request(session: ClientSession, request):
+    """
+    Handle a single client request.
+    :return: the response to send back, None if the request is broken.
+    """
+    start = time.perf_counter()
+    operation_number, payload = protocol.split_request(request)
+    response = None
+    try:
         if operation_number == Consts.Request.WELCOME_INFO:
+            players_ids, players_masses = [], []
+            for player_id, (mass, _, _) in game.world_state.items():
+                players_ids.append(player_id)
+                players_masses.append(mass)
+            players_names = names_of_players(players_ids)
+
             if not game.players:
-                game.create_new_fake_player()
-            players_ids, players_names, players_masses = [], [], []
-            for player in game.players:
-                players_ids.append(int(player.id))
-                players_names.append(player.name)
-                players_masses.append(int(player.mass))
-
-            response = protocol.build_response(
-                game.width, game.height, players_ids, players_names, players_masses
+                # nobody to watch. the bot only joins on the next tick, but the client needs somebody now
+                bot = game.queue_new_fake_player()
+                if bot.id not in players_ids:
+                    players_ids.append(bot.id)
+                    players_names.append(bot.name)
+                    players_masses.append(bot.mass)
+
+            response = protocol.build_welcome_info_response(
+                game.width, game.height, game.tick_rate, players_ids, players_names, players_masses
             )
 
         elif operation_number == Consts.Request.SPAWN_NEW_PLAYER:
-            new_player_name = par1
-            new_player = game.create_new_player(new_player_name)
-            client_player = new_player
-            is_client_alive = True
-            response = protocol.build_response(
+            new_player_name = protocol.decrypt_spawn_new_player_request(payload)
+            new_player = game.queue_new_player(new_player_name)
+            session.player = new_player
+            response = protocol.build_spawn_new_player_response(
                 new_player.id, new_player.mass, new_player.position[0], new_player.position[1]
             )
 
         elif operation_number == Consts.Update.MY_POSITION_AND_MASS:
-            if client_player in game.players:
-                update_x, update_y = par1.split(protocol.VALUE_SEPERATOR)
-                update_x, update_y = int(update_x), int(update_y)
-                update_mass = int(par2)
+            if session.is_alive():
+                update_x, update_y, update_mass = protocol.decrypt_position_and_mass_request(payload)
 
-                client_player.position = (update_x, update_y)
-                client_player.mass = update_mass
+                game.queue_input(session.player, (update_x, update_y), update_mass)
                 response = protocol.build_response(protocol.Consts.Confirm.CONFIRM)
             else:
                 response = protocol.build_response(protocol.Consts.Error.YOURE_DEAD)
 
         elif operation_number == Consts.Request.INFO:
-            players_ids, players_masses, players_x, players_y = [], [], [], []
-            for player in game.players:
-                players_ids.append(int(player.id))
-                players_masses.append(int(player.mass))
-                x, y = player.position
-                players_x.append(x)
-                players_y.append(y)
-
-            response = protocol.build_response(
-                players_ids, players_masses, players_x, players_y
-            )
+            response = protocol.build_info_response(*game.players_info())
 
-        elif operation_number == Consts.Request.NAMES:
-            requested_names_id_list = par1.split(protocol.VALUE_SEPERATOR)
-            requested_names_id_list = protocol.string_list_to_other_type_of_list(requested_names_id_list, int)
-            players_names = []
-            for requested_name_id in requested_names_id_list:
-                for player in game.players:
-                    if player.id == requested_name_id:
-                        players_names.append(player.name)
-                        break
+        elif operation_number == Consts.Request.SUBSCRIBE:
+            subscribers.add(session)
+            response = protocol.build_response(protocol.Consts.Confirm.CONFIRM)
 
-            response = protocol.build_response(players_names)
+        elif operation_number == Consts.Request.OPEN_UDP:
+            if datagram_server is not None and session.udp_token is None:
+                session.udp_token = secrets.randbits(64) or 1  # 0 means no UDP
+                udp_sessions[session.udp_token] = session
+            response = protocol.build_open_udp_response(session.udp_token or 0)
 
-        elif operation_number == Consts.Update.EAT:
-            eaten_players_id = par1.split(protocol.VALUE_SEPERATOR)
-            eaten_players_id = protocol.string_list_to_other_type_of_list(eaten_players_id, int)
-            for i, player in enumerate(game.players):
-                if player.id in eaten_players_id:
-                    game.remove_player(i)
-                    if player == client_player:
-                        client_player = Player
-                        is_client_alive = False
+        elif operation_number == Consts.Update.ACK:
+            acked_tick = protocol.decrypt_ack_request(payload)
+            if session.acked_tick < acked_tick <= game.tick:
+                session.acked_tick = acked_tick
+            response = NO_RESPONSE
+
+        elif operation_number == Consts.Update.REQUEST_KEYFRAME:
+            session.wants_keyframe = True
+            response = NO_RESPONSE
+
+        elif operation_number == Consts.Update.VIEWPORT:
+            session.viewport = protocol.decrypt_viewport_request(payload)
+            response = NO_RESPONSE
+
+        elif operation_number == Consts.Request.NAMES:
+            requested_names_id_list = protocol.decrypt_ids_request(payload)
+            response = protocol.build_names_response(names_of_players(requested_names_id_list))
 
+        elif operation_number == Consts.Update.EAT:
+            eaten_players_id = protocol.decrypt_ids_request(payload)
+            eat_players(eaten_players_id)
             response = protocol.build_response(protocol.Consts.Confirm.CONFIRM)
 
+        elif operation_number == Consts.Request.SYNC:
+            has_position, update_x, update_y, update_mass, eaten_players_id, eaten_pallets_keys = \
+                protocol.decrypt_sync_request(payload)
+            eat_players(eaten_players_id)
+            is_alive = session.is_alive()
+            if has_position and is_alive:
+                game.queue_input(session.player, (update_x, update_y), update_mass)
+            if eaten_pallets_keys and is_alive:  # the position may be coming over UDP
+                game.queue_pallets_eaten(eaten_pallets_keys)
+            response = protocol.build_sync_response(is_alive)
+
         elif operation_number == Consts.Update.QUIT:
-            if is_client_alive:
-                game.remove_player(player=client_player)
+            handle_disconnect(session)
             response = protocol.build_response(protocol.Consts.Confirm.CONFIRM)
-            player_quit = True
+            session.quit = True
+    except protocol.DECODE_ERRORS:  # a whole frame, but what's in it is not what this operation has
+        response = None
 
-        if response is not None:
-            # with lock:
-            server.send(
-                client_socket,
-                response
-            )
-        else:
-            print("WOW!!!!!! ERORRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRR")
-            print(request)
-            print(operation_number, par1, par2)
+    if response is None:
+        stats.record_broken_request()
+        print("WOW!!!!!! ERORRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRR")
+        print(request)
+        print(operation_number, payload)
+    else:
+        stats.record_request(session, operation_number, len(request), len(response), time.perf_counter() - start)
+    return response
+
+
+def names_of_players(players_ids):
+    """the name of every player id. a name for every id ("" for gone players), or the client matches them wrong"""
+    players_names = []
+    for player_id in players_ids:
+        player = game.get_player_by_ID(player_id)
+        players_names.append(player.name if player is not None else "")
+    return players_names
+
+
+def eat_players(eaten_players_id):
+    """The client's player ate these players. their clients find out on their next SYNC after the tick"""
+    for eaten_player_id in eaten_players_id:
+        game.queue_removal(eaten_player_id)
+
+
+def handle_datagram(datagram, address):
+    """A datagram from a client's UDP channel (see OPEN_UDP). unknown tokens and older datagrams are dropped"""
+    token, sequence, request = protocol.split_datagram(datagram)
+    session = udp_sessions.get(token)
+    if session is None or sequence <= session.udp_received_sequence:
+        return
+    operation_number, _ = protocol.decrypt_header(request)
+    if operation_number not in protocol.DATAGRAM_OPERATIONS:
+        return
+    session.udp_received_sequence = sequence
+    session.udp_address = address  # may change on the way (NAT), the newest one is where the client is
+    handle_request(session, request)  # the response, if there is one, is not sent. nobody waits for it
+
+
+def handle_disconnect(session: ClientSession):
+    """The client is gone, take its player with it"""
+    subscribers.discard(session)
+    udp_sessions.pop(session.udp_token, None)
+    if session.is_alive():
+        game.queue_removal(session.player.id)
+    session.player = None
 
-        if player_quit:
-            client_socket.close()
-            client_socket = None
+
+def handle_client(server: Server, client_socket):
+    """Handle all client requests"""
+    connection = server.connection(client_socket)  # responses are sent from here, snapshots from the tick loop
+
+    def send(data):
+        """send a response, it waits for the client"""
+        try:
+            connection.send(data)
+        except OSError:
+            pass  # it's gone. the next receive finds out
+
+    session = ClientSession(push=connection.push)
+    sessions.add(session)
+    frame_reader = server.frame_reader(client_socket)
+    try:
+        while not session.quit:
+            request = server.receive(frame_reader)
+            if not request:
+                break  # client disconnected without saying goodbye
+
+            response = handle_request(session, request)
+            if response:
+                send(response)
+    finally:  # whatever happened, the client is gone and so is its player
+        handle_disconnect(session)
+        sessions.discard(session)
+        client_socket.close()
     print("now i dont handle client anymore :(")
 
 
+async def handle_client_async(server: AsyncServer, reader, writer):
+    """Handle all client requests, on the event loop. no thread per client here"""
+    session = ClientSession(push=lambda data: server.push(writer, data))
+    sessions.add(session)
+    try:
+        while not session.quit:
+            request = await server.receive(reader)
+            if not request:
+                break  # client disconnected without saying goodbye
+
+            response = handle_request(session, request)
+            if response:
+                await server.send(writer, response)
+    finally:  # whatever happened, the client is gone and so is its player
+        handle_disconnect(session)
+        sessions.discard(session)
+
+
+def viewport_around(position, mass):
+    """The part of the map a client's camera shows around its player, sized the same way Camera.update_size does"""
+    player_size = (mass * 2 / math.pi) ** 0.5
+    height = max(game.height // 10, player_size * 3)
+    width = height * ASPECT_RATIO
+    x, y = position
+    return x - width / 2, y - height / 2, width, height
+
+
+def build_snapshot(session):
+    """
+    The snapshot for one client: only the players in its area of interest.
+    A delta from the tick it acknowledged when possible, a keyframe otherwise.
+    """
+    visible_ids = game.players_ids_in(session.area_of_interest())
+    acked_tick = session.acked_tick  # read once, handler threads may acknowledge while we build
+
+    changed_ids = None
+    keyframe_is_due = game.tick - session.last_keyframe_tick >= KEYFRAME_INTERVAL
+    if acked_tick in session.visible_ids_by_tick and not session.wants_keyframe and not keyframe_is_due:
+        changed_ids = game.changed_since(acked_tick)
+
+    if changed_ids is None:
+        base_tick = 0
+        players_ids = list(visible_ids)
+        removed_players_ids = []
+        session.wants_keyframe = False
+        session.last_keyframe_tick = game.tick
+    else:
+        base_tick = acked_tick
+        sent_visible_ids = [ids for tick, ids in session.visible_ids_by_tick.items() if tick >= base_tick]
+        # a snapshot sent after the base may have removed a player that's back now (the client may have applied it),
+        # so only players visible in the base and in every snapshot since are surely still with the client
+        surely_known_ids = set.intersection(*sent_visible_ids)
+        players_ids = [player_id for player_id in visible_ids
+                       if player_id in changed_ids or player_id not in surely_known_ids]
+        # the client may have anyone we sent since its base tick. whoever is not visible anymore has to go
+        maybe_known_ids = set().union(*sent_visible_ids)
+        removed_players_ids = list(maybe_known_ids - visible_ids)
+
+    for tick in [tick for tick in session.visible_ids_by_tick
+                 if tick < acked_tick or tick <= game.tick - SNAPSHOT_HISTORY_TICKS]:
+        del session.visible_ids_by_tick[tick]
+    session.visible_ids_by_tick[game.tick] = visible_ids
+
+    players_masses, players_x, players_y = [], [], []
+    for player_id in players_ids:
+        mass, x, y = game.world_state[player_id]
+        players_masses.append(mass)
+        players_x.append(x)
+        players_y.append(y)
+    return protocol.build_snapshot(game.tick, base_tick, players_ids, players_masses, players_x, players_y,
+                                   removed_players_ids)
+
+
+def build_names_update(session):
+    """
+    The changes to the names since the version the client has. all of them if it has none, or is too far behind.
+    :return: the version the client will have after it, and the update. b"" if nothing changed.
+    """
+    names_version, changes = game.names_changed_since(session.names_version)
+    if changes is None:
+        players_ids, players_names = game.names_table()
+        return names_version, protocol.build_names_update(names_version, True, players_ids, players_names, [])
+    if not changes:
+        return names_version, b""
+
+    players_ids, players_names, left_players_ids = [], [], []
+    for player_id, name in changes.items():
+        if name is None:
+            left_players_ids.append(player_id)
+        else:
+            players_ids.append(player_id)
+            players_names.append(name)
+    return names_version, protocol.build_names_update(names_version, False, players_ids, players_names,
+                                                      left_players_ids)
+
+
+def build_pallets_update(session):
+    """
+    The pallet chunks around the client that changed since it got them, and the ones it doesn't need anymore.
+    Everything again with every snapshot keyframe, so a client that missed something catches up.
+    Call it after build_snapshot.
+    :return: the session's pallet_chunks once the client gets the update, and the update (b"" if nothing changed).
+    the session keeps what it had until the update was pushed, see push_snapshot
+    """
+    pallet_field = game.pallet_field
+    if session.last_keyframe_tick == game.tick:
+        pallet_chunks = dict.fromkeys(session.pallet_chunks)  # known, but as if we never sent them
+    else:
+        pallet_chunks = session.pallet_chunks.copy()
+    if session.viewport is None and not session.is_alive():
+        wanted_chunks = []  # its area of interest is the whole map. no pallets until it tells us where it looks
+    else:
+        wanted_chunks = pallet_field.chunks_in(session.area_of_interest())
+
+    chunk_updates = []
+    for chunk_index in wanted_chunks:
+        chunk = pallet_field.get_chunk(chunk_index)
+        known_version = pallet_chunks.get(chunk_index)
+        version = chunk.version
+        if known_version == version:
+            continue
+        pallets, eaten_slots = chunk.changes_since(known_version)
+        chunk_updates.append((chunk_index, version, known_version is None, pallets, eaten_slots))
+        pallet_chunks[chunk_index] = version
+
+    dropped_chunks = []
+    if len(pallet_chunks) > len(wanted_chunks):
+        wanted_chunks = set(wanted_chunks)
+        dropped_chunks = [chunk_index for chunk_index in pallet_chunks if chunk_index not in wanted_chunks]
+        for chunk_index in dropped_chunks:
+            del pallet_chunks[chunk_index]
+
+    if not chunk_updates and not dropped_chunks:
+        return pallet_chunks, b""
+    return pallet_chunks, protocol.build_pallets_update(dropped_chunks, chunk_updates)
+
+
+def run_tick():
+    """One tick of the server: advance the world, then push the result to everyone who subscribed"""
+    start = time.perf_counter()
+    game.step()
+    if replay_writer is not None:
+        replay_writer.record(game)
+    for session in subscribers.copy():  # handler threads may subscribe while we push
+        push_snapshot(session, build_snapshot(session), *build_pallets_update(session))
+    stats.record_tick(time.perf_counter() - start)
+
+    if stats_log_interval and time.perf_counter() - stats.last_log_time >= stats_log_interval:
+        print(stats.log_line(len(sessions), len(game.players), game.tick))
+
+
+def push_snapshot(session, snapshot, pallet_chunks=None, pallets_update=b""):
+    """
+    Push a tick's snapshot and pallets update to a client, with whatever names changed in front of them.
+    The snapshot goes over UDP if the client has it working and it fits, the rest always over TCP.
+    :param pallet_chunks: what the session's pallet_chunks are once the client gets the pallets update
+    :return: False if the push over TCP was dropped (the client doesn't keep up)
+    """
+    names_version, names_update = build_names_update(session)
+    over_udp = session.udp_address is not None and \
+        len(snapshot) + protocol.DATAGRAM.size <= protocol.MAX_DATAGRAM_SIZE
+
+    # names first, so the client knows whoever the snapshot shows. one push, one send
+    frame = names_update + (b"" if over_udp else snapshot) + pallets_update
+    is_pushed = not frame or session.push(frame)
+    if frame and is_pushed:
+        session.names_version = names_version  # if the push was dropped, these changes go again next tick
+        if pallet_chunks is not None:
+            session.pallet_chunks = pallet_chunks
+        stats.record_push(session, len(frame))
+
+    if over_udp:
+        session.udp_sent_sequence += 1
+        datagram = protocol.build_datagram(session.udp_token, session.udp_sent_sequence, snapshot)
+        datagram_server.send(datagram, session.udp_address)
+        stats.record_push(session, len(datagram))
+    return is_pushed
+
+
+def stats_text():
+    """the stats endpoint's text report"""
+    return stats.to_text(sessions.copy(), len(game.players), game.tick)
+
+
+def stats_dict():
+    """the stats endpoint's JSON report"""
+    return stats.to_dict(sessions.copy(), len(game.players), game.tick)
+
+
 threads = []
-lock = threading.Lock()
+subscribers = set()
+sessions = set()  # every connected client
+datagram_server = None  # a DatagramServer or AsyncDatagramServer, if the server was started with --udp
+udp_sessions = {}  # UDP token -> the ClientSession it was given to
+replay_writer = None  # a ReplayWriter, if the server was started with --record-replay
+stats = ServerStats(protocol.OPERATION_NAMES)
 
 # CONSTANTS
 FPS = 10
+SNAPSHOT_HISTORY_TICKS = 64  # how far back a client may acknowledge and still get a delta
+KEYFRAME_INTERVAL = 100  # every client gets a full snapshot at least this often (in ticks)
+NAME_CHANGES_HISTORY = 1024  # how many joins and leaves the server remembers. clients further behind get all names
+NO_RESPONSE = b""
+ASPECT_RATIO = 16 / 9  # same as the client's screen
+AOI_CELL_SIZE = 50  # size of a spatial grid cell, in game units
+AOI_MARGIN = 40  # clients also get players this far outside of their viewport
 GAME_WIDTH, GAME_HEIGHT = 700, 700
+BOT_POSITION = (100, 100)
+MAX_CLIENTS = 10000
+STATS_PORT = 8822  # local HTTP port with the server's stats, see stats.py
+STATS_LOG_INTERVAL = 10  # seconds between stats log lines
+stats_log_interval = STATS_LOG_INTERVAL
 
-game = Game(GAME_WIDTH, GAME_HEIGHT)
+game = Game(GAME_WIDTH, GAME_HEIGHT, FPS)
 game.create_new_fake_player()  # for entertainment
 
 
-def main():
-    global game
+def run_threaded_server(use_udp):
+    """One thread per client. the game is shared between all of them"""
+    global datagram_server
     server = Server(host="0.0.0.0", port=protocol.PORT)
+    if use_udp:
+        datagram_server = DatagramServer(host="0.0.0.0", port=protocol.PORT)
+        threading.Thread(target=datagram_server.serve, args=[handle_datagram], daemon=True).start()
     print("Server is up up and running!")
 
     start_connecting_clients(server)
 
-    pygame.init()
-    clock = pygame.time.Clock()
+    tick_duration = 1 / game.tick_rate
+    next_tick_time = time.perf_counter()
+    while True:
+        run_tick()
+        next_tick_time += tick_duration
+        delay = next_tick_time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            stats.record_overrun()
+            next_tick_time = time.perf_counter()  # we are late. don't try to catch up with a burst of ticks
+
+
+async def run_asyncio_server(max_clients, use_udp):
+    """Every client on one event loop. the game is only ever touched from this loop"""
+    global datagram_server
+    server = AsyncServer(host="0.0.0.0", port=protocol.PORT, max_clients=max_clients)
+    await server.start(handle_client_async)
+    if use_udp:
+        datagram_server = AsyncDatagramServer(host="0.0.0.0", port=protocol.PORT)
+        await datagram_server.start(handle_datagram)
+    print("Server is up up and running! (asyncio)")
+
+    loop = asyncio.get_running_loop()
+    tick_duration = 1 / game.tick_rate
+    next_tick_time = loop.time()
     while True:
-        game.decrease_all_players_mass()
-        clock.tick(FPS)
+        run_tick()
+        next_tick_time += tick_duration
+        delay = next_tick_time - loop.time()
+        if delay < 0:
+            stats.record_overrun()
+            next_tick_time = loop.time()  # we are late. don't try to catch up with a burst of ticks
+        await asyncio.sleep(max(0.0, delay))
+
+
+def build_argument_parser():
+    """the server's command line arguments. sharded_server.py adds its own to them"""
+    parser = argparse.ArgumentParser(description="agar.io clone server")
+    parser.add_argument("--asyncio", action="store_true",
+                        help="serve every client from a single asyncio event loop instead of a thread per client")
+    parser.add_argument("--max-clients", type=int, default=MAX_CLIENTS,
+                        help="asyncio mode: connections above this are refused")
+    parser.add_argument("--tick-rate", type=int, default=FPS,
+                        help="simulation ticks (and snapshots pushed to every client) per second")
+    parser.add_argument("--stats-port", type=int, default=STATS_PORT,
+                        help="serve stats on http://127.0.0.1:PORT/ (text) and /json. 0 to turn off")
+    parser.add_argument("--stats-log-interval", type=float, default=STATS_LOG_INTERVAL,
+                        help="seconds between stats log lines. 0 to turn off")
+    parser.add_argument("--udp", action="store_true",
+                        help="also listen on UDP, for clients that want positions and snapshots over it (OPEN_UDP)")
+    parser.add_argument("--record-replay", metavar="PATH",
+                        help="append every tick's players to a replay log, to watch later with replay.py")
+    parser.add_argument("--map-width", type=int, default=GAME_WIDTH)
+    parser.add_argument("--map-height", type=int, default=GAME_HEIGHT)
+    return parser
+
+
+def parse_arguments():
+    """command line arguments"""
+    return build_argument_parser().parse_args()
+
+
+def main():
+    global game, stats_log_interval, replay_writer
+    arguments = parse_arguments()
+    game = Game(arguments.map_width, arguments.map_height, arguments.tick_rate)
+    game.create_new_fake_player()
+    if arguments.record_replay:
+        replay_writer = ReplayWriter(arguments.record_replay, game)
+    stats_log_interval = arguments.stats_log_interval
+    if arguments.stats_port:
+        start_stats_server(arguments.stats_port, stats_text, stats_dict)
+    if arguments.asyncio:
+        asyncio.run(run_asyncio_server(arguments.max_clients, arguments.udp))
+    else:
+        run_threaded_server(arguments.udp)
 
 
 if __name__ == '__main__':
@@ -1,4 +1,18 @@
+import asyncio
 import socket
+import threading
+import time
+
+import protocol
+
+MAX_REQUEST_PAYLOAD = 64 * 1024
+"""clients never need to send more than this in one request. anything bigger is a broken client"""
+MAX_PENDING_PUSH_BYTES = 256 * 1024
+"""a client that has this much waiting to be sent to it is too slow. pushed frames to it are dropped"""
+MAX_STUCK_SECONDS = 10
+"""threaded server: a client that didn't read anything pushed to it for this long is disconnected"""
+PUSH_FLAGS = getattr(socket, "MSG_DONTWAIT", 0)
+"""send without waiting. where there is no such flag (Windows), pushes wait like everything else"""
 
 
 class Server:
@@ -20,19 +34,224 @@ class Server:
     def connect_client(self):
         """Wait for a client to connect"""
         client_socket, client_address = self.socket.accept()
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # every frame is small, and waited for
         return client_socket, client_address
 
     def close(self):
         """Close server socket"""
         self.socket.close()
 
-    def receive(self, client_socket, receive_in_bytes=False, num_of_bytes=1024):
-        """Wait for client to send data"""
-        if receive_in_bytes:
-            return client_socket.recv(num_of_bytes)
-        else:
-            return client_socket.recv(num_of_bytes).decode()
+    def frame_reader(self, client_socket):
+        """The receive buffer of a client, for receive. one for every client, for as long as it's connected"""
+        return protocol.FrameReader(client_socket, MAX_REQUEST_PAYLOAD)
+
+    def receive(self, frame_reader):
+        """
+        Wait for client to send a whole frame. returns b"" if the client disconnected.
+        the frame is a view of the client's buffer, good until the next receive
+        """
+        try:
+            return frame_reader.receive_frame()
+        except OSError:
+            return b""
 
     def send(self, client_socket, data):
-        """Send data to client"""
-        client_socket.send(data.encode())
+        """Send a whole frame to client"""
+        client_socket.sendall(data)
+
+    def connection(self, client_socket):
+        """How to send to a client: responses with send, frames it didn't ask for with push"""
+        return Connection(client_socket)
+
+
+class Connection:
+    """
+    A client's socket in the threaded server, for sending. responses wait for the client, pushes never do:
+    the tick pushes to everyone, one client that doesn't read must not hold it up.
+    """
+    def __init__(self, client_socket):
+        """Initializer"""
+        self.socket = client_socket
+        self.lock = threading.Lock()  # the client's thread sends responses, the tick pushes
+        self.pending = bytearray()  # what was pushed, but didn't fit in the socket's buffer yet. whole frames after
+        self.stuck_since = None  # when pushes started being dropped, None while the client keeps up
+
+    def send(self, data):
+        """Send a whole frame to client, after whatever pushes are still pending. waits if the client doesn't read"""
+        with self.lock:
+            if self.pending:
+                self.socket.sendall(self.pending)
+                self.pending.clear()
+                self.stuck_since = None
+            self.socket.sendall(data)
+
+    def push(self, data):
+        """
+        Send a frame the client did not ask for, without waiting. the part that doesn't fit waits in pending,
+        and goes out with the next push or send.
+        :return: False if the frame was dropped because the client does not keep up.
+        """
+        if not self.lock.acquire(blocking=False):
+            return False  # the client's thread is sending it a response. this one can go next tick
+        try:
+            if self.pending:
+                self.pending = self.pending[self.send_some(self.pending):]
+            if len(self.pending) + len(data) > MAX_PENDING_PUSH_BYTES:
+                self.drop_push()
+                return False
+            self.stuck_since = None
+            if self.pending:
+                self.pending += data  # behind the rest, or the frames get mixed up
+            else:
+                self.pending = bytearray(data[self.send_some(data):])
+            return True
+        except OSError:
+            return False  # it's gone. its thread finds out and cleans up
+        finally:
+            self.lock.release()
+
+    def send_some(self, data):
+        """Send as much of data as the socket takes right now. :return: how much it took"""
+        try:
+            return self.socket.send(data, PUSH_FLAGS)
+        except BlockingIOError:
+            return 0
+
+    def drop_push(self):
+        """A push didn't fit. if the client hasn't read anything for too long, disconnect it"""
+        now = time.monotonic()
+        if self.stuck_since is None:
+            self.stuck_since = now
+        elif now - self.stuck_since > MAX_STUCK_SECONDS:
+            self.socket.shutdown(socket.SHUT_RDWR)  # its thread's receive ends, and it cleans up as usual
+
+
+class AsyncServer:
+    """asyncio socket server. Every client is a coroutine on one event loop instead of a thread"""
+    def __init__(self, host, port, max_clients):
+        """Initializer"""
+        self.host = host
+        self.port = port
+        self.max_clients = max_clients
+        self.connected_clients = 0
+        self.server = None
+
+    async def start(self, handle_client):
+        """Start listening. handle_client(server, reader, writer) is awaited for every new client"""
+        async def serve_client(reader, writer):
+            """Refuse clients over the limit, and always clean up after the ones we served"""
+            if self.connected_clients >= self.max_clients:
+                writer.close()
+                return
+
+            self.connected_clients += 1
+            # asyncio turns Nagle off by itself these days, but every frame here is small and waited for
+            writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            try:
+                await handle_client(self, reader, writer)
+            finally:
+                self.connected_clients -= 1
+                writer.close()
+
+        self.server = await asyncio.start_server(serve_client, self.host, self.port, backlog=1024)
+
+    def close(self):
+        """Stop listening"""
+        self.server.close()
+
+    async def receive(self, reader):
+        """Wait for client to send a whole frame. returns b"" if the client disconnected"""
+        try:
+            header = await reader.readexactly(protocol.HEADER.size)
+            operation_number, payload_length = protocol.decrypt_header(header)
+            if operation_number is None or payload_length > MAX_REQUEST_PAYLOAD:
+                return b""
+            return header + await reader.readexactly(payload_length)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return b""
+
+    async def send(self, writer, data):
+        """Send a whole frame to client. waits if the client does not keep up, so nothing piles up in memory"""
+        writer.write(data)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    def push(self, writer, data):
+        """
+        Send a frame the client did not ask for, without waiting.
+        :return: False if the frame was dropped because the client does not keep up.
+        """
+        if writer.is_closing() or writer.transport.get_write_buffer_size() > MAX_PENDING_PUSH_BYTES:
+            return False
+        writer.write(data)
+        return True
+
+
+class DatagramServer:
+    """UDP socket server, for what's fine to lose. there are no connections, every datagram is on its own"""
+    def __init__(self, host, port):
+        """Initializer"""
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((host, port))
+        self.buffer = bytearray(protocol.MAX_DATAGRAM_SIZE)
+        self.view = memoryview(self.buffer)
+
+    def serve(self, handle_datagram):
+        """
+        Receive datagrams forever.
+        handle_datagram(datagram, address) gets a view of the receive buffer, good until it returns
+        """
+        while True:
+            try:
+                size, address = self.socket.recvfrom_into(self.buffer)
+            except ConnectionError:
+                continue  # a client we sent to is gone. it's UDP, nobody else cares
+            try:
+                handle_datagram(self.view[:size], address)
+            except Exception as error:  # one broken datagram must not stop UDP for every client
+                print(f"broken datagram from {address}: {error!r}")
+
+    def send(self, data, address):
+        """Send a datagram. if it's lost, it's lost"""
+        try:
+            self.socket.sendto(data, address)
+        except OSError:
+            pass
+
+    def close(self):
+        """Close server socket"""
+        self.socket.close()
+
+
+class AsyncDatagramServer(asyncio.DatagramProtocol):
+    """asyncio UDP socket server, on the same event loop as the AsyncServer"""
+    def __init__(self, host, port):
+        """Initializer"""
+        self.host = host
+        self.port = port
+        self.transport = None
+        self.handle_datagram = None
+
+    async def start(self, handle_datagram):
+        """Start listening. handle_datagram(datagram, address) is called for every datagram"""
+        self.handle_datagram = handle_datagram
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self, local_addr=(self.host, self.port))
+
+    def connection_made(self, transport):
+        """asyncio tells us the socket is ready"""
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        """asyncio got a datagram"""
+        self.handle_datagram(data, address)
+
+    def send(self, data, address):
+        """Send a datagram. if it's lost, it's lost"""
+        self.transport.sendto(data, address)
+
+    def close(self):
+        """Stop listening"""
+        self.transport.close()
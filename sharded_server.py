@@ -0,0 +1,573 @@
+"""
+The server with the map split into regions (vertical strips), each one simulated by a worker process of its own,
+so a single big map can use more than one core.
+
+The front process (Router) has every client's socket, hands out player ids and names, and keeps the tick clock.
+Whatever else a client sends goes to the shard that has the client. A shard (ShardWorker) runs the usual
+server.Game and server.handle_request for its region, and builds the snapshots of its clients.
+- A player that crosses into another region is handed off to that region's shard, together with its client.
+- Players near a border are mirrored to the shard on the other side every tick, so clients there see them
+  and can eat them. eating a mirror is sent on to the shard that owns the player.
+- Shards tick in lockstep: the front tells all of them to tick, and only ticks again once all of them are done.
+- Every shard has the pallets of the whole map, from the same seed (see pallet_field.py). pallets eaten in one
+  shard are eaten in all of them.
+
+Clients see no difference, except that INFO only has the players of their shard (and its mirrors).
+
+python3 sharded_server.py --shards 4 --map-width 2800
+"""
+import asyncio
+import itertools
+import multiprocessing
+import os
+import queue
+import random
+import signal
+import threading
+import time
+
+import protocol
+from protocol import Consts
+import server
+from server_server import AsyncServer
+from player_registry import PlayerRegistry, BOT_SLOT
+from stats import start_stats_server
+
+# Messages go both ways as lists of tuples, one list for everything a side has to send at once.
+# front -> shard: ("connect", client id), ("disconnect", client id), ("request", client id, request),
+#                 ("spawn", client id, player id, name, position), ("adopt", client id, handoff state),
+#                 ("mirror", from shard, rows), ("kill", player ids), ("pallets_eaten", keys), ("tick",),
+#                 ("dropped", client id)
+# shard -> front: ("response", client id, response), ("push", client id, snapshot),
+#                 ("handoff", client id, to shard, handoff state), ("mirror", to shard, rows),
+#                 ("kill", player ids), ("pallets_eaten", keys), ("left", player ids), ("reroute", message),
+#                 ("tick_done",)
+# a handoff state is (player id, name, mass, position, viewport, is subscribed), a mirror row (player id, mass, x, y)
+
+
+def region_of(index, shards_count, width):
+    """the x range [start, end) of the map a shard owns"""
+    return width * index // shards_count, width * (index + 1) // shards_count
+
+
+def shard_of(x, shards_count, width):
+    """the index of the shard that owns this x. outside of the map goes to the shard at its edge"""
+    return min(max(0, int(x * shards_count // width)), shards_count - 1)
+
+
+class ShardWorker:
+    """One region of the map, in a process of its own. it only ever talks to the front, through connection"""
+
+    def __init__(self, index, shards_count, width, height, tick_rate, seed, bot_name, connection):
+        """initializer"""
+        self.index = index
+        self.shards_count = shards_count
+        self.region = region_of(index, shards_count, width)
+        self.connection = connection
+        self.outbox = []  # messages to the front. sent together once everything that came in is handled
+
+        self.sessions = {}  # client id -> ClientSession of every client this shard has
+        self.owned_ids = set()  # the players this shard simulates
+        self.mirrored_ids = {}  # neighbouring shard -> ids of its players we have a copy of
+        self.recently_killed = {}  # player id -> tick it was eaten. late mirrors and handoffs of it are ignored
+
+        # this process has a server module of its own: handle_request and build_snapshot work on this game
+        server.game = server.Game(width, height, tick_rate, rng=random.Random(seed))  # the same pallets everywhere
+        server.game.players = PlayerRegistry(hands_out_ids=False)  # the front hands out the ids
+        server.subscribers = set()
+        if shard_of(server.BOT_POSITION[0], shards_count, width) == index:
+            self.add_owned_player(server.Player(bot_name, BOT_SLOT, server.BOT_POSITION))
+
+    def run(self):
+        """Handle whatever the front sends, until the front is gone"""
+        while True:
+            try:
+                messages = self.connection.recv()
+            except EOFError:
+                return
+            for message in messages:
+                self.handle_message(message)
+            if self.outbox:
+                self.connection.send(self.outbox)
+                self.outbox = []
+
+    def handle_message(self, message):
+        """one message from the front"""
+        kind = message[0]
+        if kind == "request":
+            _, client_id, request = message
+            session = self.sessions.get(client_id)
+            if session is None:
+                self.outbox.append(("reroute", message))  # the client was handed off, the front didn't know yet
+                return
+            response = server.handle_request(session, request)
+            if response != server.NO_RESPONSE:
+                self.outbox.append(("response", client_id, response))
+            if session.quit:
+                del self.sessions[client_id]
+
+        elif kind == "tick":
+            self.run_tick()
+
+        elif kind == "mirror":
+            _, from_shard, rows = message
+            self.apply_mirror(from_shard, rows)
+
+        elif kind == "spawn":
+            _, client_id, player_id, name, position = message
+            session = self.sessions.get(client_id)
+            if session is None:
+                self.outbox.append(("reroute", message))
+                return
+            session.player = server.Player(name, player_id, position)
+            self.add_owned_player(session.player)
+            self.hand_off_if_outside(client_id, session)
+
+        elif kind == "adopt":
+            _, client_id, state = message
+            self.adopt(client_id, state)
+
+        elif kind == "kill":
+            self.kill(message[1])
+
+        elif kind == "pallets_eaten":
+            server.game.pallet_field.eat(message[1], remember=False)
+
+        elif kind == "connect":
+            _, client_id = message
+            self.sessions[client_id] = server.ClientSession(push=self.pusher(client_id))
+
+        elif kind == "disconnect":
+            _, client_id = message
+            session = self.sessions.pop(client_id, None)
+            if session is None:
+                self.outbox.append(("reroute", message))
+                return
+            server.handle_disconnect(session)
+
+        elif kind == "dropped":
+            _, client_id = message
+            session = self.sessions.get(client_id)
+            if session is not None:  # handed off: the next shard sends it every chunk anyway
+                # we can't tell which of the pallets updates since got there. it gets its chunks all over again
+                session.pallet_chunks = dict.fromkeys(session.pallet_chunks)
+
+    def pusher(self, client_id):
+        """
+        the push of a client's session: snapshots go to the front, which adds the names and sends them.
+        the front can't answer right away if it sent them. when it didn't, it tells us with a "dropped"
+        """
+
+        def push(frame):
+            """push a frame to the client"""
+            self.outbox.append(("push", client_id, frame))
+            return True
+
+        return push
+
+    def add_owned_player(self, player):
+        """A player is ours now. if it was a mirror until now, the real one replaces it"""
+        for mirrored_ids in self.mirrored_ids.values():
+            mirrored_ids.discard(player.id)
+        server.game.players.add(player)
+        self.owned_ids.add(player.id)
+
+    def hand_off_if_outside(self, client_id, session):
+        """If the client's player is in another shard's region now, give the client and its player to that shard"""
+        player = session.player
+        shard_index = shard_of(player.position[0], self.shards_count, server.game.width)
+        if shard_index == self.index:
+            return
+
+        # we keep a mirror of the player: it's right at the border, and the other shard will mirror it back to us
+        self.owned_ids.discard(player.id)
+        self.mirrored_ids.setdefault(shard_index, set()).add(player.id)
+        del self.sessions[client_id]
+        is_subscribed = session in server.subscribers
+        server.subscribers.discard(session)
+        state = (player.id, player.name, player.mass, player.position, session.viewport, is_subscribed)
+        self.outbox.append(("handoff", client_id, shard_index, state))
+
+    def adopt(self, client_id, state):
+        """A client and its player came from another shard"""
+        player_id, name, mass, position, viewport, is_subscribed = state
+        session = server.ClientSession(push=self.pusher(client_id))  # it gets a keyframe from us first
+        session.viewport = viewport
+        self.sessions[client_id] = session
+        if is_subscribed:
+            server.subscribers.add(session)
+        if player_id in self.recently_killed:
+            return  # eaten on the way
+
+        session.player = server.Player(name, player_id, position)
+        session.player.mass = mass
+        self.add_owned_player(session.player)
+        self.hand_off_if_outside(client_id, session)  # a spawn far away may have to go further
+
+    def apply_mirror(self, from_shard, rows):
+        """The players of a neighbouring shard that are near our border, as of its last tick"""
+        server.game.apply_commands()  # the eats our clients asked for since the tick, before the mirror moves them
+        self.find_eaten_mirrors()  # before a mirror brings them back
+        mirrored_ids = set()
+        for player_id, mass, x, y in rows:
+            if player_id in self.owned_ids or player_id in self.recently_killed:
+                continue
+            mirrored_ids.add(player_id)
+            player = server.game.players.get(player_id)
+            if player is None:
+                player = server.Player("", player_id, (x, y))
+                server.game.players.add(player)
+            player.position = (x, y)
+            player.mass = mass
+
+        for player_id in self.mirrored_ids.get(from_shard, set()) - mirrored_ids:
+            server.game.players.remove(player_id)
+        self.mirrored_ids[from_shard] = mirrored_ids
+
+    def find_eaten_mirrors(self):
+        """Mirrors our clients ate are gone from the game. tell the shards that own them"""
+        eaten_ids = []
+        for mirrored_ids in self.mirrored_ids.values():
+            for player_id in [player_id for player_id in mirrored_ids if server.game.players.get(player_id) is None]:
+                mirrored_ids.discard(player_id)
+                self.recently_killed[player_id] = server.game.tick
+                eaten_ids.append(player_id)
+        if eaten_ids:
+            self.outbox.append(("kill", eaten_ids))
+
+    def kill(self, player_ids):
+        """A client of another shard ate these players"""
+        for player_id in player_ids:
+            self.recently_killed[player_id] = server.game.tick
+            if player_id in self.owned_ids:
+                server.game.remove_player(player_id)  # its client finds out on its next SYNC
+            else:
+                for mirrored_ids in self.mirrored_ids.values():
+                    if player_id in mirrored_ids:
+                        mirrored_ids.discard(player_id)
+                        server.game.players.remove(player_id)
+
+    def run_tick(self):
+        """One tick: advance the region, hand off whoever left it, mirror the border, push the snapshots"""
+        game = server.game
+        game.apply_commands()  # step would, but the eaten mirrors have to be found before it
+        self.find_eaten_mirrors()
+        game.step()
+
+        for client_id, session in list(self.sessions.items()):
+            if session.is_alive():
+                self.hand_off_if_outside(client_id, session)
+
+        left_ids = [player_id for player_id in self.owned_ids if game.players.get(player_id) is None]
+        if left_ids:
+            self.owned_ids.difference_update(left_ids)
+            self.outbox.append(("left", left_ids))
+
+        self.send_mirrors()
+        eaten_pallets_keys = game.pallet_field.take_eaten_keys()
+        if eaten_pallets_keys:
+            self.outbox.append(("pallets_eaten", eaten_pallets_keys))
+        for session in server.subscribers:
+            snapshot = server.build_snapshot(session)
+            pallet_chunks, pallets_update = server.build_pallets_update(session)
+            if session.push(snapshot + pallets_update):
+                session.pallet_chunks = pallet_chunks
+
+        if self.recently_killed:
+            self.recently_killed = {player_id: tick for player_id, tick in self.recently_killed.items()
+                                    if tick > game.tick - KILLED_MEMORY_TICKS}
+        self.outbox.append(("tick_done",))
+
+    def send_mirrors(self):
+        """Our players near a border, to the shard on the other side of it"""
+        start, end = self.region
+        left_rows, right_rows = [], []
+        for player_id in self.owned_ids:
+            player = server.game.players.get(player_id)
+            x, y = player.position
+            row = (player_id, player.mass, x, y)
+            if x < start + MIRROR_MARGIN:
+                left_rows.append(row)
+            if x >= end - MIRROR_MARGIN:
+                right_rows.append(row)
+
+        if self.index > 0:
+            self.outbox.append(("mirror", self.index - 1, left_rows))
+        if self.index < self.shards_count - 1:
+            self.outbox.append(("mirror", self.index + 1, right_rows))
+
+
+def run_shard(index, shards_count, width, height, tick_rate, seed, bot_name, connection, front_connections):
+    """A shard process"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # ctrl+c is for the front. we stop when it's gone
+    for front_connection in front_connections:
+        front_connection.close()  # forked copies of the front's ends. with them open we'd never see the front go
+    ShardWorker(index, shards_count, width, height, tick_rate, seed, bot_name, connection).run()
+
+
+class ShardLink:
+    """The front's end of a shard: its process, the pipe to it, and the messages waiting to go to it"""
+
+    def __init__(self, process, connection):
+        """initializer"""
+        self.process = process
+        self.connection = connection
+        self.outbox = []
+        self.send_queue = queue.SimpleQueue()
+        threading.Thread(target=self.send_forever, daemon=True).start()
+
+    def send_forever(self):
+        """On a thread of its own, so the event loop never waits for a full pipe"""
+        while True:
+            self.connection.send(self.send_queue.get())
+
+    def flush(self):
+        """send everything waiting"""
+        if self.outbox:
+            self.send_queue.put(self.outbox)
+            self.outbox = []
+
+
+class Router:
+    """The front process. every client's socket, the ids and names of every player, and the tick clock"""
+
+    def __init__(self):
+        """initializer"""
+        self.links = []  # shard index -> ShardLink
+        self.sessions = {}  # client id -> ClientSession
+        self.routes = {}  # client id -> index of the shard that has the client
+        self.waiting = {}  # client id -> future of the response the client waits for
+        self.client_ids = itertools.count(1)
+        self.busy_shards = set()  # shards that did not finish the last tick yet
+        self.tick_started_at = 0.0
+        self.flush_is_scheduled = False
+        self.loop = None
+
+    def start_shards(self, shards_count, bot_name):
+        """Start the shard processes. before anything else starts a thread"""
+        seed = random.randrange(1 << 32)
+        for index in range(shards_count):
+            connection, shard_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=run_shard, daemon=True,
+                args=(index, shards_count, server.game.width, server.game.height, server.game.tick_rate, seed,
+                      bot_name, shard_connection, [link.connection for link in self.links] + [connection]))
+            process.start()
+            shard_connection.close()
+            self.links.append(ShardLink(process, connection))
+
+    def send(self, index, message):
+        """Send a message to a shard, with everything else it gets on this turn of the event loop"""
+        self.links[index].outbox.append(message)
+        if not self.flush_is_scheduled:
+            self.flush_is_scheduled = True
+            self.loop.call_soon(self.flush)
+
+    def flush(self):
+        """send what's waiting for every shard"""
+        self.flush_is_scheduled = False
+        for link in self.links:
+            link.flush()
+
+    def receive_from_shard(self, index):
+        """The shard's pipe is readable"""
+        connection = self.links[index].connection
+        while connection.poll():
+            try:
+                messages = connection.recv()
+            except EOFError:
+                self.loop.remove_reader(connection.fileno())
+                print(f"shard {index} is gone!")
+                return
+            for message in messages:
+                self.handle_shard_message(index, message)
+
+    def handle_shard_message(self, index, message):
+        """one message from a shard"""
+        kind = message[0]
+        if kind == "push":
+            _, client_id, snapshot = message
+            session = self.sessions.get(client_id)
+            if session is not None and not server.push_snapshot(session, snapshot):
+                self.send(index, ("dropped", client_id))  # it thinks the client has the pallets it just sent
+
+        elif kind == "response":
+            _, client_id, response = message
+            future = self.waiting.pop(client_id, None)
+            if future is not None and not future.done():
+                future.set_result(response)
+
+        elif kind == "handoff":
+            _, client_id, shard_index, state = message
+            self.send(shard_index, ("adopt", client_id, state))
+            if client_id in self.routes:
+                self.routes[client_id] = shard_index
+            else:
+                self.send(shard_index, ("disconnect", client_id))  # it left while it was handed off
+
+        elif kind == "mirror":
+            _, shard_index, rows = message
+            self.send(shard_index, ("mirror", index, rows))
+
+        elif kind == "kill" or kind == "pallets_eaten":
+            for shard_index in range(len(self.links)):
+                if shard_index != index:
+                    self.send(shard_index, message)
+
+        elif kind == "left":
+            for player_id in message[1]:
+                server.game.remove_player(player_id)
+
+        elif kind == "reroute":
+            _, rerouted_message = message
+            client_id = rerouted_message[1]
+            if client_id in self.routes:
+                self.send(self.routes[client_id], rerouted_message)
+
+        elif kind == "tick_done":
+            self.busy_shards.discard(index)
+            if not self.busy_shards:
+                server.stats.record_tick(time.perf_counter() - self.tick_started_at)
+
+    async def handle_client(self, async_server, reader, writer):
+        """Handle all requests of a client"""
+        client_id = next(self.client_ids)
+        session = server.ClientSession(push=lambda data: async_server.push(writer, data))
+        self.sessions[client_id] = session
+        server.sessions.add(session)
+        self.routes[client_id] = client_id % len(self.links)  # spread the clients that have no player yet
+        self.send(self.routes[client_id], ("connect", client_id))
+
+        try:
+            while not session.quit:
+                request = await async_server.receive(reader)
+                if not request:
+                    break  # client disconnected without saying goodbye
+
+                response = await self.handle_request(client_id, session, request)
+                if response:
+                    await async_server.send(writer, response)
+        finally:
+            if not session.quit:  # after a QUIT its shard already let it go
+                self.send(self.routes[client_id], ("disconnect", client_id))
+        del self.sessions[client_id], self.routes[client_id]
+        self.waiting.pop(client_id, None)
+        server.sessions.discard(session)
+
+    async def handle_request(self, client_id, session, request):
+        """
+        Answer what the front knows by itself, send the rest to the client's shard and wait for its answer.
+        :return: the response to send back, None if the request is broken.
+        """
+        start = time.perf_counter()
+        game = server.game
+        operation_number, payload = protocol.split_request(request)
+        try:
+            if operation_number == Consts.Request.WELCOME_INFO:
+                players_ids, players_names = game.names_table()
+                response = protocol.build_welcome_info_response(
+                    game.width, game.height, game.tick_rate, players_ids, players_names,
+                    [server.PLAYER_INITIAL_MASS] * len(players_ids)  # their snapshots will tell
+                )
+
+            elif operation_number == Consts.Request.SPAWN_NEW_PLAYER:
+                name = protocol.decrypt_spawn_new_player_request(payload)
+                session.player = game.create_new_player(name)
+                x, y = session.player.position
+                self.send(self.routes[client_id], ("spawn", client_id, session.player.id, name, (x, y)))
+                response = protocol.build_spawn_new_player_response(session.player.id, session.player.mass, x, y)
+
+            elif operation_number == Consts.Request.NAMES:
+                players_ids = protocol.decrypt_ids_request(payload)
+                response = protocol.build_names_response(server.names_of_players(players_ids))
+
+            else:
+                self.send(self.routes[client_id], ("request", client_id, request))
+                if operation_number in NO_RESPONSE_OPERATIONS:
+                    response = server.NO_RESPONSE
+                else:
+                    future = self.loop.create_future()
+                    self.waiting[client_id] = future
+                    response = await future
+                if operation_number == Consts.Update.QUIT:
+                    session.quit = True
+        except protocol.DECODE_ERRORS:  # a whole frame, but what's in it is not what this operation has
+            response = None
+
+        if response is None:
+            server.stats.record_broken_request()
+        else:
+            server.stats.record_request(session, operation_number, len(request), len(response),
+                                        time.perf_counter() - start)
+        return response
+
+    async def run(self, max_clients):
+        """Serve the clients and keep the tick clock, forever"""
+        self.loop = asyncio.get_running_loop()
+        for index, link in enumerate(self.links):
+            self.loop.add_reader(link.connection.fileno(), self.receive_from_shard, index)
+
+        async_server = AsyncServer(host="0.0.0.0", port=protocol.PORT, max_clients=max_clients)
+        await async_server.start(self.handle_client)
+        print(f"Server is up up and running! ({len(self.links)} shards)")
+
+        tick_duration = 1 / server.game.tick_rate
+        next_tick_time = self.loop.time()
+        while True:
+            if self.busy_shards:
+                server.stats.record_overrun()  # a shard is still busy with the last tick. everyone skips this one
+            else:
+                self.busy_shards = set(range(len(self.links)))
+                self.tick_started_at = time.perf_counter()
+                server.game.tick += 1
+                for index in range(len(self.links)):
+                    self.send(index, ("tick",))
+
+            if server.stats_log_interval and \
+                    time.perf_counter() - server.stats.last_log_time >= server.stats_log_interval:
+                print(server.stats.log_line(len(server.sessions), len(server.game.players), server.game.tick))
+
+            next_tick_time += tick_duration
+            delay = next_tick_time - self.loop.time()
+            if delay < 0:
+                server.stats.record_overrun()
+                next_tick_time = self.loop.time()  # we are late. don't try to catch up with a burst of ticks
+            await asyncio.sleep(max(0.0, delay))
+
+
+# CONSTANTS
+MIRROR_MARGIN = 150  # players this close to a border are mirrored to the shard on the other side. covers a viewport
+KILLED_MEMORY_TICKS = 20  # how long a shard ignores late news about a player that was eaten
+NO_RESPONSE_OPERATIONS = {Consts.Update.ACK, Consts.Update.REQUEST_KEYFRAME, Consts.Update.VIEWPORT}
+
+
+def parse_arguments():
+    """command line arguments: the server's, and how many shards"""
+    parser = server.build_argument_parser()
+    parser.description = "agar.io clone server, with the map split between worker processes (always asyncio)"
+    parser.add_argument("--shards", type=int, default=os.cpu_count(),
+                        help="worker processes. the map is split into this many vertical strips")
+    arguments = parser.parse_args()
+    if arguments.udp:
+        parser.error("--udp is not supported here, the front only speaks TCP. clients asking for it stay on TCP")
+    if arguments.record_replay:
+        parser.error("--record-replay is not supported here, no process has the whole world")
+    return arguments
+
+
+def main():
+    arguments = parse_arguments()
+    # the front's game only has names and ids: the directory of every player
+    server.game = server.Game(arguments.map_width, arguments.map_height, arguments.tick_rate)
+    server.game.create_new_fake_player()
+    server.stats_log_interval = arguments.stats_log_interval
+
+    router = Router()
+    router.start_shards(arguments.shards, server.game.names[BOT_SLOT])
+    if arguments.stats_port:
+        start_stats_server(arguments.stats_port, server.stats_text, server.stats_dict)
+    asyncio.run(router.run(arguments.max_clients))
+
+
+if __name__ == '__main__':
+    main()
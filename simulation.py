@@ -0,0 +1,221 @@
+"""
+Run the server's game headless, on a virtual clock, as fast as the CPU allows. no sockets, no waiting for ticks.
+Bots send the same requests real clients do (through server.handle_request), the world gets a seeded random,
+so the same seed (or the same recorded script) gives the same game, tick by tick.
+
+Every tick's world hash can be written down, so two runs can be diffed, and the slowest ticks are reported,
+so a slow tick can be replayed up to the tick it happens on and looked at.
+
+python3 simulation.py --bots 500 --ticks 3000 --seed 7                       soak / capacity run
+python3 simulation.py --bots 200 --ticks 1000 --record script.jsonl          save every request
+python3 simulation.py --replay script.jsonl --hashes hashes.txt              run exactly the same requests again
+python3 simulation.py --replay script.jsonl --stop-at-tick 420 --dump        the world as it was on tick 420
+python3 simulation.py --bots 200 --record-replay sim.replay                 watch it with replay.py sim.replay
+"""
+import argparse
+import hashlib
+import json
+import random
+import time
+
+import protocol
+from protocol import Consts
+import server
+from replay_log import ReplayWriter
+from stats import Histogram, format_histogram
+
+STEP_SIZE = 6  # how far a bot moves every tick, in game units
+SLOWEST_TICKS = 10  # how many of the slowest ticks to report
+
+
+class SimulatedClient:
+    """A bot. it plays like load_test.py's bots, but talks to handle_request directly"""
+
+    def __init__(self, name, rng, arguments):
+        """initializer"""
+        self.name = name
+        self.rng = rng
+        self.arguments = arguments
+        self.is_joined = False
+        self.player_id = None
+        self.position = (0, 0)
+
+    def play(self, send):
+        """
+        Decide what to send on this tick, and send it.
+        :param send: send(frame) hands a request to the server, and returns the response
+        """
+        if not self.is_joined:
+            if self.rng.random() < self.arguments.join_chance:
+                send(protocol.build_request(Consts.Request.SUBSCRIBE))
+                self.spawn(send)
+                self.is_joined = True
+            return
+
+        # acknowledge the last tick's snapshot, like the client does
+        send(protocol.build_ack_request(server.game.tick))
+
+        x, y = self.position
+        x = min(max(1, x + self.rng.randint(-STEP_SIZE, STEP_SIZE)), server.game.width - 1)
+        y = min(max(1, y + self.rng.randint(-STEP_SIZE, STEP_SIZE)), server.game.height - 1)
+        self.position = (x, y)
+
+        eaten_ids = []
+        if self.rng.random() < self.arguments.eat_chance:
+            around_us = server.viewport_around(self.position, server.PLAYER_INITIAL_MASS)
+            candidates = sorted(server.game.players_ids_in(around_us) - {self.player_id})
+            if candidates:
+                eaten_ids.append(self.rng.choice(candidates))
+
+        response = send(protocol.build_sync_request(self.position, server.PLAYER_INITIAL_MASS, eaten_ids))
+        if not protocol.decrypt_sync_response(response):
+            self.spawn(send)  # somebody ate us
+
+        if self.rng.random() < self.arguments.quit_chance:
+            send(protocol.build_request(Consts.Update.QUIT))
+            self.is_joined = False
+
+    def spawn(self, send):
+        """get a new player"""
+        response = send(protocol.build_spawn_new_player_request(self.name))
+        self.player_id, _, x, y = protocol.decrypt_spawn_a_new_player_response(response)
+        self.position = (x, y)
+
+
+class Simulation:
+    """The server's game and the sessions of every simulated client, stepped one tick at a time"""
+
+    def __init__(self, seed, tick_rate):
+        """initializer"""
+        server.game = server.Game(server.GAME_WIDTH, server.GAME_HEIGHT, tick_rate, rng=random.Random(seed))
+        server.game.create_new_fake_player()
+        server.subscribers.clear()
+        server.stats_log_interval = 0  # the log line runs on the real clock
+        server.replay_writer = None
+
+        self.sessions = {}  # client number -> its ClientSession
+        self.pushed_bytes = 0
+        self.recorded = []  # (tick, client number, request) of everything that was sent
+
+    def push(self, frame):
+        """what the server pushes to a simulated client. nobody reads it, only counted"""
+        self.pushed_bytes += len(frame)
+        return True
+
+    def send(self, client_number, request):
+        """Hand a request from a client to the server. a client that quit connects again with its next request"""
+        session = self.sessions.get(client_number)
+        if session is None or session.quit:
+            session = self.sessions[client_number] = server.ClientSession(push=self.push)
+        self.recorded.append((server.game.tick, client_number, request))
+        return server.handle_request(session, request)
+
+    def run_tick(self):
+        """:return: how long the tick took"""
+        start = time.perf_counter()
+        server.run_tick()
+        return time.perf_counter() - start
+
+
+def world_hash(game):
+    """A short fingerprint of the world at the end of the last tick. the same game, the same hash"""
+    return hashlib.sha1(repr(sorted(game.world_state.items())).encode()).hexdigest()[:16]
+
+
+def load_script(path):
+    """tick -> [(client number, request)] of a script written by --record"""
+    script = {}
+    with open(path) as script_file:
+        header = json.loads(script_file.readline())
+        for line in script_file:
+            tick, client_number, request = json.loads(line)
+            script.setdefault(tick, []).append((client_number, bytes.fromhex(request)))
+    return header, script
+
+
+def save_script(path, header, recorded):
+    """a header line, then a line for every request: [tick, client number, request in hex]"""
+    with open(path, "w") as script_file:
+        script_file.write(json.dumps(header) + "\n")
+        for tick, client_number, request in recorded:
+            script_file.write(json.dumps([tick, client_number, request.hex()]) + "\n")
+
+
+def parse_arguments():
+    """command line arguments"""
+    parser = argparse.ArgumentParser(description="deterministic headless simulation of the agar.io clone server")
+    parser.add_argument("--bots", type=int, default=100)
+    parser.add_argument("--ticks", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--tick-rate", type=int, default=server.FPS,
+                        help="ticks a second of game time (the simulation itself runs as fast as it can)")
+    parser.add_argument("--join-chance", type=float, default=0.05, help="chance a bot that's not in joins, per tick")
+    parser.add_argument("--eat-chance", type=float, default=0.005, help="chance a bot eats someone, per tick")
+    parser.add_argument("--quit-chance", type=float, default=0.001, help="chance a bot quits, per tick")
+    parser.add_argument("--record", help="write every request to this script file")
+    parser.add_argument("--replay", help="send the requests of this script file instead of running bots")
+    parser.add_argument("--hashes", help="write the world hash of every tick to this file")
+    parser.add_argument("--stop-at-tick", type=int, help="stop after this tick")
+    parser.add_argument("--dump", action="store_true", help="print the world (id, mass, x, y) at the end")
+    parser.add_argument("--record-replay", metavar="PATH", help="write a replay log of the game, see replay.py")
+    return parser.parse_args()
+
+
+def main():
+    """Run the simulation and report how fast the ticks were"""
+    arguments = parse_arguments()
+
+    script = None
+    if arguments.replay:
+        header, script = load_script(arguments.replay)
+        arguments.seed, arguments.tick_rate, arguments.ticks = header["seed"], header["tick_rate"], header["ticks"]
+    last_tick = arguments.ticks if arguments.stop_at_tick is None else min(arguments.ticks, arguments.stop_at_tick)
+
+    simulation = Simulation(arguments.seed, arguments.tick_rate)
+    if arguments.record_replay:
+        server.replay_writer = ReplayWriter(arguments.record_replay, server.game)
+    bots_rng = random.Random(arguments.seed + 1)
+    bots = [SimulatedClient(f"bot{number}", random.Random(bots_rng.random()), arguments)
+            for number in range(arguments.bots)]
+
+    tick_times = Histogram()
+    slowest_ticks = []  # (seconds, tick)
+    hashes = []
+    start = time.perf_counter()
+    while server.game.tick < last_tick:
+        if script is not None:
+            for client_number, request in script.get(server.game.tick, ()):
+                simulation.send(client_number, request)
+        else:
+            for client_number, bot in enumerate(bots):
+                bot.play(lambda request: simulation.send(client_number, request))
+
+        seconds = simulation.run_tick()
+        tick_times.record(seconds)
+        slowest_ticks = sorted(slowest_ticks + [(seconds, server.game.tick)], reverse=True)[:SLOWEST_TICKS]
+        hashes.append((server.game.tick, world_hash(server.game)))
+    elapsed = time.perf_counter() - start
+    if server.replay_writer is not None:
+        server.replay_writer.close()
+
+    game_seconds = server.game.tick / arguments.tick_rate
+    print(f"{server.game.tick} ticks ({game_seconds:.0f} s of game) in {elapsed:.2f} s, "
+          f"{game_seconds / elapsed:.1f}x real time, {len(server.game.players)} players at the end")
+    print(f"ticks: {format_histogram(tick_times.to_dict())}")
+    print(f"pushed {simulation.pushed_bytes / 1024:.0f} KiB, {len(simulation.recorded)} requests")
+    print("slowest ticks: " + ", ".join(f"{tick} ({seconds * 1000:.2f} ms)" for seconds, tick in slowest_ticks))
+    print(f"world hash: {hashes[-1][1] if hashes else None}")
+
+    if arguments.hashes:
+        with open(arguments.hashes, "w") as hashes_file:
+            hashes_file.writelines(f"{tick} {tick_hash}\n" for tick, tick_hash in hashes)
+    if arguments.record:
+        save_script(arguments.record, {"seed": arguments.seed, "tick_rate": arguments.tick_rate,
+                                       "ticks": arguments.ticks}, simulation.recorded)
+    if arguments.dump:
+        for player_id, (mass, x, y) in sorted(server.game.world_state.items()):
+            print(f"{player_id} {mass} {x} {y}")
+
+
+if __name__ == '__main__':
+    main()
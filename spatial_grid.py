@@ -0,0 +1,84 @@
+class SpatialGrid:
+    """
+    A uniform grid over the map. Every item lives in the cell its position falls in,
+    so finding what is near a point only looks at a few cells instead of at everything.
+    Items can be anything hashable (player ids, game objects...).
+    """
+
+    def __init__(self, cell_size):
+        """initializer"""
+        self.cell_size = cell_size
+        self.cells = {}  # (column, row) -> set of items
+        self.item_cells = {}  # item -> (column, row) of the cell it's in
+
+    def cell_of(self, position):
+        """the (column, row) of the cell a position falls in"""
+        x, y = position
+        return int(x // self.cell_size), int(y // self.cell_size)
+
+    def insert(self, item, position):
+        """Add an item, or move it if it's already in the grid"""
+        cell = self.cell_of(position)
+        old_cell = self.item_cells.get(item)
+        if old_cell == cell:
+            return
+        if old_cell is not None:
+            self._remove_from_cell(item, old_cell)
+
+        self.item_cells[item] = cell
+        items = self.cells.get(cell)
+        if items is None:
+            self.cells[cell] = {item}
+        else:
+            items.add(item)
+
+    move = insert
+
+    def remove(self, item):
+        """Remove an item. does nothing if it's not in the grid"""
+        cell = self.item_cells.pop(item, None)
+        if cell is not None:
+            self._remove_from_cell(item, cell)
+
+    def _remove_from_cell(self, item, cell):
+        """take an item out of a cell, and forget the cell if it's empty now"""
+        items = self.cells[cell]
+        items.discard(item)
+        if not items:
+            del self.cells[cell]
+
+    def query_rect(self, left, top, right, bottom):
+        """
+        Everything in the cells the rect touches. it may include items a bit outside of the rect,
+        the caller checks the exact bounds if it cares.
+        """
+        first_column, first_row = self.cell_of((left, top))
+        last_column, last_row = self.cell_of((right, bottom))
+        cells = self.cells
+        found = []
+        if (last_column - first_column + 1) * (last_row - first_row + 1) > len(cells):
+            # the rect covers more cells than there are non empty ones. cheaper to go over those
+            for (column, row), items in cells.items():
+                if first_column <= column <= last_column and first_row <= row <= last_row:
+                    found.extend(items)
+            return found
+
+        for column in range(first_column, last_column + 1):
+            for row in range(first_row, last_row + 1):
+                items = cells.get((column, row))
+                if items:
+                    found.extend(items)
+        return found
+
+    def query_circle(self, position, radius):
+        """Everything in the cells a circle touches. see query_rect"""
+        x, y = position
+        return self.query_rect(x - radius, y - radius, x + radius, y + radius)
+
+    def __contains__(self, item):
+        """is the item in the grid"""
+        return item in self.item_cells
+
+    def __len__(self):
+        """how many items are in the grid"""
+        return len(self.item_cells)
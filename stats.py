@@ -0,0 +1,201 @@
+"""
+What the server is doing, cheap enough to leave on: request counts and latency histograms per operation,
+bytes in and out per client, tick durations and overruns.
+Served as text (/) and JSON (/json) on a local HTTP port, and summed up in a log line every few seconds.
+Counters are updated without locks from many threads. a lost increment here and there is fine for stats.
+Only the table of operations has one: a report going through it while a new operation is added would raise.
+"""
+import json
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BUCKETS_PER_DOUBLING = 4
+BUCKET_BOUNDS = [2 ** (step / BUCKETS_PER_DOUBLING) / 1_000_000
+                 for step in range(24 * BUCKETS_PER_DOUBLING + 1)]  # 1 microsecond to 16 seconds, about 19% apart
+PERCENTILES = (0.5, 0.9, 0.99)
+
+
+class Histogram:
+    """How long something took, in buckets that grow exponentially. O(log buckets) to record, no list of samples"""
+
+    def __init__(self):
+        """initializer"""
+        self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)  # the last one is for anything slower than the last bound
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        """one more measurement"""
+        self.buckets[bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """the upper bound of the bucket this fraction of the measurements are in or below"""
+        if not self.count:
+            return 0.0
+        wanted = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKET_BOUNDS, self.buckets):
+            seen += count
+            if seen >= wanted:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        """count, average, percentiles and max, in milliseconds"""
+        numbers = {"count": self.count, "avg_ms": self.total / self.count * 1000 if self.count else 0.0}
+        for fraction in PERCENTILES:
+            numbers[f"p{int(fraction * 100)}_ms"] = self.percentile(fraction) * 1000
+        numbers["max_ms"] = self.max * 1000
+        return numbers
+
+
+class ServerStats:
+    """Everything the server counts. one of them for the whole server, see server.stats"""
+
+    def __init__(self, operation_names):
+        """
+        initializer
+        :param operation_names: operation number -> name, for the reports
+        """
+        self.operation_names = operation_names
+        self.started_at = time.time()
+        self.requests = {}  # operation number -> Histogram of how long handling it took
+        self.requests_lock = threading.Lock()  # for adding to requests, and copying it. not for recording
+        self.broken_requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.ticks = Histogram()
+        self.overruns = 0  # ticks that ended after the next one should have started
+        self.last_log_time = time.perf_counter()
+        self.last_log_numbers = (0, 0, 0)  # requests, bytes in, bytes out at the last log line
+
+    def record_request(self, session, operation_number, request_length, response_length, seconds):
+        """A request was handled. session is the ClientSession it came from"""
+        histogram = self.requests.get(operation_number)
+        if histogram is None:
+            with self.requests_lock:
+                histogram = self.requests.setdefault(operation_number, Histogram())
+        histogram.record(seconds)
+        self.bytes_in += request_length
+        self.bytes_out += response_length
+        session.bytes_in += request_length
+        session.bytes_out += response_length
+
+    def record_broken_request(self):
+        """A request we could not make sense of"""
+        self.broken_requests += 1
+
+    def record_push(self, session, length):
+        """A frame was pushed to a client"""
+        self.bytes_out += length
+        session.bytes_out += length
+
+    def record_tick(self, seconds):
+        """A tick took this long, pushes included"""
+        self.ticks.record(seconds)
+
+    def record_overrun(self):
+        """A tick ended too late for the next one to start on time"""
+        self.overruns += 1
+
+    def to_dict(self, sessions, alive_players, tick):
+        """Everything, ready for JSON. sessions are the connected ClientSessions"""
+        sessions = list(sessions)
+        with self.requests_lock:
+            requests = sorted(self.requests.items())
+        return {
+            "uptime_seconds": time.time() - self.started_at,
+            "tick": tick,
+            "connected_clients": len(sessions),
+            "alive_players": alive_players,
+            "ticks": self.ticks.to_dict(),
+            "tick_overruns": self.overruns,
+            "requests": {self.operation_names.get(operation_number, str(operation_number)): histogram.to_dict()
+                         for operation_number, histogram in requests},
+            "broken_requests": self.broken_requests,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "clients": [{"player": session.player.name if session.player is not None else None,
+                         "bytes_in": session.bytes_in, "bytes_out": session.bytes_out} for session in sessions],
+        }
+
+    def to_text(self, sessions, alive_players, tick):
+        """Everything, for people"""
+        numbers = self.to_dict(sessions, alive_players, tick)
+        lines = [
+            f"uptime {numbers['uptime_seconds']:.0f} s, tick {tick}",
+            f"clients {numbers['connected_clients']}, alive players {alive_players}",
+            f"ticks {format_histogram(numbers['ticks'])}, overruns {numbers['tick_overruns']}",
+            f"bytes in {numbers['bytes_in']}, out {numbers['bytes_out']}, broken requests {numbers['broken_requests']}",
+            "requests:",
+        ]
+        for name, histogram in numbers["requests"].items():
+            lines.append(f"  {name:<20} {format_histogram(histogram)}")
+
+        lines.append("top clients by bytes out:")
+        for client in sorted(numbers["clients"], key=lambda client: client["bytes_out"], reverse=True)[:10]:
+            lines.append(f"  {client['player']!s:<20} in {client['bytes_in']:>10}  out {client['bytes_out']:>10}")
+        return "\n".join(lines) + "\n"
+
+    def log_line(self, connected_clients, alive_players, tick):
+        """A one line summary of what happened since the last one"""
+        now = time.perf_counter()
+        seconds = max(now - self.last_log_time, 1e-9)
+        with self.requests_lock:
+            histograms = list(self.requests.values())
+        requests = sum(histogram.count for histogram in histograms)
+        last_requests, last_bytes_in, last_bytes_out = self.last_log_numbers
+        self.last_log_time = now
+        self.last_log_numbers = (requests, self.bytes_in, self.bytes_out)
+        return (f"[stats] tick {tick}: {connected_clients} clients, {alive_players} alive, "
+                f"{(requests - last_requests) / seconds:.0f} requests/s, "
+                f"in {(self.bytes_in - last_bytes_in) / seconds / 1024:.1f} KiB/s, "
+                f"out {(self.bytes_out - last_bytes_out) / seconds / 1024:.1f} KiB/s, "
+                f"ticks p99 {self.ticks.percentile(0.99) * 1000:.2f} ms max {self.ticks.max * 1000:.2f} ms, "
+                f"{self.overruns} overruns")
+
+
+def format_histogram(numbers):
+    """count and timings of a Histogram.to_dict, in one line"""
+    return (f"count {numbers['count']}, avg {numbers['avg_ms']:.3f} ms, p50 {numbers['p50_ms']:.3f} ms, "
+            f"p90 {numbers['p90_ms']:.3f} ms, p99 {numbers['p99_ms']:.3f} ms, max {numbers['max_ms']:.3f} ms")
+
+
+def start_stats_server(port, get_text, get_dict):
+    """
+    Serve the stats on localhost:port, on a thread of its own. / is text, /json is JSON.
+    :param get_text: get_text() returns the text report
+    :param get_dict: get_dict() returns the report as a dict
+    """
+
+    class StatsRequestHandler(BaseHTTPRequestHandler):
+        """answers GET / and GET /json"""
+
+        def do_GET(self):
+            """send the stats"""
+            if self.path == "/json":
+                body, content_type = json.dumps(get_dict(), indent=2).encode(), "application/json"
+            elif self.path == "/":
+                body, content_type = get_text().encode(), "text/plain; charset=utf-8"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            """don't print a line for every request"""
+
+    http_server = ThreadingHTTPServer(("127.0.0.1", port), StatsRequestHandler)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    return http_server